@@ -0,0 +1,21 @@
+# Gunicorn reads this file from the working directory (WorkingDirectory in the
+# systemd unit). Command-line options such as --workers and --threads still apply.
+import os
+
+from dotenv import load_dotenv
+
+import shared_snapshot
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def on_exit(server):
+    """Runs in the master once every worker has stopped: removes the decrypted
+    snapshots published with SHARED_DATA=1. A single worker that is recycled or
+    dies never removes them, the others are still mapping them."""
+    load_dotenv(os.path.join(BASE_DIR, '.env'))
+    if os.environ.get('SHARED_DATA', '0') != '1':
+        return
+    data_dir = os.environ.get('DATA_PATH', os.path.join(BASE_DIR, "data"))
+    directory = shared_snapshot.snapshot_directory(data_dir)
+    if directory:
+        shared_snapshot.remove_snapshots(directory)
@@ -0,0 +1,198 @@
+"""Chunked encrypted storage for lists of JSON records (students, timetable).
+
+Instead of one Fernet token for the whole file, every record is its own
+AES-GCM frame, so a single record can be read through the index, the file can be
+streamed record by record and new records can be appended without re-encrypting
+the rest. Used by server.py and utils/encrypt_data.py.
+
+Layout:
+    MAGIC | frame* | index frame | footer
+    frame  = kind (1 byte) | length (u32) | nonce (12) | ciphertext + tag
+    footer = offset of the index frame (u64) | FOOTER_MAGIC
+
+The index frame holds {key: offset} for the live records. If the footer is
+missing or damaged readers fall back to scanning the frames.
+
+Writers never touch a file in place: both a full write and an append build a
+temp file and rename it over the old one (an append copies the existing frames
+as they are), so readers in other processes, which take no lock, always see a
+complete file. Writers serialise on a sidecar "<path>.lock" file.
+"""
+import os
+import json
+import base64
+import struct
+import fcntl
+from contextlib import contextmanager
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+MAGIC = b"SJC1"
+FOOTER_MAGIC = b"SJCX"
+FRAME_DATA = b"D"
+FRAME_INDEX = b"I"
+FRAME_HEADER = struct.Struct(">cI")
+FOOTER = struct.Struct(">Q4s")
+NONCE_SIZE = 12
+
+def derive_aead(fernet_key):
+    """AES-GCM cipher derived (HKDF) from the STUDENTS_DATA_KEY Fernet key."""
+    if isinstance(fernet_key, str):
+        fernet_key = fernet_key.encode()
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"partesSalida chunked secure json v1")
+    return AESGCM(hkdf.derive(base64.urlsafe_b64decode(fernet_key)))
+
+def is_chunked(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def record_key(record, position):
+    if isinstance(record, dict) and record.get('id') not in (None, ''):
+        return str(record['id'])
+    return f"#{position}"
+
+def encode_record(record):
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def encode_frame(aead, kind, payload):
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = aead.encrypt(nonce, payload, MAGIC + kind)
+    return FRAME_HEADER.pack(kind, NONCE_SIZE + len(sealed)) + nonce + sealed
+
+def read_frame(f, aead):
+    """Returns (kind, offset, plaintext) or None at the end of the frames."""
+    offset = f.tell()
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size or header[:len(FOOTER_MAGIC)] == FOOTER_MAGIC:
+        return None
+    kind, length = FRAME_HEADER.unpack(header)
+    if kind not in (FRAME_DATA, FRAME_INDEX):
+        return None  # footer bytes or a torn write
+    body = f.read(length)
+    if len(body) < length:
+        return None
+    return kind, offset, aead.decrypt(body[:NONCE_SIZE], body[NONCE_SIZE:], MAGIC + kind)
+
+def read_index(f, aead):
+    """({key: offset}, index offset) from the footer, or (None, None) if there is no valid footer."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size < len(MAGIC) + FOOTER.size:
+        return None, None
+    f.seek(size - FOOTER.size)
+    index_offset, magic = FOOTER.unpack(f.read(FOOTER.size))
+    if magic != FOOTER_MAGIC or index_offset >= size:
+        return None, None
+    f.seek(index_offset)
+    frame = read_frame(f, aead)
+    if not frame or frame[0] != FRAME_INDEX:
+        return None, None
+    return json.loads(frame[2]), index_offset
+
+def scan_index(f, aead):
+    """Rebuilds ({key: offset}, end of the last data frame) reading every frame; the last frame for a key wins."""
+    index, position, end = {}, 0, len(MAGIC)
+    f.seek(len(MAGIC))
+    while True:
+        frame = read_frame(f, aead)
+        if not frame:
+            return index, end
+        if frame[0] == FRAME_DATA:
+            index[record_key(json.loads(frame[2]), position)] = frame[1]
+            position += 1
+            end = f.tell()
+
+def load_index(f, aead):
+    index, end = read_index(f, aead)
+    if index is None:
+        index, end = scan_index(f, aead)
+    return index, end
+
+def write_tail(f, aead, index):
+    index_offset = f.tell()
+    f.write(encode_frame(aead, FRAME_INDEX, json.dumps(index, separators=(',', ':')).encode('utf-8')))
+    f.write(FOOTER.pack(index_offset, FOOTER_MAGIC))
+    f.truncate()
+
+@contextmanager
+def writer_lock(path):
+    """Exclusive lock shared by every writer of path (the file itself is replaced, so it cannot hold the lock)."""
+    with open(f"{path}.lock", 'ab') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def write_records(path, records, aead):
+    """Writes the whole list (temp file + rename)."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    index = {}
+    with writer_lock(path):
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            for position, record in enumerate(records):
+                index[record_key(record, position)] = f.tell()
+                f.write(encode_frame(aead, FRAME_DATA, encode_record(record)))
+            write_tail(f, aead, index)
+        os.replace(tmp_path, path)
+
+def append_records(path, records, aead):
+    """Appends (or replaces, by key) records: copies the existing frames without
+    decrypting them, encrypts only the new ones and renames the copy into place."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with writer_lock(path):
+        with open(path, 'rb') as src:
+            index, end = load_index(src, aead)
+            src.seek(0)
+            existing = src.read(end)
+        with open(tmp_path, 'wb') as f:
+            f.write(existing)
+            position = len(index)
+            for record in records:
+                index[record_key(record, position)] = f.tell()
+                f.write(encode_frame(aead, FRAME_DATA, encode_record(record)))
+                position += 1
+            write_tail(f, aead, index)
+        os.replace(tmp_path, path)
+
+def iter_records(path, aead):
+    """Streams the live records in file order, decrypting one frame at a time."""
+    with open(path, 'rb') as f:
+        live, _ = load_index(f, aead)
+        live_offsets = set(live.values())
+        f.seek(len(MAGIC))
+        while True:
+            frame = read_frame(f, aead)
+            if not frame:
+                return
+            kind, offset, payload = frame
+            if kind == FRAME_DATA and offset in live_offsets:
+                yield json.loads(payload)
+
+def read_all(path, aead):
+    """Whole list at once: one read and a single json parse over the joined frames
+    (what the roster cache uses; iter_records keeps memory flat instead)."""
+    with open(path, 'rb') as f:
+        live, _ = load_index(f, aead)
+        f.seek(0)
+        buf = memoryview(f.read())
+    payloads = []
+    for offset in sorted(live.values()):
+        kind, length = FRAME_HEADER.unpack_from(buf, offset)
+        body = buf[offset + FRAME_HEADER.size:offset + FRAME_HEADER.size + length]
+        payloads.append(aead.decrypt(body[:NONCE_SIZE], body[NONCE_SIZE:], MAGIC + kind))
+    return json.loads(b"[" + b",".join(payloads) + b"]")
+
+def read_record(path, key, aead):
+    """Reads one record by key (student id) using the index. None if not found."""
+    with open(path, 'rb') as f:
+        index, _ = load_index(f, aead)
+        offset = index.get(str(key))
+        if offset is None:
+            return None
+        f.seek(offset)
+        frame = read_frame(f, aead)
+        return json.loads(frame[2]) if frame else None
@@ -1,20 +1,37 @@
 import os
+import re
 import csv
+import copy
 import json
 import secrets
+import hashlib
+import unicodedata
 import sqlite3
 import tempfile
 import shutil
+import threading
+import time
+import gc
+import base64
+import atexit
+import io
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
-import pandas as pd
-from fpdf import FPDF
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from itertools import accumulate, chain
+from collections.abc import Mapping, Sequence
+from xml.sax.saxutils import escape as xml_escape
 from cryptography.fernet import Fernet
+import secure_json
+import shared_snapshot
 
-from flask import Flask, request, jsonify, session, send_from_directory, redirect, url_for, make_response
+from flask import Flask, request, jsonify, session, send_from_directory, redirect, url_for, make_response, Response, stream_with_context, g, has_request_context
+from flask.sessions import SessionInterface, SessionMixin
+from flask.json.tag import TaggedJSONSerializer
+from werkzeug.datastructures import CallbackDict
+from itsdangerous import Signer, BadSignature
 from flask_bcrypt import Bcrypt
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -72,6 +89,18 @@ try:
 except Exception as e:
     raise RuntimeError(f"FATAL: Invalida STUDENTS_DATA_KEY format: {e}")
 
+# Encrypted JSON files are written as per-record AES-GCM frames ('chunked', see
+# secure_json.py) or as a single Fernet token ('fernet'). Both are always readable.
+# Unset, a write keeps the format the file already has (new files: fernet).
+SECURE_JSON_FORMAT = os.environ.get('SECURE_JSON_FORMAT', '').lower()
+
+# lazy (default): pandas/openpyxl load on the first roster upload, FPDF on the
+# first ticket, smtplib on the first email, and the timetable/roster on first use.
+# preload: warm all of that at import, meant for `gunicorn --preload` so the
+# workers share the master's pages copy-on-write (see warm_up()).
+STARTUP_MODE = os.environ.get('STARTUP_MODE', 'lazy').lower()
+chunked_aead = secure_json.derive_aead(STUDENTS_DATA_KEY)
+
 # Paths & Directories
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.environ.get('DATA_PATH', os.path.join(BASE_DIR, "data"))
@@ -85,26 +114,171 @@ for d in [DATA_DIR, PDF_DIR]:
 CSV_FILE = os.path.join(DATA_DIR, "salidas.csv")
 LOG_FILE = os.path.join(DATA_DIR, "server_error.log")
 DB_FILE = os.path.join(DATA_DIR, "sessions.db")
+EXITS_DB_FILE = os.path.join(DATA_DIR, "salidas.db")
 
-CSV_HEADERS = ["Fecha", "Hora", "ID Alumno", "Nombre", "Grupo", 
-               "DNI Alumno", "Motivo", "Acompañante", "Detalle Acompañante", 
+CSV_HEADERS = ["Fecha", "Hora", "ID Alumno", "Nombre", "Grupo",
+               "DNI Alumno", "Motivo", "Acompañante", "Detalle Acompañante",
                "PDF", "Vuelve", "Horas", "TicketID", "HaVuelto"]
 
-# Ensure CSV exists
-if not os.path.exists(CSV_FILE):
-    with open(CSV_FILE, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        writer.writerow(CSV_HEADERS)
+# Column in the exits table for each CSV header (same order)
+EXIT_COLUMNS = ["date", "time", "student_id", "student_name", "group_name",
+                "dni", "motive", "accompanied_by", "accompanied_detail",
+                "pdf", "returns", "hours", "ticket_id", "has_returned"]
+
+# --- SQLITE CONNECTION POOL ---
+# One connection per thread and DB file, reused across requests instead of a
+# connect() per call. Each connection keeps its own cache of prepared statements.
+# Keyed by pid too, so a forked gunicorn worker opens its own connections; SQLite
+# handles must not cross fork(), so the preload master closes the ones it opened
+# at import before the workers are forked (warm_up).
+DB_CACHED_STATEMENTS = 256
+_db_local = threading.local()
+
+def get_db(path):
+    conns = getattr(_db_local, 'conns', None)
+    if conns is None or _db_local.pid != os.getpid():
+        conns = _db_local.conns = {}
+        _db_local.pid = os.getpid()
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10, cached_statements=DB_CACHED_STATEMENTS)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, avoids an fsync per commit
+        conns[path] = conn
+    return conn
+
+def close_db_connections():
+    """Closes this thread's pooled connections; the next get_db() reopens them."""
+    for conn in (getattr(_db_local, 'conns', None) or {}).values():
+        conn.close()
+    _db_local.conns = None
 
 # --- DB FOR PERSISTENT SESSIONS & TOKENS ---
+# Sessions are stored server side in the sessions table; the cookie only carries
+# a signed random id, so both gunicorn workers see the same session. Anonymous
+# sessions (nothing but the CSRF secret, e.g. the login page or bots) are kept in
+# the signed cookie instead, so they never add rows.
+SESSION_SWEEP_INTERVAL_SECONDS = 15 * 60
+COOKIE_SESSION_KEYS = {'csrf_token'}
+COOKIE_SESSION_PREFIX = "~"
+
+def get_session_db():
+    return get_db(DB_FILE)
+
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_session_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        # IMMEDIATE: workers starting together must not both find a column missing and add it
+        conn.execute("BEGIN IMMEDIATE")
         conn.execute('''CREATE TABLE IF NOT EXISTS sessions 
                         (session_id TEXT PRIMARY KEY, user_id TEXT, expires_at DATETIME)''')
+        if 'data' not in [r['name'] for r in conn.execute("PRAGMA table_info(sessions)")]:
+            conn.execute("ALTER TABLE sessions ADD COLUMN data TEXT NOT NULL DEFAULT ''")
         conn.execute('''CREATE TABLE IF NOT EXISTS login_tokens
                         (email TEXT PRIMARY KEY, token TEXT, expires_at DATETIME)''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_login_tokens_expires ON login_tokens (expires_at)")
 init_db()
 
+def db_timestamp(dt):
+    # Same text format the sqlite3 datetime adapter used, so old rows still compare correctly
+    return dt.isoformat(sep=' ')
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, expires_at=None, in_cookie=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = sid is None
+        self.expires_at = expires_at
+        self.modified = False
+        self.rotate = False  # set on login: new id, against session fixation
+        self.in_cookie = in_cookie  # anonymous session read from the cookie itself
+
+class SQLiteSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def get_signer(self, app):
+        return Signer(app.secret_key, salt='server-session')
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self.get_signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            if sid and sid.startswith(COOKIE_SESSION_PREFIX):
+                data = base64.urlsafe_b64decode(sid[len(COOKIE_SESSION_PREFIX):]).decode()
+                return ServerSession(self.serializer.loads(data), in_cookie=True)
+            if sid:
+                row = get_session_db().execute("SELECT data, expires_at FROM sessions WHERE session_id = ? AND expires_at > ?",
+                                               (sid, db_timestamp(datetime.now()))).fetchone()
+                if row:
+                    return ServerSession(self.serializer.loads(row['data']) if row['data'] else None, sid, row['expires_at'])
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                with get_session_db() as conn:
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (session.sid,))
+            if session.modified and (not session.new or session.in_cookie):
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if set(session) <= COOKIE_SESSION_KEYS:
+            if session.in_cookie and not session.modified:
+                return
+            if not session.new:
+                with get_session_db() as conn:
+                    conn.execute("DELETE FROM sessions WHERE session_id = ?", (session.sid,))
+            data = base64.urlsafe_b64encode(self.serializer.dumps(dict(session)).encode()).decode()
+            self.set_cookie(app, session, response, COOKIE_SESSION_PREFIX + data)
+            return
+
+        now = datetime.now()
+        lifetime = app.permanent_session_lifetime
+        # Unchanged sessions are only written again once half their lifetime has passed
+        stale = session.expires_at is not None and session.expires_at < db_timestamp(now + lifetime / 2)
+        if not (session.new or session.modified or session.rotate or stale):
+            return
+        with get_session_db() as conn:
+            if session.rotate and not session.new:
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session.sid,))
+            if session.new or session.rotate:
+                session.sid = secrets.token_urlsafe(32)
+            session.expires_at = db_timestamp(now + lifetime)
+            conn.execute("INSERT OR REPLACE INTO sessions (session_id, user_id, expires_at, data) VALUES (?, ?, ?, ?)",
+                         (session.sid, session.get('user_email', ''), session.expires_at, self.serializer.dumps(dict(session))))
+        self.set_cookie(app, session, response, session.sid)
+
+    def set_cookie(self, app, session, response, value):
+        response.set_cookie(self.get_cookie_name(app), self.get_signer(app).sign(value).decode(),
+                            expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                            domain=self.get_cookie_domain(app), path=self.get_cookie_path(app),
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+app.session_interface = SQLiteSessionInterface()
+
+def sweep_expired_logins():
+    """Deletes expired login tokens and sessions. Returns (tokens, sessions) removed."""
+    now = db_timestamp(datetime.now())
+    with get_session_db() as conn:
+        tokens = conn.execute("DELETE FROM login_tokens WHERE expires_at < ?", (now,)).rowcount
+        sessions = conn.execute("DELETE FROM sessions WHERE expires_at < ?", (now,)).rowcount
+    return tokens, sessions
+
+def session_sweeper():
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL_SECONDS)
+        try:
+            sweep_expired_logins()
+        except Exception as e:
+            log_error(f"Error sweeping expired sessions: {e}")
+
 # Authorized Emails (can be overriden in .env)
 _default_emails = [
     "josemanuel.rodriguez@edumelilla.es",
@@ -132,10 +306,303 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def fold_text(text):
+    """Lowercase and strip accents: 'Peñalver Martínez' -> 'penalver martinez'."""
+    text = unicodedata.normalize('NFKD', str(text or '').lower())
+    return ''.join(c for c in text if not unicodedata.combining(c))
+
+def like_pattern(text):
+    """'%text%' for LIKE ... ESCAPE '\\', with the user's % and _ matched literally."""
+    return "%" + text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
 def safe_text(text):
     if not text: return ""
     return str(text).encode('latin-1', 'replace').decode('latin-1')
 
+# --- METRICS ---
+# Per-worker latency histograms for every route and for named spans (PDF,
+# exit store, timetable lookup, SMTP, secure JSON...), served in Prometheus
+# text format at /metrics. Requests slower than SLOW_REQUEST_MS are logged
+# with their span breakdown. timed_span works as `with` block or decorator.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_HELP = {
+    "partes_request_duration_seconds": "Tiempo de respuesta por ruta",
+    "partes_span_duration_seconds": "Tiempo por etapa instrumentada",
+}
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 1000))
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+_metrics_lock = threading.Lock()
+_histograms = {}  # (metric, labels) -> [count per bucket..., sum, count]
+
+def observe(metric, labels, seconds):
+    key = (metric, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * len(METRICS_BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(METRICS_BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+@contextmanager
+def timed_span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("partes_span_duration_seconds", {"span": name}, elapsed)
+        if has_request_context() and 'spans' in g:
+            g.spans.append((name, elapsed))
+
+def metric_labels(labels):
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ",".join(f'{k}="{escape(v)}"' for k, v in labels)
+
+def render_metrics():
+    with _metrics_lock:
+        snapshot = {key: list(h) for key, h in _histograms.items()}
+    worker = ("worker", str(os.getpid()))
+    lines = []
+    for metric, help_text in METRICS_HELP.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} histogram"]
+        for (name, labels), h in sorted(snapshot.items()):
+            if name != metric:
+                continue
+            base = metric_labels((worker,) + labels)
+            for bound, count in zip(METRICS_BUCKETS, h):
+                lines.append(f'{metric}_bucket{{{base},le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{{base},le="+Inf"}} {h[-1]}')
+            lines.append(f"{metric}_sum{{{base}}} {h[-2]:.6f}")
+            lines.append(f"{metric}_count{{{base}}} {h[-1]}")
+    return "\n".join(lines) + "\n"
+
+# --- EXIT LOG STORE ---
+# Exits live in SQLite (indexed by student, ticket, PDF and date) instead of
+# salidas.csv, which is only used as a one-time import and as export format.
+# The DB runs in WAL mode; deletes only set a tombstone (deleted_at) and a
+# background compaction purges old tombstones.
+EXIT_TOMBSTONE_RETENTION_DAYS = 30
+EXIT_COMPACTION_INTERVAL_SECONDS = 6 * 3600
+LIVE_EXITS = "deleted_at = ''"
+
+def get_exit_db():
+    return get_db(EXITS_DB_FILE)
+
+def exit_search_text(values):
+    """Folded name, group, DNI and student id of an exit (CSV-ordered values), one per line,
+    what the history search matches against."""
+    record = dict(zip(CSV_HEADERS, values))
+    return "\n".join(fold_text(record[h]) for h in ("Nombre", "Grupo", "DNI Alumno", "ID Alumno"))
+
+def fill_exit_search_text(conn):
+    rows = conn.execute(f"SELECT id, {', '.join(EXIT_COLUMNS)} FROM exits WHERE search_text = ''").fetchall()
+    conn.executemany("UPDATE exits SET search_text = ? WHERE id = ?", [(exit_search_text(list(r)[1:]), r[0]) for r in rows])
+
+def exit_row_to_record(row):
+    """Converts a DB row into the CSV-shaped dict the frontend expects."""
+    return {header: row[col] or '' for header, col in zip(CSV_HEADERS, EXIT_COLUMNS)}
+
+def init_exit_store():
+    with get_exit_db() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        # IMMEDIATE: one worker migrates (and builds the counters), the other waits and finds it done
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(f'''CREATE TABLE IF NOT EXISTS exits
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                         {", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in EXIT_COLUMNS)},
+                         deleted_at TEXT NOT NULL DEFAULT '')''')
+        columns = [r['name'] for r in conn.execute("PRAGMA table_info(exits)")]
+        if 'deleted_at' not in columns:
+            conn.execute("ALTER TABLE exits ADD COLUMN deleted_at TEXT NOT NULL DEFAULT ''")
+        if 'returned_at' not in columns:
+            conn.execute("ALTER TABLE exits ADD COLUMN returned_at TEXT NOT NULL DEFAULT ''")
+        if 'batch_id' not in columns:
+            conn.execute("ALTER TABLE exits ADD COLUMN batch_id TEXT NOT NULL DEFAULT ''")
+        if 'search_text' not in columns:
+            conn.execute("ALTER TABLE exits ADD COLUMN search_text TEXT NOT NULL DEFAULT ''")
+            fill_exit_search_text(conn)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_exits_student ON exits (student_id, date)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_exits_ticket ON exits (ticket_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_exits_pdf ON exits (pdf)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_exits_date ON exits (date, time)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_exits_batch ON exits (batch_id) WHERE batch_id != ''")
+        conn.execute("CREATE TABLE IF NOT EXISTS store_meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Precomputed per-student, per-month totals for the student cards
+        conn.execute('''CREATE TABLE IF NOT EXISTS exit_counters
+                        (student_id TEXT, month TEXT, count INTEGER NOT NULL,
+                         PRIMARY KEY (student_id, month))''')
+        # Exits per day, group, motive, session and student for the reports (see REPORTS)
+        conn.execute('''CREATE TABLE IF NOT EXISTS exit_daily
+                        (date TEXT, group_name TEXT, motive TEXT, session TEXT, student_id TEXT,
+                         count INTEGER NOT NULL,
+                         PRIMARY KEY (date, group_name, motive, session, student_id)) WITHOUT ROWID''')
+        if not conn.execute("SELECT 1 FROM store_meta WHERE key = 'counters_built'").fetchone():
+            rebuild_exit_counters(conn)
+            conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('counters_built', ?)",
+                         (datetime.now().isoformat(),))
+    import_csv_history()
+
+def import_csv_history():
+    """One-time import of the legacy salidas.csv. Safe to run from every worker."""
+    if not os.path.exists(CSV_FILE):
+        return
+    conn = get_exit_db()
+    try:
+        # IMMEDIATE takes the write lock, so only one worker performs the import
+        conn.execute("BEGIN IMMEDIATE")
+        if conn.execute("SELECT 1 FROM store_meta WHERE key = 'csv_imported'").fetchone():
+            conn.rollback()
+            return
+        with open(CSV_FILE, 'r', encoding='utf-8') as f:
+            rows = [[r.get(h) or '' for h in CSV_HEADERS] for r in csv.DictReader(f)]
+        conn.executemany(f"INSERT INTO exits ({', '.join(EXIT_COLUMNS)}, search_text) VALUES ({', '.join('?' * (len(EXIT_COLUMNS) + 1))})",
+                         [row + [exit_search_text(row)] for row in rows])
+        rebuild_exit_counters(conn)
+        conn.execute("DELETE FROM store_meta WHERE key = 'daily_built'")  # rebuilt by the first report
+        conn.execute("INSERT INTO store_meta (key, value) VALUES ('csv_imported', ?)", (datetime.now().isoformat(),))
+        conn.commit()
+        log_error(f"Imported {len(rows)} records from {CSV_FILE} into {EXITS_DB_FILE}")
+    except Exception as e:
+        conn.rollback()
+        log_error(f"Error importing CSV history: {e}")
+
+def export_exits_to_csv(path):
+    """Writes the whole exit log to a CSV file with the legacy headers."""
+    conn = get_exit_db()
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_HEADERS)
+        for row in conn.execute(f"SELECT {', '.join(EXIT_COLUMNS)} FROM exits WHERE {LIVE_EXITS} ORDER BY id"):
+            writer.writerow(list(row))
+
+def rebuild_exit_counters(conn):
+    conn.execute("DELETE FROM exit_counters")
+    conn.execute('''INSERT INTO exit_counters (student_id, month, count)
+                    SELECT student_id, substr(date, 1, 7), COUNT(*) FROM exits WHERE deleted_at = ''
+                    GROUP BY student_id, substr(date, 1, 7)''')
+
+def bump_exit_counter(conn, student_id, date, delta):
+    month = (date or '')[:7]
+    conn.execute('''INSERT INTO exit_counters (student_id, month, count) VALUES (?, ?, ?)
+                    ON CONFLICT (student_id, month) DO UPDATE SET count = count + excluded.count''',
+                 (student_id, month, delta))
+    if delta < 0:
+        conn.execute("DELETE FROM exit_counters WHERE student_id = ? AND month = ? AND count <= 0",
+                     (student_id, month))
+
+def bump_exit_daily(conn, date, hhmm, group, motive, student_id, delta):
+    key = (date or '', group or '', motive or '', exit_session(date, hhmm), student_id or '')
+    conn.execute('''INSERT INTO exit_daily (date, group_name, motive, session, student_id, count) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (date, group_name, motive, session, student_id) DO UPDATE SET count = count + excluded.count''',
+                 (*key, delta))
+    if delta < 0:
+        conn.execute('''DELETE FROM exit_daily WHERE date = ? AND group_name = ? AND motive = ? AND session = ?
+                        AND student_id = ? AND count <= 0''', key)
+
+def add_exit_record(record):
+    """Inserts a record (dict keyed by CSV headers). Returns the new row id."""
+    return add_exit_records([record])[0]
+
+def add_exit_records(records, batch_id=''):
+    """Inserts several records in one transaction (batch_id: group exit they belong to). Returns their row ids."""
+    ids = []
+    with get_exit_db() as conn:
+        for record in records:
+            values = [record.get(h, '') or '' for h in CSV_HEADERS]
+            cur = conn.execute(f"INSERT INTO exits ({', '.join(EXIT_COLUMNS)}, batch_id, search_text) VALUES ({', '.join('?' * (len(EXIT_COLUMNS) + 2))})",
+                               values + [batch_id, exit_search_text(values)])
+            bump_exit_counter(conn, record.get('ID Alumno', ''), record.get('Fecha', ''), 1)
+            bump_exit_daily(conn, record.get('Fecha'), record.get('Hora'), record.get('Grupo'),
+                            record.get('Motivo'), record.get('ID Alumno'), 1)
+            ids.append(cur.lastrowid)
+    return ids
+
+def delete_exit_records(pdf_names):
+    """Tombstones the live records whose PDF is in pdf_names. Returns the deleted rows."""
+    with get_exit_db() as conn:
+        rows = conn.execute(f"SELECT id, pdf, ticket_id, student_id, date, time, group_name, motive FROM exits WHERE pdf IN ({', '.join('?' * len(pdf_names))}) AND {LIVE_EXITS}",
+                            list(pdf_names)).fetchall()
+        now = datetime.now().isoformat()
+        for r in rows:
+            conn.execute("UPDATE exits SET deleted_at = ? WHERE id = ?", (now, r['id']))
+            bump_exit_counter(conn, r['student_id'], r['date'], -1)
+            bump_exit_daily(conn, r['date'], r['time'], r['group_name'], r['motive'], r['student_id'], -1)
+    return rows
+
+def mark_exit_returned(ticket_id):
+    """Sets HaVuelto on the live exit with this ticket. Returns (row, changed); row is None if not found."""
+    with get_exit_db() as conn:
+        row = conn.execute(f"SELECT id, student_id, has_returned, returned_at FROM exits WHERE ticket_id = ? AND {LIVE_EXITS} ORDER BY id DESC LIMIT 1",
+                           (ticket_id,)).fetchone()
+        if not row or row['has_returned'] == 'Sí':
+            return row, False
+        returned_at = datetime.now().isoformat(timespec='seconds')
+        conn.execute("UPDATE exits SET has_returned = 'Sí', returned_at = ? WHERE id = ?", (returned_at, row['id']))
+    return {"id": row['id'], "student_id": row['student_id'], "has_returned": 'Sí', "returned_at": returned_at}, True
+
+def compact_exit_store():
+    """Purges tombstones older than the retention window and truncates the WAL."""
+    cutoff = (datetime.now() - timedelta(days=EXIT_TOMBSTONE_RETENTION_DAYS)).isoformat()
+    with get_exit_db() as conn:
+        purged = conn.execute("DELETE FROM exits WHERE deleted_at != '' AND deleted_at < ?", (cutoff,)).rowcount
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return purged
+
+def compaction_worker():
+    while True:
+        time.sleep(EXIT_COMPACTION_INTERVAL_SECONDS)
+        try:
+            purged = compact_exit_store()
+            if purged:
+                log_error(f"Exit store compaction purged {purged} deleted records")
+            purge_events()
+        except Exception as e:
+            log_error(f"Error in exit store compaction: {e}")
+
+def get_exit_counts(student_ids):
+    """Returns {student_id: {"count": total, "monthlyCount": this month}} from the counters."""
+    current_month = datetime.now().strftime("%Y-%m")
+    counts = {sid: {"count": 0, "monthlyCount": 0} for sid in student_ids}
+    if not counts:
+        return counts
+    with get_exit_db() as conn:
+        rows = conn.execute(f'''SELECT student_id, SUM(count), SUM(CASE WHEN month = ? THEN count ELSE 0 END)
+                                FROM exit_counters WHERE student_id IN ({', '.join('?' * len(counts))})
+                                GROUP BY student_id''', (current_month, *counts))
+        for student_id, total, monthly in rows:
+            counts[student_id] = {"count": total, "monthlyCount": monthly}
+    return counts
+
+init_exit_store()
+
+def load_secure_record(path, key):
+    """One record by id. Chunked files seek through the index instead of decrypting everything."""
+    if not os.path.exists(path):
+        return None
+    try:
+        if secure_json.is_chunked(path):
+            return secure_json.read_record(path, key, chunked_aead)
+        return next((r for r in load_secure_json(path) if str(r.get('id')) == str(key)), None)
+    except Exception as e:
+        log_error(f"Error decrypting secure record at {path}: {e}")
+        return None
+
+def append_secure_json(path, records):
+    """Adds or replaces (by id) records. Chunked files only re-encrypt the new records."""
+    try:
+        if os.path.exists(path) and secure_json.is_chunked(path):
+            secure_json.append_records(path, records, chunked_aead)
+            return True
+        by_id = {secure_json.record_key(r, i): r for i, r in enumerate(load_secure_json(path) + records)}
+        return save_secure_json(path, list(by_id.values()))
+    except Exception as e:
+        log_error(f"Error encrypting secure data at {path}: {e}")
+        return False
+
 # --- BUSINESS LOGIC ---
 def load_timetable():
     if os.path.exists(TIMETABLE_PATH):
@@ -144,10 +611,13 @@ def load_timetable():
                 return json.load(f)
         except Exception as e:
             log_error(f"Error loading timetable: {e}")
+@timed_span("secure_json_load")
 def load_secure_json(path):
     if not os.path.exists(path):
         return []
     try:
+        if secure_json.is_chunked(path):
+            return secure_json.read_all(path, chunked_aead)
         with open(path, 'rb') as f:
             encrypted_content = f.read()
         
@@ -167,12 +637,24 @@ def load_secure_json(path):
         log_error(f"Error decrypting secure data at {path}: {e}")
         return []
 
+@timed_span("secure_json_save")
+def secure_json_format(path):
+    if SECURE_JSON_FORMAT:
+        return SECURE_JSON_FORMAT
+    return 'chunked' if secure_json.is_chunked(path) else 'fernet'
+
 def save_secure_json(path, data):
     try:
+        if secure_json_format(path) == 'chunked' and isinstance(data, list):
+            secure_json.write_records(path, data, chunked_aead)
+            return True
         json_data = json.dumps(data, indent=4)
         encrypted_data = cipher_suite.encrypt(json_data.encode('utf-8'))
-        with open(path, 'wb') as f:
+        # Write to a temp file and rename, so readers in other workers never see a partial file
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, 'wb') as f:
             f.write(encrypted_data)
+        os.replace(tmp_path, path)
         return True
     except Exception as e:
         log_error(f"Error encrypting secure data at {path}: {e}")
@@ -182,9 +664,369 @@ def save_secure_json(path, data):
 def load_timetable():
     return load_secure_json(TIMETABLE_PATH)
 
-TIMETABLE = load_timetable()
+def file_stamp(path):
+    """(mtime, size) of a file, or None if it does not exist. Used to detect changes on disk."""
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+# --- SHARED DATA SNAPSHOTS ---
+# By default each worker keeps the decrypted roster and the timetable index as
+# plain dicts (see STUDENT ROSTER CACHE and TIMETABLE INDEX). With SHARED_DATA=1
+# they are kept instead as compact read-only snapshots (shared_snapshot.py):
+# interned strings and integer columns, read through __slots__ records,
+# published to a private directory on tmpfs and mmapped by every worker, so
+# adding workers does not add copies. The first worker that sees a new
+# students.json/timetable builds the snapshot and swaps it in with a rename.
+# That puts decrypted student data in a file, so it is opt-in and the files are
+# removed when the server shuts down: by the gunicorn master (gunicorn.conf.py),
+# or by this process when it runs on its own. A worker that is recycled or dies
+# leaves them for the others.
+SNAPSHOT_VERSION = 1
+SHARED_DATA = os.environ.get('SHARED_DATA', '0') == '1'
+SHARED_DATA_DIR = shared_snapshot.snapshot_directory(DATA_DIR)
+
+def init_shared_data_dir():
+    """The snapshot directory, or '' if it cannot be used safely (it holds decrypted data)."""
+    if not SHARED_DATA or not SHARED_DATA_DIR:
+        return ''
+    try:
+        os.makedirs(SHARED_DATA_DIR, mode=0o700, exist_ok=True)
+        st = os.stat(SHARED_DATA_DIR)
+        if st.st_uid != os.getuid() or st.st_mode & 0o077:
+            log_error(f"Shared data dir {SHARED_DATA_DIR} is not private to this user, snapshots stay per worker")
+            return ''
+        return SHARED_DATA_DIR
+    except OSError as e:
+        log_error(f"Cannot use shared data dir {SHARED_DATA_DIR}: {e}")
+        return ''
+
+SHARED_DATA_DIR = init_shared_data_dir()
+
+def snapshot_source(stamp):
+    return [SNAPSHOT_VERSION] + list(stamp or [])
+
+def load_shared_snapshot(name, stamp, build):
+    """Snapshot of a data file at `stamp`: the one already published by another
+    worker if it matches, otherwise build() (-> snapshot bytes) and publish it."""
+    snap = shared_snapshot.open_snapshot(os.path.join(SHARED_DATA_DIR, f"{name}.snap"))
+    if snap and snap.meta.get("source") == snapshot_source(stamp):
+        return snap
+    return publish_snapshot(name, build())
+
+def publish_snapshot(name, data):
+    path = os.path.join(SHARED_DATA_DIR, f"{name}.snap")
+    try:
+        shared_snapshot.write_snapshot(path, data)
+        snap = shared_snapshot.open_snapshot(path)
+        if snap:
+            return snap
+    except OSError as e:
+        log_error(f"Error publishing snapshot {path}: {e}")
+    return shared_snapshot.Snapshot(data)
+
+class SnapshotRecord(Mapping):
+    """Read-only dict-like view of one snapshot row. Subclasses list the string
+    FIELDS stored as columns; anything else lives in a per-row JSON "extra" string."""
+    __slots__ = ("_snap", "_row")
+    FIELDS = ()
+    PREFIX = ""
+
+    def __init__(self, snap, row):
+        self._snap, self._row = snap, row
+
+    def _present(self, i):
+        return self._snap.column(f"{self.PREFIX}flags")[self._row] & (1 << i)
+
+    def _extra(self):
+        sid = self._snap.column(f"{self.PREFIX}extra")[self._row]
+        return json.loads(self._snap.string(sid)) if sid else {}
+
+    def _field(self, i, key):
+        return self._snap.string(self._snap.column(f"{self.PREFIX}{key}")[self._row])
+
+    def __getitem__(self, key):
+        if key in self.FIELDS:
+            i = self.FIELDS.index(key)
+            if self._present(i):
+                return self._field(i, key)
+        return self._extra()[key]
+
+    def __iter__(self):
+        for i, key in enumerate(self.FIELDS):
+            if self._present(i):
+                yield key
+        yield from self._extra()
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    @classmethod
+    def columns(cls, records, pool):
+        """Column data for a list of dicts: {name: (typecode, ints)}."""
+        columns = {f"{cls.PREFIX}{key}": [] for key in cls.FIELDS}
+        flags, extras = [], []
+        for record in records:
+            mask, extra = 0, {}
+            for key, value in (record.items() if isinstance(record, dict) else ()):
+                if key in cls.FIELDS and cls.stores(key, value):
+                    mask |= 1 << cls.FIELDS.index(key)
+                else:
+                    extra[key] = value
+            for key in cls.FIELDS:
+                value = record.get(key) if mask & (1 << cls.FIELDS.index(key)) else None
+                columns[f"{cls.PREFIX}{key}"].append(pool.add(cls.column_text(key, value)))
+            flags.append(mask)
+            extras.append(pool.add(json.dumps(extra, ensure_ascii=False, separators=(',', ':'))) if extra else 0)
+        columns = {name: ('I', values) for name, values in columns.items()}
+        columns[f"{cls.PREFIX}flags"] = ('B', flags)
+        columns[f"{cls.PREFIX}extra"] = ('I', extras)
+        return columns
+
+    @classmethod
+    def stores(cls, key, value):
+        return isinstance(value, str)
+
+    @classmethod
+    def column_text(cls, key, value):
+        return value
+
+class Student(SnapshotRecord):
+    __slots__ = ()
+    FIELDS = ("id", "name", "group", "dni", "tutor1")
+
+    def _field(self, i, key):
+        text = super()._field(i, key)
+        return {"name": text} if key == "tutor1" else text
+
+    @classmethod
+    def stores(cls, key, value):
+        if key == "tutor1":
+            return isinstance(value, dict) and list(value) == ["name"] and isinstance(value["name"], str)
+        return isinstance(value, str)
+
+    @classmethod
+    def column_text(cls, key, value):
+        return value["name"] if key == "tutor1" and value else value
+
+class Teacher(SnapshotRecord):
+    # Only what the notifications use; the full horario is indexed, not copied
+    __slots__ = ()
+    FIELDS = ("nombre", "email")
+    PREFIX = "teacher."
+
+class RosterView(Sequence):
+    """The roster as a read-only sequence of Student records."""
+    __slots__ = ("_snap",)
+
+    def __init__(self, snap):
+        self._snap = snap
+
+    def __len__(self):
+        return self._snap.meta["count"]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Student(self._snap, i)
+
+    def get(self, student_id):
+        pos = self._snap.find_sorted(self._snap.column("id_sorted"), str(student_id))
+        return Student(self._snap, self._snap.column("id_rows")[pos]) if pos >= 0 else None
+
+def roster_body(students):
+    """The roster's JSON body and its content hash, so every worker hands out the same ETag for the same roster."""
+    body = json.dumps(students, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return body, hashlib.sha256(body).hexdigest()[:32]
+
+def build_roster_snapshot(students, stamp):
+    students = students or []
+    body, etag = roster_body(students)
+    pool = shared_snapshot.StringPool()
+    columns = Student.columns(students, pool)
+    by_id = sorted((s['id'], row) for row, s in enumerate(students) if isinstance(s, dict) and isinstance(s.get('id'), str))
+    columns["id_sorted"] = ('I', [pool.add(i) for i, _ in by_id])
+    columns["id_rows"] = ('I', [row for _, row in by_id])
+    meta = {"source": snapshot_source(stamp), "count": len(students), "etag": etag}
+    return shared_snapshot.build_snapshot(meta, pool, columns, {"body": body})
+
+# --- STUDENT ROSTER CACHE ---
+# The decrypted students.json (with its pre-serialised JSON body and an id
+# lookup), swapped when the file changes on disk (mtime/size) or after an upload
+# in this worker. Plain dicts per worker, or Student records over the shared
+# snapshot with SHARED_DATA=1.
+STUDENTS_FILE = os.path.join(DATA_DIR, "students.json")
 
-SESSIONS_TIMES = [
+_students_lock = threading.Lock()
+_students_cache = {"stamp": None, "generation": -1, "data": None, "by_id": None, "body": None, "etag": None}
+_students_generation = 0
+
+def roster_cache_entry(stamp, generation, students=None):
+    """Cache entry for students.json at `stamp`. students: the roster just written by this worker (else read it)."""
+    if SHARED_DATA_DIR:
+        if students is None:
+            snap = load_shared_snapshot("roster", stamp, lambda: build_roster_snapshot(load_secure_json(STUDENTS_FILE), stamp))
+        else:
+            snap = publish_snapshot("roster", build_roster_snapshot(students, stamp))
+        roster = RosterView(snap)
+        return {"stamp": stamp, "generation": generation, "data": roster, "by_id": roster,
+                "body": snap.blob("body"), "etag": snap.meta["etag"]}
+    if students is None:
+        students = load_secure_json(STUDENTS_FILE)
+    body, etag = roster_body(students)
+    by_id = {s['id']: s for s in students if isinstance(s, dict) and isinstance(s.get('id'), str)}
+    return {"stamp": stamp, "generation": generation, "data": students, "by_id": by_id, "body": body, "etag": etag}
+
+def publish_students(students):
+    """After this worker rewrote students.json: swap in the new roster (and publish its
+    snapshot, with SHARED_DATA, so the other workers skip decrypting it)."""
+    global _students_cache, _students_generation
+    with _students_lock:
+        _students_generation += 1
+        _students_cache = roster_cache_entry(file_stamp(STUDENTS_FILE), _students_generation, students)
+
+def get_students_cache():
+    """Returns the cache entry: roster (sequence of student mappings), id lookup, JSON body and its ETag."""
+    global _students_cache
+    stamp = file_stamp(STUDENTS_FILE)
+    cache = _students_cache
+    if cache["body"] is not None and cache["stamp"] == stamp and cache["generation"] == _students_generation:
+        return cache
+    with _students_lock:
+        cache = _students_cache
+        generation = _students_generation
+        if cache["body"] is None or cache["stamp"] != stamp or cache["generation"] != generation:
+            cache = roster_cache_entry(stamp, generation)
+            _students_cache = cache
+    return cache
+
+def load_students():
+    return get_students_cache()["data"]
+
+def load_student(student_id):
+    """Single student: from the warm cache if it is current, otherwise straight from disk."""
+    cache = _students_cache
+    if cache["data"] is not None and cache["stamp"] == file_stamp(STUDENTS_FILE) and cache["generation"] == _students_generation:
+        student = cache["by_id"].get(student_id)
+        return dict(student) if student else None
+    return load_secure_record(STUDENTS_FILE, student_id)
+
+# --- STUDENT SEARCH INDEX ---
+# In-memory index over the cached roster: accent-folded tokens, 1-3 character
+# n-grams for partial matches, exact id/DNI maps and group facets.
+# Rebuilt whenever the roster cache's ETag changes.
+SEARCH_NGRAM = 3
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 100
+
+_search_lock = threading.Lock()
+_search_index = {"etag": None}
+
+def build_search_index(students):
+    ngrams, by_id, by_dni, by_group = {}, {}, {}, {}
+    texts, name_tokens, group_tokens = [], [], []
+    for i, student in enumerate(students):
+        name = fold_text(student.get('name'))
+        group = fold_text(student.get('group'))
+        dni = fold_text(student.get('dni'))
+        text = f"{name} {group} {dni}"
+        texts.append(text)
+        name_tokens.append(name.split())
+        group_tokens.append(group.split())
+        for token in set(text.split()):
+            for n in range(1, SEARCH_NGRAM + 1):
+                for j in range(len(token) - n + 1):
+                    ngrams.setdefault(token[j:j + n], set()).add(i)
+        if student.get('id'): by_id.setdefault(str(student['id']).strip().lower(), []).append(i)
+        if dni: by_dni.setdefault(dni, []).append(i)
+        by_group.setdefault(student.get('group') or '', []).append(i)
+    return {"students": students, "texts": texts, "name_tokens": name_tokens,
+            "group_tokens": group_tokens, "ngrams": ngrams, "by_id": by_id,
+            "by_dni": by_dni, "by_group": by_group}
+
+def get_search_index():
+    global _search_index
+    cache = get_students_cache()
+    index = _search_index
+    if index["etag"] != cache["etag"]:
+        with _search_lock:
+            index = _search_index
+            if index["etag"] != cache["etag"]:
+                index = build_search_index(cache["data"] or [])
+                index["etag"] = cache["etag"]
+                _search_index = index
+    return index
+
+def term_candidates(index, term):
+    """Students whose text contains term. n-grams give the exact set for short terms
+    and a superset (intersection of trigrams) for longer ones, checked against the text."""
+    if len(term) <= SEARCH_NGRAM:
+        return index["ngrams"].get(term, set())
+    grams = [term[j:j + SEARCH_NGRAM] for j in range(len(term) - SEARCH_NGRAM + 1)]
+    sets = sorted((index["ngrams"].get(g, set()) for g in grams), key=len)
+    candidates = set(sets[0]).intersection(*sets[1:])
+    texts = index["texts"]
+    return {i for i in candidates if term in texts[i]}
+
+def score_student(index, i, terms, raw_query):
+    score = 0
+    if i in index["by_id"].get(raw_query, ()) or i in index["by_dni"].get(raw_query, ()):
+        score += 100
+    for term in terms:
+        if term in index["name_tokens"][i]: score += 5
+        elif any(t.startswith(term) for t in index["name_tokens"][i]): score += 3
+        elif term in index["group_tokens"][i]: score += 2
+        else: score += 1
+    return score
+
+def search_students(query, group=None, page=1, page_size=SEARCH_PAGE_SIZE):
+    index = get_search_index()
+    students = index["students"]
+    terms = fold_text(query).split()
+
+    if terms:
+        # Every term must appear somewhere in name/group/DNI (same rule as the old client filter)
+        matches = None
+        for term in sorted(terms, key=len, reverse=True):
+            found = term_candidates(index, term)
+            matches = set(found) if matches is None else matches & found
+            if not matches: break
+        raw_query = ' '.join(terms)
+        ranked = sorted(matches, key=lambda i: (-score_student(index, i, terms, raw_query), index["texts"][i]))
+        facets = {}
+        for i in ranked:
+            g = students[i].get('group') or ''
+            facets[g] = facets.get(g, 0) + 1
+        if group:
+            ranked = [i for i in ranked if (students[i].get('group') or '') == group]
+    else:
+        facets = {g: len(ids) for g, ids in index["by_group"].items()}
+        ranked = index["by_group"].get(group, []) if group else range(len(students))
+
+    start = (page - 1) * page_size
+    return {"total": len(ranked), "page": page, "pageSize": page_size,
+            "results": [dict(students[i]) for i in ranked[start:start + page_size]],
+            "facets": facets}
+
+# --- SESSION SCHEDULE ---
+# Bell schedule compiled into a minute-of-day table per distinct day layout, so
+# "current session" and "remaining sessions" are list lookups. The default day
+# can be overridden per weekday and per term, and holidays have no sessions,
+# through the optional data/schedule.json (plain JSON, reloaded on change):
+#   {"sessions": [["07:35", "08:30", "Sesión 1"], ...],
+#    "weekdays": {"Viernes": [...]},
+#    "terms": [{"from": "2026-06-01", "to": "2026-06-23", "sessions": [...], "weekdays": {...}}],
+#    "holidays": ["2026-12-08", {"from": "2026-12-22", "to": "2027-01-07"}]}
+# Session names follow the timetable ("Sesión N", "Recreo N") and are labelled
+# "Nª" in the UI.
+SCHEDULE_PATH = os.path.join(DATA_DIR, "schedule.json")
+DEFAULT_SESSIONS = [
     ("07:35", "08:30", "Sesión 1"), ("08:30", "09:25", "Sesión 2"),
     ("09:25", "10:20", "Sesión 3"), ("10:20", "11:15", "Sesión 4"),
     ("11:15", "11:45", "Recreo 1"), ("11:45", "12:40", "Sesión 5"),
@@ -194,60 +1036,1479 @@ SESSIONS_TIMES = [
     ("18:45", "19:00", "Recreo 2"), ("19:00", "19:55", "Sesión 12"),
     ("19:55", "20:50", "Sesión 13"), ("20:50", "21:45", "Sesión 14"),
 ]
+WEEKDAYS_ES = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes"]
+MINUTES_PER_DAY = 24 * 60
+
+_schedule_lock = threading.Lock()
+_schedule = {"stamp": None, "config": None, "layouts": {}, "days": {}}
+
+def session_label(session_name):
+    # "Sesión 3" -> "3ª", "Recreo 1" -> "Recreo 1"
+    if session_name.startswith("Sesión"):
+        return f"{session_name.split()[-1]}ª"
+    return session_name
+
+def minute_of_day(hhmm):
+    return int(hhmm[:2]) * 60 + int(hhmm[3:5])
+
+def compile_day(sessions):
+    """[(start, end, name), ...] -> sessions, minute -> session index, minute -> next session index, labels."""
+    sessions = sorted((tuple(s) for s in sessions), key=lambda s: s[0])
+    current, following = [-1] * MINUTES_PER_DAY, [0] * MINUTES_PER_DAY
+    for i, (start, end, _) in enumerate(sessions):
+        for m in range(minute_of_day(start), minute_of_day(end)):
+            current[m] = i
+    # following[m]: first session starting after minute m
+    i = len(sessions)
+    for m in range(MINUTES_PER_DAY - 1, -1, -1):
+        while i > 0 and minute_of_day(sessions[i - 1][0]) > m:
+            i -= 1
+        following[m] = i
+    return {"sessions": sessions, "current": current, "following": following,
+            "labels": {session_label(name): name for _, _, name in sessions if name.startswith("Sesión")}}
+
+def in_ranges(iso_date, entries):
+    for entry in entries or []:
+        if isinstance(entry, str) and entry == iso_date:
+            return True
+        if isinstance(entry, dict) and entry.get('from', '') <= iso_date <= entry.get('to', '9999-12-31'):
+            return True
+    return False
+
+def refresh_schedule():
+    global _schedule
+    stamp = file_stamp(SCHEDULE_PATH)
+    if _schedule["config"] is not None and _schedule["stamp"] == stamp:
+        return _schedule
+    with _schedule_lock:
+        if _schedule["config"] is None or _schedule["stamp"] != stamp:
+            config = {}
+            if stamp:
+                try:
+                    with open(SCHEDULE_PATH, 'r', encoding='utf-8') as f:
+                        config = json.load(f)
+                except Exception as e:
+                    log_error(f"Error loading schedule {SCHEDULE_PATH}, using the default one: {e}")
+            _schedule = {"stamp": stamp, "config": config, "layouts": {}, "days": {}}
+    return _schedule
+
+def compiled_layout(state, sessions):
+    # Days sharing the same bell times share one compiled table
+    key = json.dumps(sessions)
+    layout = state["layouts"].get(key)
+    if layout is None:
+        layout = state["layouts"][key] = compile_day(sessions)
+    return layout
+
+def default_day():
+    state = refresh_schedule()
+    return compiled_layout(state, state["config"].get("sessions") or DEFAULT_SESSIONS)
+
+def schedule_for(day):
+    """Compiled sessions for a date, or None on weekends and holidays."""
+    state = refresh_schedule()
+    if day in state["days"]:
+        return state["days"][day]
+    config, iso = state["config"], day.isoformat()
+    term = next((t for t in config.get("terms", []) if t.get('from', '') <= iso <= t.get('to', '9999-12-31')), {})
+    if day.weekday() >= len(WEEKDAYS_ES) or in_ranges(iso, config.get("holidays")) or in_ranges(iso, term.get("holidays")):
+        compiled = None
+    else:
+        weekday = WEEKDAYS_ES[day.weekday()]
+        sessions = (term.get("weekdays", {}).get(weekday) or term.get("sessions")
+                    or config.get("weekdays", {}).get(weekday) or config.get("sessions") or DEFAULT_SESSIONS)
+        compiled = compiled_layout(state, sessions)
+    state["days"][day] = compiled
+    return compiled
+
+def school_weekday(day):
+    """'Lunes'..'Viernes' if there are classes that day, else None (weekend or holiday)."""
+    return WEEKDAYS_ES[day.weekday()] if schedule_for(day) else None
+
+def current_session(now=None):
+    """(session name, index in the day's sessions) or (None, -1) outside sessions."""
+    now = now or datetime.now()
+    day = schedule_for(now.date())
+    if not day:
+        return None, -1
+    i = day["current"][now.hour * 60 + now.minute]
+    return (day["sessions"][i][2], i) if i >= 0 else (None, -1)
+
+def remaining_sessions(now=None):
+    """Class sessions (no breaks) still to start today."""
+    now = now or datetime.now()
+    day = schedule_for(now.date())
+    if not day:
+        return []
+    return [name for _, _, name in day["sessions"][day["following"][now.hour * 60 + now.minute]:] if name.startswith("Sesión")]
+
+def next_session_change(now=None):
+    """When the current session ends or the next one starts, or None if nothing else happens today."""
+    now = now or datetime.now()
+    day = schedule_for(now.date())
+    if not day:
+        return None
+    minute = now.hour * 60 + now.minute
+    i = day["current"][minute]
+    if i >= 0:
+        hhmm = day["sessions"][i][1]
+    elif day["following"][minute] < len(day["sessions"]):
+        hhmm = day["sessions"][day["following"][minute]][0]
+    else:
+        return None
+    return datetime.combine(now.date(), datetime.strptime(hhmm, "%H:%M").time())
+
+def sessions_for_hours(horas, day=None):
+    """UI hours "1ª, 3ª" -> ["Sesión 1", "Sesión 3"] (any of 1ª..14ª present in that day's schedule)."""
+    compiled = schedule_for(day or datetime.now().date()) or default_day()
+    return [compiled["labels"][h.strip()] for h in (horas or '').split(',') if h.strip() in compiled["labels"]]
+
+# --- REPORTS ---
+# Term/year/month reports answered from exit_daily (exits per date, group,
+# motive, session and student), kept up to date by add_exit_records and
+# delete_exit_records, so a report reads a few hundred aggregate rows instead
+# of the whole log. The session of each exit depends on the bell schedule:
+# the table is rebuilt from the log when schedule.json changes.
+# Terms default to the usual evaluations and can be set in schedule.json, with
+# MM-DD dates (every school year) or full dates (only the school year they fall in):
+#   "reportTerms": [{"name": "1ª evaluación", "from": "09-10", "to": "12-22"}, ...]
+REPORT_TOP_STUDENTS = 20
+REPORT_MAX_TOP = 200
+REPORT_MAX_DAYS = 400
+DEFAULT_REPORT_TERMS = [("1ª evaluación", "09-01", "12-31"), ("2ª evaluación", "01-01", "03-31"),
+                        ("3ª evaluación", "04-01", "08-31")]
+NO_SESSION_LABEL = "Fuera de horario"
+DAY_LABELS = ['Dom', 'Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb']  # index = strftime('%w')
+
+def exit_layout(iso_date):
+    """Compiled sessions an exit on that date is matched against (the default day on holidays)."""
+    try:
+        return schedule_for(datetime.fromisoformat(iso_date).date()) or default_day()
+    except (TypeError, ValueError):
+        return None
+
+def exit_session(iso_date, hhmm, layout=None):
+    """Session name ("Sesión 3", "Recreo 1") an exit falls in, '' outside sessions or if unparseable."""
+    layout = layout or exit_layout(iso_date)
+    try:
+        i = layout["current"][minute_of_day(hhmm)]
+    except (TypeError, ValueError, IndexError):
+        return ''
+    return layout["sessions"][i][2] if i >= 0 else ''
+
+def ensure_exit_daily():
+    """Rebuilds exit_daily if it was never built or was built with another bell schedule."""
+    schedule_stamp = json.dumps(refresh_schedule()["stamp"])
+    conn = get_exit_db()
+    built = conn.execute("SELECT value FROM store_meta WHERE key = 'daily_built'").fetchone()
+    if built and built[0] == schedule_stamp:
+        return
+    try:
+        # IMMEDIATE takes the write lock: one worker rebuilds, the others find it done
+        conn.execute("BEGIN IMMEDIATE")
+        built = conn.execute("SELECT value FROM store_meta WHERE key = 'daily_built'").fetchone()
+        if built and built[0] == schedule_stamp:
+            conn.rollback()
+            return
+        daily, layouts = {}, {}
+        for row in conn.execute(f'''SELECT date, substr(time, 1, 5), group_name, motive, student_id, COUNT(*)
+                                    FROM exits WHERE {LIVE_EXITS} GROUP BY 1, 2, 3, 4, 5'''):
+            date, hhmm, group, motive, student_id, count = row
+            if date not in layouts:
+                layouts[date] = exit_layout(date)
+            key = (date, group, motive, exit_session(date, hhmm, layouts[date]), student_id)
+            daily[key] = daily.get(key, 0) + count
+        conn.execute("DELETE FROM exit_daily")
+        conn.executemany("INSERT INTO exit_daily (date, group_name, motive, session, student_id, count) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(*key, count) for key, count in daily.items()])
+        conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('daily_built', ?)", (schedule_stamp,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def school_year_date(school_year, month_day):
+    """'MM-DD' -> ISO date within the school year starting in September of school_year."""
+    return f"{school_year + (month_day < '09'):04d}-{month_day}"
+
+def report_terms(school_year):
+    """[(name, from, to)] for the school year starting in September of school_year."""
+    first, last = f"{school_year}-09-01", f"{school_year + 1}-08-31"
+    terms = []
+    for t in refresh_schedule()["config"].get("reportTerms") or []:
+        start, end = t.get('from', ''), t.get('to', '')
+        if len(start) == 5 and len(end) == 5:
+            terms.append((t.get('name', ''), school_year_date(school_year, start), school_year_date(school_year, end)))
+        elif first <= start <= last:
+            terms.append((t.get('name', ''), start, end))
+    return terms or [(name, school_year_date(school_year, start), school_year_date(school_year, end))
+                     for name, start, end in DEFAULT_REPORT_TERMS]
+
+def report_period(period, day, school_year=None, term=None):
+    """(label, first date, last date) of the month, term or school year containing day.
+    school_year (starting year) picks another school year; term (1-based) a term in it."""
+    if period == 'month':
+        following = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return day.strftime("%Y-%m"), day.replace(day=1).isoformat(), (following - timedelta(days=1)).isoformat()
+    if school_year is None:
+        school_year = day.year if day.month >= 9 else day.year - 1
+    if period == 'year':
+        return f"Curso {school_year}-{school_year + 1}", f"{school_year}-09-01", f"{school_year + 1}-08-31"
+    terms = report_terms(school_year)
+    if term is not None:
+        return terms[term - 1] if 1 <= term <= len(terms) else None
+    iso = day.isoformat()
+    for name, start, end in terms:
+        if start <= iso <= end:
+            return name, start, end
+    return None
+
+def group_sizes():
+    """{group: students in the roster}, recomputed when the roster changes."""
+    global _group_sizes
+    cache = get_students_cache()
+    if _group_sizes[0] != cache["etag"]:
+        sizes = {}
+        for student in cache["data"]:
+            group = student.get("group")
+            if group:
+                sizes[group] = sizes.get(group, 0) + 1
+        _group_sizes = (cache["etag"], sizes)
+    return _group_sizes[1]
+
+_group_sizes = (None, {})
+
+def session_labels(names):
+    """Session names in bell order (default day first, then any other layout's), as UI labels."""
+    order = [name for _, _, name in default_day()["sessions"]]
+    ordered = [n for n in order if n in names] + sorted(n for n in names if n and n not in order)
+    if '' in names:
+        ordered.append('')
+    return ordered, [session_label(n) if n else NO_SESSION_LABEL for n in ordered]
+
+def build_report(start, end, group=None, motive=None, top=REPORT_TOP_STUDENTS):
+    """Totals, top recurring students, per-group rates, motives and a weekday x session heatmap."""
+    ensure_exit_daily()
+    clauses, params = ["date >= ?", "date <= ?"], [start, end]
+    if group:
+        clauses.append("group_name = ?"); params.append(group)
+    if motive:
+        clauses.append("motive = ?"); params.append(motive)
+    where = " AND ".join(clauses)
+
+    conn = get_exit_db()
+    days = conn.execute(f"SELECT date, SUM(count) FROM exit_daily WHERE {where} GROUP BY date ORDER BY date", params).fetchall()
+    top_rows = conn.execute(f'''SELECT student_id, SUM(count) AS c FROM exit_daily
+                                WHERE {where} GROUP BY student_id ORDER BY c DESC, student_id LIMIT ?''',
+                            (*params, top)).fetchall()
+    group_rows = conn.execute(f'''SELECT group_name, SUM(count), COUNT(DISTINCT student_id) FROM exit_daily
+                                  WHERE {where} GROUP BY group_name''', params).fetchall()
+    motive_rows = conn.execute(f"SELECT motive, SUM(count) FROM exit_daily WHERE {where} GROUP BY motive ORDER BY 2 DESC", params).fetchall()
+    cells = conn.execute(f"SELECT date, session, SUM(count) FROM exit_daily WHERE {where} GROUP BY 1, 2", params).fetchall()
+    # Name and group as in each student's latest exit (the student may no longer be in the roster)
+    latest = {}
+    if top_rows:
+        ids = [r[0] for r in top_rows]
+        for student_id, name, group_name in conn.execute(f'''SELECT student_id, student_name, group_name FROM exits WHERE id IN
+                                                             (SELECT MAX(id) FROM exits WHERE student_id IN ({', '.join('?' * len(ids))})
+                                                              AND {LIVE_EXITS} GROUP BY student_id)''', ids):
+            latest[student_id] = (name, group_name)
+
+    sizes = group_sizes()
+    groups = []
+    for group_name, exits, students_out in group_rows:
+        size = sizes.get(group_name, 0)
+        groups.append({"group": group_name, "exits": exits, "studentsWithExits": students_out, "students": size,
+                       "exitsPerStudent": round(exits / size, 2) if size else None,
+                       "studentsWithExitsPct": round(100 * students_out / size, 1) if size else None})
+    groups.sort(key=lambda g: (-(g["exitsPerStudent"] or 0), -g["exits"], g["group"]))
+
+    sessions, labels = session_labels({name for _, name, _ in cells})
+    column = {name: i for i, name in enumerate(sessions)}
+    heatmap = {label: [0] * len(sessions) for label in DAY_LABELS[1:6]}
+    weekdays = {}
+    for date, session_name, count in cells:
+        if date not in weekdays:
+            try:
+                weekdays[date] = DAY_LABELS[(datetime.fromisoformat(date).weekday() + 1) % 7]
+            except ValueError:
+                weekdays[date] = None
+        if weekdays[date] in heatmap:
+            heatmap[weekdays[date]][column[session_name]] += count
+
+    return {
+        "from": start, "to": end, "total": sum(c for _, c in days), "daysWithExits": len(days),
+        "days": [{"date": d, "count": c} for d, c in days],
+        "students": [{"studentId": sid, "name": latest.get(sid, ('', ''))[0], "group": latest.get(sid, ('', ''))[1],
+                      "count": c} for sid, c in top_rows],
+        "groups": groups,
+        "motives": [{"motive": m, "count": c} for m, c in motive_rows],
+        "heatmap": {"sessions": labels, "rows": [{"day": day, "counts": counts} for day, counts in heatmap.items()]},
+    }
 
-# Mapping from UI names (1ª, 2ª...) to Timetable names (Sesión 1, Sesión 2...)
-SESSION_MAPPING = {
-    "1ª": "Sesión 1", "2ª": "Sesión 2", "3ª": "Sesión 3", "4ª": "Sesión 4",
-    "5ª": "Sesión 5", "6ª": "Sesión 6", "7ª": "Sesión 7", "8ª": "Sesión 8"
+# --- ROSTER IMPORT (Séneca export) ---
+# Column-wise pipeline: read (pandas, or openpyxl streaming for big files),
+# transform/validate whole columns at once, then diff against the current roster.
+ROSTER_HEADER_ROW = 4  # 0-based: headers are on the 5th row of the Séneca export
+ROSTER_COLUMNS = {
+    "id": "Nº Id. Escolar", "name": "Alumno/a", "group": "Unidad", "dni": "DNI/Pasaporte",
+    "tutor_name": "Nombre Primer tutor", "tutor_surname": "Primer apellido Primer tutor",
 }
+ROSTER_REQUIRED_COLUMNS = ["Alumno/a", "Nº Id. Escolar", "Unidad"]
+ROSTER_STREAMING_THRESHOLD_BYTES = 1024 * 1024
+ROSTER_MAX_REPORTED_ERRORS = 100
 
-def get_current_session_info():
-    time_str = datetime.now().strftime("%H:%M")
-    for i, (start, end, name) in enumerate(SESSIONS_TIMES):
-        if start <= time_str < end:
-            return name, i
-    return None, -1
-
-def get_teacher_for_group(group_name, session_name):
-    if not session_name or not group_name: return None
-    day_name = datetime.now().strftime("%A")
-    days_map = {"Monday": "Lunes", "Tuesday": "Martes", "Wednesday": "Miércoles", "Thursday": "Jueves", "Friday": "Viernes"}
-    spanish_day = days_map.get(day_name)
-    if not spanish_day: return None
-
-    for teacher in TIMETABLE:
+def roster_cell_text(value):
+    """A cell as read_excel(dtype=str) returns it: text as is ('01001' keeps its zero), 1234.0 -> '1234'."""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value)
+
+def read_roster_excel(path, streaming=None):
+    """Reads only the roster columns, every cell as text. Large files go through openpyxl read_only mode."""
+    if streaming is None:
+        streaming = os.path.getsize(path) > ROSTER_STREAMING_THRESHOLD_BYTES
+    import pandas as pd
+    if not streaming:
+        # dtype=str: without it pandas turns text ids like '01001' into 1001
+        df = pd.read_excel(path, header=ROSTER_HEADER_ROW, dtype=str)
+        df.columns = [str(c).strip() for c in df.columns]
+        return df[[c for c in ROSTER_COLUMNS.values() if c in df.columns]]
+
+    import openpyxl
+    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(min_row=ROSTER_HEADER_ROW + 1, values_only=True)
+        header = [str(c).strip() for c in next(rows, ())]
+        wanted = [(header.index(c), c) for c in ROSTER_COLUMNS.values() if c in header]
+        columns = {c: [] for _, c in wanted}
+        for row in rows:
+            for i, c in wanted:
+                columns[c].append(roster_cell_text(row[i]) if i < len(row) else None)
+    finally:
+        wb.close()
+    return pd.DataFrame(columns, dtype=object)
+
+def roster_text(df, column):
+    import pandas as pd
+    if column not in df.columns:
+        return pd.Series('', index=df.index)
+    col = df[column]
+    return col.where(col.notna(), '').astype(str).str.strip().replace('nan', '')
+
+def transform_roster(df):
+    """Returns (students, errors). errors: [{"row": excel row, "id": ..., "error": ...}]."""
+    import pandas as pd
+    text = {key: roster_text(df, column) for key, column in ROSTER_COLUMNS.items()}
+    tutor = (text["tutor_name"] + " " + text["tutor_surname"]).str.strip()
+    excel_rows = df.index.to_series() + ROSTER_HEADER_ROW + 2
+
+    has_name = text["name"] != ''
+    missing_id = has_name & (text["id"] == '')
+    candidate = has_name & ~missing_id
+    duplicated = pd.Series(False, index=df.index)
+    duplicated[candidate] = text["id"][candidate].duplicated(keep='first')
+    valid = candidate & ~duplicated
+
+    errors = [{"row": int(r), "id": i, "error": "Falta el Nº Id. Escolar"}
+              for r, i in zip(excel_rows[missing_id], text["id"][missing_id])]
+    errors += [{"row": int(r), "id": i, "error": "Nº Id. Escolar duplicado"}
+               for r, i in zip(excel_rows[duplicated], text["id"][duplicated])]
+    errors.sort(key=lambda e: e["row"])
+
+    students = [{"id": i, "name": n, "group": g, "dni": d, "tutor1": {"name": t}}
+                for i, n, g, d, t in zip(text["id"][valid], text["name"][valid], text["group"][valid],
+                                         text["dni"][valid], tutor[valid])]
+    return students, errors
+
+def diff_rosters(old, new):
+    """Student ids added, changed and removed between two rosters."""
+    old_by_id = {s.get('id'): s for s in old or []}
+    new_by_id = {s.get('id'): s for s in new}
+    return {
+        "added": [i for i in new_by_id if i not in old_by_id],
+        "changed": [i for i, s in new_by_id.items() if i in old_by_id and old_by_id[i] != s],
+        "removed": [i for i in old_by_id if i not in new_by_id],
+    }
+
+def store_roster_changes(old_students, new_students, diff):
+    """Writes the roster changes to students.json and returns the roster as now stored.
+    Added and changed students are appended to the chunked file (only they are
+    encrypted); removals, or changes to most of the roster, rewrite the whole file,
+    which also drops the frames the appends left behind."""
+    changed = set(diff["changed"])
+    new_by_id = {s.get('id'): s for s in new_students}
+    appended = [new_by_id[i] for i in diff["changed"] + diff["added"]]
+    if not diff["removed"] and len(appended) * 2 < len(new_students) and secure_json.is_chunked(STUDENTS_FILE):
+        if not append_secure_json(STUDENTS_FILE, appended):
+            raise RuntimeError("No se pudo guardar students.json")
+        # Same order as the file: replaced records move to the end
+        return [dict(s) for s in old_students if s.get('id') not in changed] + appended
+    if not save_secure_json(STUDENTS_FILE, new_students):
+        raise RuntimeError("No se pudo guardar students.json")
+    return new_students
+
+# --- PDF TICKETS ---
+# The static part of the ticket (logo, header, labels, rules, footer) is laid out
+# once per process; each ticket is a copy of that template with the values added.
+TICKET_LOGO_PATH = os.path.join(DATA_DIR, 'logo.gif')
+TICKET_TEMPLATE_VERSION = "2"  # bump when the ticket layout changes
+
+# PDF_MODE=lazy: register_exit only records the exit and /pdfs/<file> renders the
+# ticket on first access into a size-bounded LRU cache. Default (eager) keeps
+# writing every ticket to PDF_DIR. The combined PDF of a group exit
+# (lote_<batch>.pdf) always lives in the cache, rendered from the batch's live exits.
+PDF_MODE = os.environ.get('PDF_MODE', 'eager').lower()
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_PATH', os.path.join(PDF_DIR, "cache"))
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_MB', 200)) * 1024 * 1024
+BATCH_PDF_RE = re.compile(r'^lote_(\d{8}_\d{6}_[0-9a-f]{8})\.pdf$')
+if not os.path.exists(PDF_CACHE_DIR):
+    os.makedirs(PDF_CACHE_DIR)
+
+_ticket_template_lock = threading.Lock()
+_ticket_template = {"stamp": None, "pdf": None}
+
+def build_ticket_template():
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_auto_page_break(False)  # the footer sits inside the bottom margin
+    pdf.add_page()
+    draw_ticket_static(pdf)
+    return pdf
+
+def draw_ticket_static(pdf):
+    if os.path.exists(TICKET_LOGO_PATH):
+        pdf.image(TICKET_LOGO_PATH, x=92, y=10, w=25)
+    pdf.set_y(38)
+    pdf.set_font('Arial', 'B', 14)
+    pdf.cell(0, 8, safe_text('PARTE DE SALIDA'), 0, 1, 'C')
+    pdf.set_font('Arial', '', 12)
+    pdf.cell(0, 8, safe_text('I.E.S. Leopoldo Queipo'), 0, 1, 'C')
+
+    pdf.set_font("Arial", 'B', 11)
+    for label, y in (("Fecha:", 59), ("Hora:", 67), ("Grupo:", 95), ("DNI:", 103)):
+        pdf.set_xy(10, y); pdf.cell(90, 8, safe_text(label), 0, 0, 'R')
+    pdf.set_xy(10, 81); pdf.cell(0, 6, safe_text("Alumno:"), 0, 0, 'C')
+    pdf.set_xy(10, 119); pdf.cell(0, 6, safe_text("Motivo:"), 0, 0, 'C')
+    pdf.line(50, 77, 160, 77); pdf.line(50, 115, 160, 115)
+
+    pdf.set_y(-25); pdf.set_font('Arial', 'I', 9); pdf.cell(0, 10, safe_text('Documento oficial de control'), 0, 1, 'C')
+
+def get_ticket_template():
+    """Returns the template, rebuilt if logo.gif changed on disk."""
+    global _ticket_template
+    stamp = file_stamp(TICKET_LOGO_PATH)
+    template = _ticket_template
+    if template["pdf"] is None or template["stamp"] != stamp:
+        with _ticket_template_lock:
+            if _ticket_template["pdf"] is None or _ticket_template["stamp"] != stamp:
+                _ticket_template = {"stamp": stamp, "pdf": build_ticket_template()}
+            template = _ticket_template
+    return template["pdf"]
+
+def clone_pdf(template):
+    # Cheaper than deepcopy: only the containers FPDF mutates while adding
+    # content or on output() are copied; font metrics and image data are shared.
+    pdf = copy.copy(template)
+    pdf.pages = dict(template.pages)
+    pdf.fonts = {k: dict(v) for k, v in template.fonts.items()}
+    pdf.font_files = {k: dict(v) for k, v in template.font_files.items()}
+    pdf.images = {k: dict(v) for k, v in template.images.items()}
+    pdf.page_links = {k: list(v) for k, v in template.page_links.items()}
+    pdf.links = dict(template.links)
+    pdf.offsets = dict(template.offsets)
+    pdf.diffs = dict(template.diffs)
+    pdf.orientation_changes = dict(template.orientation_changes)
+    return pdf
+
+def render_ticket(record, pdf_path):
+    """Writes the ticket for an exit record (dict keyed by CSV headers) to pdf_path."""
+    pdf = clone_pdf(get_ticket_template())
+    draw_ticket_values(pdf, record)
+    pdf.output(pdf_path)
+
+def render_ticket_batch(records, pdf_path, ticket_dir=None):
+    """One page per record in a single PDF (group exits, printed at once). With
+    ticket_dir, each record's own ticket is written there from the same page."""
+    template = get_ticket_template()
+    batch = clone_pdf(template)
+    for i, record in enumerate(records, 1):
+        page = clone_pdf(template)
+        draw_ticket_values(page, record)
+        batch.pages[i] = page.pages[1]
+        batch.fonts.update(page.fonts)
+        if ticket_dir:
+            page.output(os.path.join(ticket_dir, record['PDF']))
+    batch.page = len(records)
+    batch.output(pdf_path)
+
+def draw_ticket_values(pdf, record):
+    pdf.set_font("Arial", '', 11)
+    for key, y in (("Fecha", 59), ("Hora", 67), ("Grupo", 95), ("DNI Alumno", 103)):
+        pdf.set_xy(105, y); pdf.cell(0, 8, safe_text(record.get(key, '')), 0, 0, 'L')
+    pdf.set_font("Arial", '', 12); pdf.set_xy(10, 87); pdf.cell(0, 8, safe_text(record.get('Nombre', '')), 0, 0, 'C')
+    pdf.set_font("Arial", '', 11); pdf.set_xy(10, 125); pdf.cell(0, 8, safe_text(record.get('Motivo', '')), 0, 0, 'C')
+    if record.get('Vuelve') == 'Sí':
+        pdf.set_font("Arial", 'B', 11); pdf.set_xy(10, 136); pdf.cell(90, 8, safe_text("Regreso:"), 0, 0, 'R')
+        pdf.set_font("Arial", '', 11); pdf.set_xy(105, 136); pdf.cell(0, 8, safe_text(f"SÍ - Horas: {record.get('Horas', '')}"), 0, 0, 'L')
+
+def ticket_cache_name(ticket_id):
+    """Content-addressed cache file: TicketID + template version (+ logo changes)."""
+    key = f"{ticket_id}:{TICKET_TEMPLATE_VERSION}:{file_stamp(TICKET_LOGO_PATH)}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32] + ".pdf"
+
+_pdf_cache_lock = threading.Lock()
+_pdf_cache_bytes = None  # estimate for this worker; recomputed on every eviction pass
+
+def pdf_cache_scan():
+    entries = []
+    for entry in os.scandir(PDF_CACHE_DIR):
+        if entry.is_file() and entry.name.endswith('.pdf'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    return entries
+
+def pdf_cache_evict(keep=None):
+    """Deletes least recently used tickets until the cache is at 90% of its limit."""
+    global _pdf_cache_bytes
+    entries = sorted(pdf_cache_scan())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= PDF_CACHE_MAX_BYTES * 0.9:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    _pdf_cache_bytes = total
+
+def get_cached_ticket(record):
+    """Path of the rendered ticket for record, rendering it on a cache miss."""
+    return get_cached_pdf(record['TicketID'] or record['PDF'], lambda path: render_ticket(record, path))
+
+def get_cached_batch(batch_id, records, ticket_dir=None):
+    """Path of the combined PDF of a group exit. The key includes the tickets, so deleting one re-renders it."""
+    key = f"lote:{batch_id}:" + ",".join(r['TicketID'] for r in records)
+    return get_cached_pdf(key, lambda path: render_ticket_batch(records, path, ticket_dir))
+
+def get_cached_pdf(key, render):
+    """Path of the cached PDF for key, calling render(path) on a cache miss."""
+    global _pdf_cache_bytes
+    path = os.path.join(PDF_CACHE_DIR, ticket_cache_name(key))
+    if os.path.exists(path):
+        os.utime(path)  # LRU: mtime is the last access
+        return path
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+    render(tmp_path)
+    os.replace(tmp_path, path)
+    with _pdf_cache_lock:
+        if _pdf_cache_bytes is None:
+            _pdf_cache_bytes = sum(size for _, size, _ in pdf_cache_scan())
+        else:
+            _pdf_cache_bytes += os.path.getsize(path)
+        if _pdf_cache_bytes > PDF_CACHE_MAX_BYTES:
+            pdf_cache_evict(keep=path)
+    return path
+
+def discard_cached_ticket(ticket_id):
+    path = os.path.join(PDF_CACHE_DIR, ticket_cache_name(ticket_id))
+    if os.path.exists(path):
+        os.remove(path)
+
+# --- TIMETABLE INDEX ---
+# Built once per timetable version: (day, session, group) -> [teachers], kept as
+# dicts per worker or, with SHARED_DATA=1, stored as a shared snapshot (see
+# SHARED DATA SNAPSHOTS) with "day|session|group" keys. Multi-group strings
+# joined with "_" (e.g. "E_3A_E_3B") are matched by substring, as before, and
+# the result is memoized per key.
+SESSION_NAME_RE = re.compile(r'(Sesi[oó]n|Recreo)\s*(\d+)', re.IGNORECASE)
+TIMETABLE_KEY_SEP = "\x1f"
+
+_timetable_lock = threading.Lock()
+_timetable_snapshot = None  # with SHARED_DATA
+_timetable_index = None  # (index, joined) otherwise; loaded on first lookup
+_timetable_stamp = None
+_timetable_lookup_cache = {}
+
+def normalize_session_name(tramo):
+    match = SESSION_NAME_RE.search(tramo or '')
+    if not match:
+        return (tramo or '').strip()
+    word = "Recreo" if match.group(1).lower() == "recreo" else "Sesión"
+    return f"{word} {int(match.group(2))}"
+
+def build_timetable_index(timetable):
+    index, joined = {}, {}
+    for teacher in timetable or []:
         for tramo in teacher.get('horario', []):
-            if session_name in tramo.get('tramo', ''):
-                class_info = tramo.get(spanish_day, {})
-                teacher_group = class_info.get('grupo', '')
-                if isinstance(teacher_group, list) and group_name in teacher_group: return teacher
-                if isinstance(teacher_group, str) and (group_name == teacher_group or (group_name in teacher_group and "_" in teacher_group)): return teacher
-    return None
+            session_name = normalize_session_name(tramo.get('tramo', ''))
+            if not session_name: continue
+            for day in WEEKDAYS_ES:
+                class_info = tramo.get(day) or {}
+                teacher_group = class_info.get('grupo', '') if isinstance(class_info, dict) else ''
+                groups = teacher_group if isinstance(teacher_group, list) else [teacher_group]
+                for group in groups:
+                    if not group or not isinstance(group, str): continue
+                    teachers = index.setdefault((day, session_name, group), [])
+                    if not any(t is teacher for t in teachers): teachers.append(teacher)
+                    if isinstance(teacher_group, str) and "_" in group:
+                        joined.setdefault((day, session_name), []).append((group, teacher))
+    return index, joined
 
+def build_timetable_snapshot(timetable, stamp):
+    timetable = [t for t in timetable or [] if isinstance(t, dict)]
+    index, joined = build_timetable_index(timetable)
+    rows = {id(t): row for row, t in enumerate(timetable)}
+    pool = shared_snapshot.StringPool()
+    columns = Teacher.columns([{k: t[k] for k in Teacher.FIELDS if k in t} for t in timetable], pool)
+    entries = sorted((TIMETABLE_KEY_SEP.join(key), [rows[id(t)] for t in teachers]) for key, teachers in index.items())
+    columns["index.key"] = ('I', [pool.add(key) for key, _ in entries])
+    columns["index.start"] = ('I', [0] + list(accumulate(len(teachers) for _, teachers in entries)))
+    columns["index.teachers"] = ('I', [row for _, teachers in entries for row in teachers])
+    entries = sorted((TIMETABLE_KEY_SEP.join(key), pairs) for key, pairs in joined.items())
+    columns["joined.key"] = ('I', [pool.add(key) for key, _ in entries])
+    columns["joined.start"] = ('I', [0] + list(accumulate(len(pairs) for _, pairs in entries)))
+    columns["joined.group"] = ('I', [pool.add(group) for _, pairs in entries for group, _ in pairs])
+    columns["joined.teacher"] = ('I', [rows[id(t)] for _, pairs in entries for _, t in pairs])
+    return shared_snapshot.build_snapshot({"source": snapshot_source(stamp)}, pool, columns)
+
+def timetable_range(snap, table, key):
+    """(start, end) of the entries stored under key in an index/joined table."""
+    pos = snap.find_sorted(snap.column(f"{table}.key"), TIMETABLE_KEY_SEP.join(key))
+    if pos < 0:
+        return 0, 0
+    start = snap.column(f"{table}.start")
+    return start[pos], start[pos + 1]
+
+def refresh_timetable_index(force=False):
+    """Swaps in the index snapshot if the timetable file changed on disk (no restart needed)."""
+    global _timetable_snapshot, _timetable_index, _timetable_stamp, _timetable_lookup_cache
+    stamp = file_stamp(TIMETABLE_PATH)
+    if not force and stamp == _timetable_stamp and (_timetable_snapshot or _timetable_index) is not None:
+        return
+    with _timetable_lock:
+        if not force and stamp == _timetable_stamp and (_timetable_snapshot or _timetable_index) is not None:
+            return
+        if SHARED_DATA_DIR:
+            build = lambda: build_timetable_snapshot(load_timetable(), stamp)
+            _timetable_snapshot = publish_snapshot("timetable", build()) if force else load_shared_snapshot("timetable", stamp, build)
+        else:
+            _timetable_index = build_timetable_index(load_timetable())
+        _timetable_lookup_cache = {}
+        _timetable_stamp = stamp
+
+@timed_span("timetable_lookup")
+def get_teachers_for_group(group_name, session_name, day=None):
+    """All teachers who have group_name in session_name on the given day (today by default)."""
+    if not session_name or not group_name: return []
+    spanish_day = day or school_weekday(datetime.now().date())
+    if not spanish_day: return []
+    refresh_timetable_index()
+
+    key = (spanish_day, normalize_session_name(session_name), group_name)
+    cache = _timetable_lookup_cache
+    if key not in cache and _timetable_snapshot is None:
+        index, joined = _timetable_index
+        teachers = list(index.get(key, []))
+        for joined_group, teacher in joined.get(key[:2], []):
+            if joined_group != group_name and group_name in joined_group and not any(t is teacher for t in teachers):
+                teachers.append(teacher)
+        cache[key] = teachers
+    elif key not in cache:
+        snap = _timetable_snapshot
+        start, end = timetable_range(snap, "index", key)
+        rows = list(snap.column("index.teachers")[start:end])
+        start, end = timetable_range(snap, "joined", key[:2])
+        joined_groups, joined_teachers = snap.column("joined.group"), snap.column("joined.teacher")
+        for i in range(start, end):
+            joined_group = snap.string(joined_groups[i])
+            if joined_group != group_name and group_name in joined_group and joined_teachers[i] not in rows:
+                rows.append(joined_teachers[i])
+        cache[key] = [Teacher(snap, row) for row in rows]
+    return cache[key]
+
+def build_email_message(to_email, subject, body):
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    msg = MIMEMultipart()
+    display_name = "Control de Salidas (No responder)"
+    sender_email = os.environ.get('SENDER_EMAIL', os.environ.get('SMTP_USER'))
+    msg['From'] = f"{display_name} <{sender_email}>"
+    msg['Reply-To'] = "noreply@iesleopoldoqueipo.com"
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(body, 'plain', 'utf-8'))
+    return msg
+
+def open_smtp_connection():
+    """Returns an authenticated SMTP connection (caller must close it)."""
+    import smtplib
+    server = smtplib.SMTP(os.environ.get('SMTP_SERVER', 'smtp.gmail.com'), int(os.environ.get('SMTP_PORT', 587)), timeout=30)
+    try:
+        server.starttls()
+        server.login(os.environ.get('SMTP_USER'), os.environ.get('SMTP_PASS'))
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def smtp_configured():
+    return bool(os.environ.get('SMTP_USER') and os.environ.get('SMTP_PASS'))
+
+@timed_span("smtp_send")
 def send_email(to_email, subject, body):
-    smtp_user = os.environ.get('SMTP_USER')
-    smtp_pass = os.environ.get('SMTP_PASS')
-    if not smtp_user or not smtp_pass: return False
-    try:
-        msg = MIMEMultipart()
-        display_name = "Control de Salidas (No responder)"
-        sender_email = os.environ.get('SENDER_EMAIL', smtp_user)
-        msg['From'] = f"{display_name} <{sender_email}>"
-        msg['Reply-To'] = "noreply@iesleopoldoqueipo.com"
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
-        with smtplib.SMTP(os.environ.get('SMTP_SERVER', 'smtp.gmail.com'), int(os.environ.get('SMTP_PORT', 587))) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_pass)
-            server.send_message(msg)
+    if not smtp_configured(): return False
+    try:
+        with open_smtp_connection() as server:
+            server.send_message(build_email_message(to_email, subject, body))
         return True
     except Exception as e:
         log_error(f"Email error: {e}")
         return False
 
+# --- NOTIFICATION OUTBOX ---
+# Exit notifications are queued in the exits DB and sent by a background thread
+# in each worker, so /api/exit never waits for SMTP. One SMTP login per batch.
+# With NOTIFY_DIGEST_MINUTES > 0 teacher notices are held until the window
+# closes (or the session changes, whichever comes first) and all the pending
+# notices for the same teacher go out as one digest email. Group exits always
+# queue mergeable teacher notices, so they become one email per teacher either way. Each outbox row
+# keeps its own status, so /api/notifications/<ticket> still works per exit.
+OUTBOX_BATCH_SIZE = 20
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETRY_BASE_SECONDS = 30
+OUTBOX_POLL_SECONDS = 5
+OUTBOX_STALE_MINUTES = 10  # 'sending' rows older than this are retried (worker died)
+NOTIFY_DIGEST_MINUTES = int(os.environ.get('NOTIFY_DIGEST_MINUTES', 0))
+
+TEACHER_SUBJECT_TPL = os.environ.get('EMAIL_TEACHER_SUBJECT', "Aviso Salida Alumno: {periodo}")
+TEACHER_BODY_TPL = os.environ.get('EMAIL_TEACHER_BODY',
+    "El alumno {alumno} del grupo {grupo} ha salido del centro.\nMotivo: {motivo}\nPeriodo afectado: {periodo}\n¿Regresa?: {regreso}\n\n--- mensaje automático ---").replace('\\n', '\n')
+# List form: {total} exits, {salidas} one line per exit (EMAIL_TEACHER_DIGEST_ITEM), {periodos}
+TEACHER_DIGEST_SUBJECT_TPL = os.environ.get('EMAIL_TEACHER_DIGEST_SUBJECT', "Aviso Salidas de Alumnos ({total}): {periodos}")
+TEACHER_DIGEST_BODY_TPL = os.environ.get('EMAIL_TEACHER_DIGEST_BODY',
+    "Han salido del centro {total} alumnos:\n{salidas}\n\n--- mensaje automático ---").replace('\\n', '\n')
+TEACHER_DIGEST_ITEM_TPL = os.environ.get('EMAIL_TEACHER_DIGEST_ITEM',
+    "- {alumno} ({grupo}) · {periodo} · Motivo: {motivo} · ¿Regresa?: {regreso}")
+
+_outbox_wakeup = threading.Event()
+
+def init_outbox():
+    with get_exit_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")  # see init_exit_store
+        conn.execute('''CREATE TABLE IF NOT EXISTS outbox
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT, ticket_id TEXT, to_email TEXT,
+                         subject TEXT, body TEXT, status TEXT NOT NULL DEFAULT 'pending',
+                         attempts INTEGER NOT NULL DEFAULT 0, next_attempt_at TEXT,
+                         claimed_at TEXT, last_error TEXT, created_at TEXT, sent_at TEXT)''')
+        columns = [r['name'] for r in conn.execute("PRAGMA table_info(outbox)")]
+        if 'item' not in columns:
+            # Template fields of a teacher notice that can be merged into a digest
+            conn.execute("ALTER TABLE outbox ADD COLUMN item TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox (status, next_attempt_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_digest ON outbox (to_email, status) WHERE item IS NOT NULL")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_ticket ON outbox (ticket_id)")
+
+init_outbox()
+
+def queue_email(to_email, subject, body, ticket_id='', item=None, send_at=None):
+    queue_emails([(to_email, subject, body, ticket_id, item)], send_at)
+
+def queue_emails(messages, send_at=None):
+    """messages: [(to_email, subject, body, ticket_id, item)], inserted in one transaction."""
+    now = datetime.now().isoformat()
+    with get_exit_db() as conn:
+        conn.executemany('''INSERT INTO outbox (ticket_id, to_email, subject, body, next_attempt_at, created_at, item)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         [(ticket_id, to_email, subject, body, send_at or now, now,
+                           json.dumps(item, ensure_ascii=False) if item else None)
+                          for to_email, subject, body, ticket_id, item in messages])
+    ensure_background_workers()
+    if not send_at:
+        _outbox_wakeup.set()
+
+def digest_send_at(now=None):
+    """End of the digest window: NOTIFY_DIGEST_MINUTES from now, or the next session change if sooner."""
+    now = now or datetime.now()
+    send_at = now + timedelta(minutes=NOTIFY_DIGEST_MINUTES)
+    change = next_session_change(now)
+    if change and now < change < send_at:
+        send_at = change
+    return send_at.isoformat()
+
+def queue_teacher_notice(to_email, fields, ticket_id=''):
+    """fields: alumno, grupo, motivo, periodo, regreso. Held for a digest when NOTIFY_DIGEST_MINUTES is set."""
+    subject = TEACHER_SUBJECT_TPL.format(**fields)
+    body = TEACHER_BODY_TPL.format(**fields)
+    if NOTIFY_DIGEST_MINUTES <= 0:
+        queue_email(to_email, subject, body, ticket_id)
+    else:
+        queue_email(to_email, subject, body, ticket_id, item=fields, send_at=digest_send_at())
+
+def render_teacher_digest(items):
+    periodos = []
+    for item in items:
+        if item['periodo'] not in periodos:
+            periodos.append(item['periodo'])
+    fields = {"total": len(items), "periodos": ", ".join(periodos),
+              "salidas": "\n".join(TEACHER_DIGEST_ITEM_TPL.format(**item) for item in items)}
+    return TEACHER_DIGEST_SUBJECT_TPL.format(**fields), TEACHER_DIGEST_BODY_TPL.format(**fields)
+
+def outbox_messages(rows):
+    """Groups claimed rows into (rows, to_email, subject, body): one digest per teacher, the rest one by one."""
+    messages, digests = [], {}
+    for r in rows:
+        if r['item']:
+            digests.setdefault(r['to_email'], []).append(r)
+        else:
+            messages.append(([r], r['to_email'], r['subject'], r['body']))
+    for to_email, group in digests.items():
+        if len(group) == 1:
+            messages.append((group, to_email, group[0]['subject'], group[0]['body']))
+        else:
+            messages.append((group, to_email, *render_teacher_digest([json.loads(r['item']) for r in group])))
+    return messages
+
+def claim_outbox_batch():
+    now = datetime.now()
+    stale = (now - timedelta(minutes=OUTBOX_STALE_MINUTES)).isoformat()
+    conn = get_exit_db()
+    try:
+        # IMMEDIATE so the two gunicorn workers never claim the same rows
+        conn.execute("BEGIN IMMEDIATE")
+        due = conn.execute('''SELECT id, to_email, subject, body, attempts, item FROM outbox
+                              WHERE (status = 'pending' AND next_attempt_at <= ?)
+                                 OR (status = 'sending' AND claimed_at < ?)
+                              ORDER BY id LIMIT ?''', (now.isoformat(), stale, OUTBOX_BATCH_SIZE * 10)).fetchall()
+        # Up to OUTBOX_BATCH_SIZE messages: a plain row is one, a recipient's mergeable rows are one
+        messages, rows = set(), []
+        for r in due:
+            key = r['to_email'] if r['item'] else r['id']
+            if key not in messages:
+                if len(messages) >= OUTBOX_BATCH_SIZE:
+                    continue
+                messages.add(key)
+            rows.append(r)
+        # A due digest also takes that teacher's notices whose window is still open
+        digest_emails = sorted({r['to_email'] for r in rows if r['item']})
+        if digest_emails:
+            claimed = [r['id'] for r in rows]
+            rows += conn.execute(f'''SELECT id, to_email, subject, body, attempts, item FROM outbox
+                                    WHERE status = 'pending' AND item IS NOT NULL
+                                      AND to_email IN ({",".join("?" * len(digest_emails))})
+                                      AND id NOT IN ({",".join("?" * len(claimed))})
+                                    ORDER BY id''', digest_emails + claimed).fetchall()
+        conn.executemany("UPDATE outbox SET status = 'sending', claimed_at = ? WHERE id = ?",
+                         [(now.isoformat(), r['id']) for r in rows])
+        conn.commit()
+        return rows
+    except Exception:
+        conn.rollback()
+        raise
+
+def mark_outbox_result(conn, row, error=None):
+    if error is None:
+        conn.execute("UPDATE outbox SET status = 'sent', attempts = attempts + 1, sent_at = ?, last_error = NULL WHERE id = ?",
+                     (datetime.now().isoformat(), row['id']))
+        return
+    attempts = row['attempts'] + 1
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        conn.execute("UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                     (attempts, str(error), row['id']))
+        log_error(f"Email to {row['to_email']} failed after {attempts} attempts: {error}")
+    else:
+        retry_at = datetime.now() + timedelta(seconds=OUTBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+        conn.execute("UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                     (attempts, retry_at.isoformat(), str(error), row['id']))
+
+def drain_outbox_batch():
+    """Sends one batch over a single SMTP connection. Returns how many rows were processed."""
+    rows = claim_outbox_batch()
+    if not rows:
+        return 0
+    results = {}
+    if not smtp_configured():
+        results = {r['id']: "SMTP no configurado" for r in rows}
+    else:
+        with timed_span("smtp_batch"):
+            try:
+                with open_smtp_connection() as server:
+                    for group, to_email, subject, body in outbox_messages(rows):
+                        try:
+                            server.send_message(build_email_message(to_email, subject, body))
+                            error = None
+                        except Exception as e:
+                            error = e
+                        for r in group:
+                            results[r['id']] = error
+            except Exception as e:
+                # Connection or login failed: retry whatever was not sent yet
+                log_error(f"Email error: {e}")
+                for r in rows:
+                    results.setdefault(r['id'], e)
+    with get_exit_db() as conn:
+        for r in rows:
+            mark_outbox_result(conn, r, results[r['id']])
+    return len(rows)
+
+def outbox_worker():
+    while True:
+        _outbox_wakeup.wait(OUTBOX_POLL_SECONDS)
+        _outbox_wakeup.clear()
+        try:
+            while drain_outbox_batch():
+                pass
+        except Exception as e:
+            log_error(f"Error in outbox worker: {e}")
+
+_background_workers_pid = None
+
+def ensure_background_workers():
+    # Checked per process: gunicorn forks workers after import
+    global _background_workers_pid
+    if _background_workers_pid == os.getpid():
+        return
+    _background_workers_pid = os.getpid()
+    threading.Thread(target=outbox_worker, name="outbox-worker", daemon=True).start()
+    threading.Thread(target=compaction_worker, name="exit-compaction", daemon=True).start()
+    threading.Thread(target=session_sweeper, name="session-sweeper", daemon=True).start()
+
+def get_notification_status(ticket_id):
+    with get_exit_db() as conn:
+        rows = conn.execute('''SELECT to_email, status, attempts, last_error, sent_at FROM outbox
+                               WHERE ticket_id = ? ORDER BY id''', (ticket_id,)).fetchall()
+    return [{"to": r['to_email'], "status": r['status'], "attempts": r['attempts'],
+             "lastError": r['last_error'], "sentAt": r['sent_at']} for r in rows]
+
+# --- LIVE EVENTS ---
+# New exits, returns and deletions are published to the events table (the
+# broker shared by all gunicorn workers). /api/events is a short long-poll: it
+# answers at once when there are events and otherwise holds the request for up
+# to EVENT_WAIT_SECONDS, waking at once for events published in its own worker
+# and polling the table every EVENT_POLL_SECONDS for the other workers' events.
+# At most EVENT_MAX_WAITERS requests per worker wait at a time, so open browsers
+# never take every thread away from /api/exit; the rest are told to come back
+# after EVENT_BUSY_RETRY_SECONDS. With sync workers (no --threads) set
+# LIVE_EVENTS_MAX_WAITERS=0 and every poll answers immediately.
+EVENT_POLL_SECONDS = 1
+EVENT_WAIT_SECONDS = 5
+EVENT_MAX_WAITERS = int(os.environ.get('LIVE_EVENTS_MAX_WAITERS', 4))
+EVENT_BUSY_RETRY_SECONDS = 5
+EVENT_RETENTION_HOURS = 24
+EVENT_BATCH_SIZE = 100
+
+_event_cond = threading.Condition()
+_event_seq = 0  # bumped on every local publish
+_event_waiters = threading.BoundedSemaphore(EVENT_MAX_WAITERS) if EVENT_MAX_WAITERS > 0 else None
+
+def init_events():
+    with get_exit_db() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS events
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL,
+                         payload TEXT NOT NULL, created_at TEXT NOT NULL)''')
+
+init_events()
+
+def publish_event(kind, payload):
+    publish_events(kind, [payload])
+
+def publish_events(kind, payloads):
+    """Best effort: a failure here is logged and never fails the request that published."""
+    global _event_seq
+    try:
+        now = datetime.now().isoformat()
+        with get_exit_db() as conn:
+            conn.executemany("INSERT INTO events (kind, payload, created_at) VALUES (?, ?, ?)",
+                             [(kind, json.dumps(payload, ensure_ascii=False), now) for payload in payloads])
+    except Exception as e:
+        log_error(f"Error publishing {kind} event: {e}")
+        return
+    with _event_cond:
+        _event_seq += 1
+        _event_cond.notify_all()
+
+def latest_event_id():
+    return get_exit_db().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+def events_since(last_id):
+    return get_exit_db().execute("SELECT id, kind, payload FROM events WHERE id > ? ORDER BY id LIMIT ?",
+                                 (last_id, EVENT_BATCH_SIZE)).fetchall()
+
+def wait_for_event(seen_seq, timeout):
+    with _event_cond:
+        _event_cond.wait_for(lambda: _event_seq != seen_seq, timeout)
+
+def purge_events():
+    cutoff = (datetime.now() - timedelta(hours=EVENT_RETENTION_HOURS)).isoformat()
+    with get_exit_db() as conn:
+        return conn.execute("DELETE FROM events WHERE created_at < ?", (cutoff,)).rowcount
+
+def poll_events(last_id):
+    """Events after last_id, waiting up to EVENT_WAIT_SECONDS for one. Returns (rows, retry_seconds)."""
+    rows = events_since(last_id)
+    if rows:
+        return rows, 0
+    if _event_waiters is None or not _event_waiters.acquire(blocking=False):
+        return rows, EVENT_BUSY_RETRY_SECONDS
+    try:
+        deadline = time.monotonic() + EVENT_WAIT_SECONDS
+        while True:
+            seen_seq = _event_seq  # read before querying, so nothing published in between is missed
+            rows = events_since(last_id)
+            remaining = deadline - time.monotonic()
+            if rows or remaining <= 0:
+                return rows, 0
+            wait_for_event(seen_seq, min(EVENT_POLL_SECONDS, remaining))
+    finally:
+        _event_waiters.release()
+
+# --- ACTIVE EXITS ---
+# Today's exits whose student has not come back, kept in memory per worker and
+# indexed by ticket, student and expected return session. Built once a day from
+# the exits table, then kept current by replaying the events table, so returns
+# and deletions made in the other worker show up here too.
+HOUR_NUMBER_RE = re.compile(r'(\d+)')
+
+_active_lock = threading.Lock()
+_active_exits = {"date": None, "event_id": 0, "by_ticket": {}, "by_student": {}, "by_session": {}}
+
+def expected_back_session(record):
+    """Session number the student should be back for: the one after the last hour out ("3ª, 4ª" -> 5)."""
+    if record.get('Vuelve') != 'Sí':
+        return None
+    hours = [int(h) for h in HOUR_NUMBER_RE.findall(record.get('Horas') or '')]
+    return max(hours) + 1 if hours else None
+
+def active_exit_entry(record):
+    return {"ticketId": record['TicketID'], "studentId": record['ID Alumno'], "name": record['Nombre'],
+            "group": record['Grupo'], "time": record['Hora'], "motive": record['Motivo'],
+            "returns": record['Vuelve'] == 'Sí', "hours": record['Horas'],
+            "expectedBack": expected_back_session(record)}
+
+def add_active_exit(state, record):
+    if record.get('HaVuelto') == 'Sí' or record.get('Fecha') != state["date"] or not record.get('TicketID'):
+        return
+    entry = active_exit_entry(record)
+    remove_active_exit(state, entry["ticketId"])
+    state["by_ticket"][entry["ticketId"]] = entry
+    state["by_student"].setdefault(entry["studentId"], set()).add(entry["ticketId"])
+    state["by_session"].setdefault(entry["expectedBack"], set()).add(entry["ticketId"])
+
+def remove_active_exit(state, ticket_id):
+    entry = state["by_ticket"].pop(ticket_id, None)
+    if entry:
+        state["by_student"][entry["studentId"]].discard(ticket_id)
+        state["by_session"][entry["expectedBack"]].discard(ticket_id)
+
+def refresh_active_exits():
+    """Applies the events published since the last call; rebuilds from the store when the day changes."""
+    global _active_exits
+    today = datetime.now().strftime("%Y-%m-%d")
+    with _active_lock:
+        state = _active_exits
+        if state["date"] != today:
+            # Take the event position first: anything published during the query is replayed (idempotent)
+            state = {"date": today, "event_id": latest_event_id(), "by_ticket": {}, "by_student": {}, "by_session": {}}
+            rows = get_exit_db().execute(f"SELECT * FROM exits WHERE date = ? AND has_returned != 'Sí' AND {LIVE_EXITS} ORDER BY id",
+                                         (today,)).fetchall()
+            for row in rows:
+                add_active_exit(state, exit_row_to_record(row))
+            _active_exits = state
+        while True:
+            events = events_since(state["event_id"])
+            if not events:
+                return state
+            for e in events:
+                state["event_id"] = e['id']
+                payload = json.loads(e['payload'])
+                if e['kind'] == 'exit':
+                    add_active_exit(state, payload['record'])
+                elif e['kind'] == 'return':
+                    remove_active_exit(state, payload['ticketId'])
+                elif e['kind'] == 'delete':
+                    for ticket_id in payload['ticketIds']:
+                        remove_active_exit(state, ticket_id)
+
+def get_active_exits(student_id=None, session_number=None):
+    state = refresh_active_exits()
+    with _active_lock:
+        if student_id is not None:
+            tickets = state["by_student"].get(student_id, ())
+        elif session_number is not None:
+            tickets = state["by_session"].get(session_number, ())
+        else:
+            tickets = state["by_ticket"]
+        return sorted((state["by_ticket"][t] for t in tickets), key=lambda e: e["time"])
+
+# --- EXIT REGISTRATION ---
+# Shared by /api/exit (one student) and /api/exits/group (a whole class or a list
+# of ids). A group exit writes every row in one transaction, renders one
+# multi-page PDF to print (plus the per-student tickets, as usual) and queues
+# mergeable notices, so each teacher gets a single email listing the students
+# (see NOTIFICATION OUTBOX). Guardians get the same email per student as for a
+# single exit, from the EMAIL_GUARDIAN_* templates.
+GROUP_EXIT_MAX_STUDENTS = 60
+
+def make_exit_record(data, now):
+    """Exit log record (dict keyed by CSV headers) from the /api/exit payload."""
+    vuelve = data.get('vuelve', False)
+    horas = data.get('horas', '') if vuelve else ''
+    # Sanitize ID for filename
+    safe_student_id = secure_filename(str(data.get('studentId', 'unknown')))
+    stamp = now.strftime('%Y%m%d_%H%M%S')
+    return dict(zip(CSV_HEADERS, [
+        now.strftime("%Y-%m-%d"), now.strftime("%H:%M:%S"), data.get('studentId', ''), data.get('studentName', ''),
+        data.get('group', ''), data.get('dni', ''), data.get('motive', ''),
+        data.get('accompaniedBy', ''), data.get('tutorName', ''), f"ticket_{stamp}_{safe_student_id}.pdf",
+        'Sí' if vuelve else 'No', horas, f"{stamp}_{safe_student_id}", 'No']))
+
+def notify_sessions(now, vuelve, horas):
+    """Sessions whose teachers are told about an exit: the current one, plus the
+    selected hours if the student comes back, or the rest of the day if not."""
+    sessions = []
+    current_sess_name, _ = current_session(now)
+    if current_sess_name:
+        sessions.append(current_sess_name)
+    if vuelve:
+        # 'horas' comes as "1ª, 2ª"
+        extra = sessions_for_hours(horas, now.date()) if horas else []
+    else:
+        extra = remaining_sessions(now)
+    for name in extra:
+        if name not in sessions:
+            sessions.append(name)
+    return sessions
+
+def tutor_name_for(student, accompanied_by):
+    # Same labels the exit modal sends for a single student
+    if accompanied_by in ('Tutor1', 'Tutor2'):
+        return (student.get(accompanied_by.lower()) or {}).get('name') or 'Error'
+    return 'Otro Autorizado' if accompanied_by == 'Otro' else '---'
+
+def resolve_group_students(group=None, student_ids=None):
+    """(students, unknown ids) from the roster: every student of a group, or the given ids."""
+    cache = get_students_cache()
+    if group:
+        return [dict(s) for s in cache["data"] if s.get('group') == group], []
+    students, unknown, seen = [], [], set()
+    for student_id in student_ids or []:
+        student_id = str(student_id)
+        if student_id in seen:
+            continue
+        seen.add(student_id)
+        student = cache["by_id"].get(student_id)
+        if student:
+            students.append(dict(student))
+        else:
+            unknown.append(student_id)
+    return students, unknown
+
+def queue_group_notifications(records, now, vuelve, horas):
+    """One outbox row per (recipient, exit), inserted at once: teacher rows are mergeable, guardian
+    rows are rendered and sent one by one like a single exit's. Returns the notified teacher names."""
+    regreso_text = f"Sí ({horas})" if vuelve else "No"
+    guardian_subject_tpl = os.environ.get('EMAIL_GUARDIAN_SUBJECT', TEACHER_SUBJECT_TPL)
+    guardian_body_tpl = os.environ.get('EMAIL_GUARDIAN_BODY', TEACHER_BODY_TPL).replace('\\n', '\n')
+    guardian_emails = [e.strip() for e in os.environ.get('GUARDIAN_EMAILS', '').split(',') if e.strip()]
+    sessions = notify_sessions(now, vuelve, horas)
+    messages, guardian_messages, notified_teacher_names = [], [], []
+    for record in records:
+        fields = {"alumno": record['Nombre'], "grupo": record['Grupo'], "motivo": record['Motivo'],
+                  "periodo": horas if vuelve else "Resto del día", "regreso": regreso_text}
+        for email in guardian_emails:
+            guardian_messages.append((email, guardian_subject_tpl.format(**dict(fields, periodo="Varios (RESUMEN)")),
+                                      guardian_body_tpl.format(**fields), record['TicketID'], None))
+        # Each teacher once per student, listing every session they have with the group
+        teacher_sessions, teacher_names = {}, {}
+        for session_name in sessions:
+            for teacher in get_teachers_for_group(record['Grupo'], session_name):
+                t_email = (teacher.get('email') or '').strip()
+                if not t_email: continue
+                teacher_sessions.setdefault(t_email, []).append(session_name)
+                teacher_names.setdefault(t_email, teacher.get('nombre', 'Profesor'))
+        for t_email, t_sessions in teacher_sessions.items():
+            item = dict(fields, periodo=", ".join(t_sessions))
+            messages.append((t_email, TEACHER_SUBJECT_TPL.format(**item), TEACHER_BODY_TPL.format(**item),
+                             record['TicketID'], item))
+            if teacher_names[t_email] not in notified_teacher_names:
+                notified_teacher_names.append(teacher_names[t_email])
+    if guardian_messages:
+        queue_emails(guardian_messages)
+    if messages:
+        queue_emails(messages, digest_send_at(now) if NOTIFY_DIGEST_MINUTES > 0 else None)
+    return notified_teacher_names
+
+# --- HISTORY EXPORT ---
+# The filtered history is streamed as CSV or XLSX (optionally zipped with its
+# PDF tickets) while it is read in id-ordered batches, so memory stays the same
+# whatever the size of the log. XLSX and ZIP are written through zipfile into
+# a buffer the response generator empties after every chunk.
+EXPORT_BATCH_SIZE = 500
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_FORMATS = {"csv": "text/csv; charset=utf-8",
+                  "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
+XML_INVALID_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+XLSX_PARTS = {
+    "[Content_Types].xml": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    "_rels/.rels": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    "xl/workbook.xml": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Salidas" sheetId="1" r:id="rId1"/></sheets></workbook>',
+    "xl/_rels/workbook.xml.rels": '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+
+class StreamBuffer:
+    """Write-only file object for zipfile; the generator takes what was written with drain()."""
+    def __init__(self):
+        self.chunks, self.size = [], 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks, self.size = [], 0
+        return data
+
+def iter_history_rows(where, params):
+    """Live exits matching the filters, newest first, read EXPORT_BATCH_SIZE rows at a time."""
+    last_id = None
+    while True:
+        clause, args = (where, params) if last_id is None else (f"{where} AND id < ?", [*params, last_id])
+        rows = get_exit_db().execute(f"SELECT * FROM exits WHERE {clause} ORDER BY id DESC LIMIT ?",
+                                     (*args, EXPORT_BATCH_SIZE)).fetchall()
+        yield from rows
+        if len(rows) < EXPORT_BATCH_SIZE:
+            return
+        last_id = rows[-1]['id']
+
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADERS)
+    for row in rows:
+        writer.writerow(exit_row_to_record(row).values())
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def xlsx_row(values):
+    cells = "".join(f'<c t="inlineStr"><is><t xml:space="preserve">{xml_escape(XML_INVALID_RE.sub("", str(v)))}</t></is></c>'
+                    for v in values)
+    return f"<row>{cells}</row>"
+
+def xlsx_sheet_chunks(rows):
+    """sheet1.xml with inline strings (no shared string table to hold in memory), header row frozen."""
+    parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+             '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+             '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+             '</sheetView></sheetViews><sheetData>', xlsx_row(CSV_HEADERS)]
+    size = 0
+    for row in rows:
+        parts.append(xlsx_row(exit_row_to_record(row).values()))
+        size += len(parts[-1])
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(parts).encode('utf-8')
+            parts, size = [], 0
+    parts.append('</sheetData></worksheet>')
+    yield "".join(parts).encode('utf-8')
+
+def zip_stream(entries):
+    """entries: (name, iterable of bytes). Yields the ZIP file as it is written."""
+    buffer = StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, chunks in entries:
+            with zf.open(name, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    if buffer.size >= EXPORT_CHUNK_BYTES:
+                        yield buffer.drain()
+    yield buffer.drain()
+
+def xlsx_entries(rows):
+    yield from ((name, [content.encode('utf-8')]) for name, content in XLSX_PARTS.items())
+    yield "xl/worksheets/sheet1.xml", xlsx_sheet_chunks(rows)
+
+def file_chunks(path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(EXPORT_CHUNK_BYTES), b''):
+            yield chunk
+
+def ticket_pdf_file(row):
+    """Path of the ticket PDF for an exit (rendered into the cache in lazy mode), or None."""
+    if not row['pdf']:
+        return None
+    path = os.path.join(PDF_DIR, secure_filename(row['pdf']))
+    if os.path.isfile(path):
+        return path
+    if PDF_MODE == 'lazy':
+        try:
+            return get_cached_ticket(exit_row_to_record(row))
+        except Exception as e:
+            log_error(f"Error generating PDF {row['pdf']} for export: {e}")
+    return None
+
+def pdf_entries(where, params):
+    seen = set()
+    for row in iter_history_rows(where, params):
+        name = secure_filename(row['pdf'] or '')
+        if not name or name in seen:
+            continue
+        path = ticket_pdf_file(row)
+        if path:
+            seen.add(name)
+            yield f"pdfs/{name}", file_chunks(path)
+
+def export_history_stream(fmt, where, params, with_pdfs):
+    """Generator for the export response: CSV, XLSX or a ZIP with either plus the PDFs."""
+    if fmt == 'csv':
+        entries = [("historial_salidas.csv", csv_chunks(iter_history_rows(where, params)))]
+    else:
+        entries = [("historial_salidas.xlsx", zip_stream(xlsx_entries(iter_history_rows(where, params))))]
+    if not with_pdfs:
+        return entries[0][1]
+    return zip_stream(chain(entries, pdf_entries(where, params)))
+
+# --- BACKGROUND JOBS ---
+# Long tasks (roster imports) run in a small thread pool per worker. Job state is
+# kept in the exits DB so /api/jobs/<id> answers from either gunicorn worker.
+JOB_POOL_SIZE = 1
+JOB_STALE_MINUTES = 30
+
+_job_pool = None
+_job_pool_pid = None
+
+def init_jobs():
+    with get_exit_db() as conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS jobs
+                        (id TEXT PRIMARY KEY, kind TEXT, status TEXT, progress INTEGER,
+                         message TEXT, result TEXT, created_at TEXT, updated_at TEXT)''')
+
+init_jobs()
+
+def update_job(job_id, status=None, progress=None, message=None, result=None):
+    fields = {"status": status, "progress": progress, "message": message,
+              "result": json.dumps(result) if result is not None else None}
+    fields = {k: v for k, v in fields.items() if v is not None}
+    fields["updated_at"] = datetime.now().isoformat()
+    with get_exit_db() as conn:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?", (*fields.values(), job_id))
+
+def get_job(job_id):
+    with get_exit_db() as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if not row:
+        return None
+    job = {"id": row['id'], "kind": row['kind'], "status": row['status'], "progress": row['progress'],
+           "message": row['message'], "result": json.loads(row['result']) if row['result'] else None}
+    stale = (datetime.now() - timedelta(minutes=JOB_STALE_MINUTES)).isoformat()
+    if job["status"] in ("queued", "running") and row['updated_at'] < stale:
+        job.update(status="error", message="La tarea se interrumpió (reinicio del servidor)")
+    return job
+
+def submit_job(kind, fn, *args):
+    """Queues fn(job_id, *args) in the pool. fn returns the result dict or raises."""
+    global _job_pool, _job_pool_pid
+    if _job_pool_pid != os.getpid():
+        _job_pool = ThreadPoolExecutor(max_workers=JOB_POOL_SIZE, thread_name_prefix="jobs")
+        _job_pool_pid = os.getpid()
+    job_id = secrets.token_hex(8)
+    now = datetime.now().isoformat()
+    with get_exit_db() as conn:
+        conn.execute("INSERT INTO jobs (id, kind, status, progress, created_at, updated_at) VALUES (?, ?, 'queued', 0, ?, ?)",
+                     (job_id, kind, now, now))
+
+    def run():
+        try:
+            update_job(job_id, status="running")
+            update_job(job_id, status="done", progress=100, message="Completado", result=fn(job_id, *args))
+        except ValueError as e:
+            update_job(job_id, status="error", message=str(e))
+        except Exception as e:
+            log_error(f"Error in {kind} job {job_id}: {e}")
+            update_job(job_id, status="error", message="Error interno al procesar la tarea")
+    _job_pool.submit(run)
+    return job_id
+
+def import_roster_job(job_id, temp_dir, temp_path):
+    try:
+        update_job(job_id, progress=10, message="Leyendo el archivo")
+        with timed_span("roster_read"):
+            df = read_roster_excel(temp_path)
+        missing = [c for c in ROSTER_REQUIRED_COLUMNS if c not in df.columns]
+        if missing:
+            raise ValueError(f"El archivo no tiene el formato de Séneca esperado (faltan columnas: {', '.join(missing)})")
+
+        update_job(job_id, progress=60, message="Validando alumnos")
+        with timed_span("roster_transform"):
+            new_students, errors = transform_roster(df)
+        if not new_students:
+            raise ValueError("El archivo no contiene ningún alumno válido")
+
+        # Only write (and invalidate caches/indexes) when something actually changed
+        update_job(job_id, progress=80, message="Guardando")
+        with timed_span("roster_diff"):
+            old_students = load_students()
+            diff = diff_rosters(old_students, new_students)
+        if diff["added"] or diff["changed"] or diff["removed"]:
+            publish_students(store_roster_changes(old_students, new_students, diff))
+
+        return {"count": len(new_students),
+                "added": len(diff["added"]), "changed": len(diff["changed"]), "removed": len(diff["removed"]),
+                "errorCount": len(errors), "errors": errors[:ROSTER_MAX_REPORTED_ERRORS]}
+    finally:
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
 # --- ROUTES ---
 
+@app.before_request
+def start_background_workers():
+    ensure_background_workers()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.spans = []
+
+@app.after_request
+def record_request_metrics(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe("partes_request_duration_seconds", {"route": route, "method": request.method, "status": response.status_code}, elapsed)
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        breakdown = ", ".join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in g.spans) or "sin etapas"
+        log_error(f"Slow request: {request.method} {request.path} -> {response.status_code} in {elapsed * 1000:.0f} ms ({breakdown})")
+    return response
+
 @app.route('/')
 def index():
     if not session.get('logged_in'):
@@ -276,9 +2537,9 @@ def request_token():
     expires_at = datetime.now() + timedelta(minutes=10)
     
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_session_db() as conn:
             conn.execute("INSERT OR REPLACE INTO login_tokens (email, token, expires_at) VALUES (?, ?, ?)",
-                         (email, token, expires_at))
+                         (email, token, db_timestamp(expires_at)))
         
         subject = "Tu código de acceso - Control de Salidas"
         body = f"Tu código de acceso es: {token}\n\nEste código caducará en 10 minutos."
@@ -303,7 +2564,7 @@ def login():
         return jsonify({"error": "Email y token requeridos"}), 400
         
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with get_session_db() as conn:
             cursor = conn.execute("SELECT token, expires_at FROM login_tokens WHERE email = ?", (email,))
             row = cursor.fetchone()
             
@@ -322,6 +2583,7 @@ def login():
             # Valid token! Clear it and log in
             conn.execute("DELETE FROM login_tokens WHERE email = ?", (email,))
             
+        session.rotate = True
         session.permanent = True
         session['logged_in'] = True
         session['user_email'] = email
@@ -340,74 +2602,210 @@ def logout():
 @admin_required
 def student_history():
     student_id = request.args.get('id', '')
-    total_count = 0
-    monthly_count = 0
-    current_month = datetime.now().strftime("%Y-%m")
-    
-    if os.path.exists(CSV_FILE):
-        with open(CSV_FILE, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row.get('ID Alumno') == student_id:
-                    total_count += 1
-                    fecha = row.get('Fecha', '')
-                    if fecha and fecha.startswith(current_month):
-                        monthly_count += 1
-    return jsonify({"count": total_count, "monthlyCount": monthly_count})
+    return jsonify(get_exit_counts([student_id])[student_id])
+
+@app.route('/api/student-history/batch', methods=['GET'])
+@admin_required
+def student_history_batch():
+    # ids come comma separated: ?ids=123,456,789 (one card grid at most)
+    student_ids = list(dict.fromkeys(i.strip() for i in request.args.get('ids', '').split(',') if i.strip()))
+    if len(student_ids) > 200:
+        return jsonify({"error": "Demasiados alumnos en una sola consulta (máximo 200)"}), 400
+    return jsonify(get_exit_counts(student_ids))
+
+@app.route('/api/students/search', methods=['GET'])
+@admin_required
+def students_search():
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        page_size = min(SEARCH_MAX_PAGE_SIZE, max(1, int(request.args.get('pageSize', SEARCH_PAGE_SIZE))))
+    except ValueError:
+        return jsonify({"error": "Parámetros de paginación inválidos"}), 400
+    return jsonify(search_students(request.args.get('q', ''), request.args.get('group') or None, page, page_size))
+
+@app.route('/api/students/<student_id>', methods=['GET'])
+@admin_required
+def student_detail(student_id):
+    student = load_student(student_id)
+    if not student:
+        return jsonify({"error": "Alumno no encontrado"}), 404
+    return jsonify(student)
+
+HISTORY_PAGE_SIZE = 200
+HISTORY_MAX_PAGE_SIZE = 1000
+
+def history_filters(args):
+    """Builds the WHERE clause shared by the history views from the query string:
+    from/to (YYYY-MM-DD), motive, q (name, group, DNI or student id; case and accents ignored)."""
+    clauses, params = [LIVE_EXITS], []
+    if args.get('from'):
+        clauses.append("date >= ?"); params.append(args['from'])
+    if args.get('to'):
+        clauses.append("date <= ?"); params.append(args['to'])
+    if args.get('motive') and args['motive'] != 'all':
+        clauses.append("motive = ?"); params.append(args['motive'])
+    term = fold_text((args.get('q') or '').strip())
+    if term:
+        clauses.append("search_text LIKE ? ESCAPE '\\'")
+        params.append(like_pattern(term))
+    return " AND ".join(clauses), params
 
 @app.route('/api/history', methods=['GET'])
 @admin_required
 def history():
-    exits = []
-    if os.path.exists(CSV_FILE):
-        with open(CSV_FILE, 'r', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            exits = list(reader)
-    exits.reverse()
-    return jsonify(exits)
+    where, params = history_filters(request.args)
+    try:
+        limit = min(HISTORY_MAX_PAGE_SIZE, max(1, int(request.args.get('limit', HISTORY_PAGE_SIZE))))
+        cursor = request.args.get('cursor')
+        if cursor:
+            where += " AND id < ?"
+            params.append(int(cursor))
+    except ValueError:
+        return jsonify({"error": "Parámetros de paginación inválidos"}), 400
+
+    with get_exit_db() as conn:
+        rows = conn.execute(f"SELECT * FROM exits WHERE {where} ORDER BY id DESC LIMIT ?", (*params, limit + 1)).fetchall()
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return jsonify({"records": [exit_row_to_record(r) for r in rows[:limit]], "nextCursor": next_cursor})
+
+@app.route('/api/history/stats', methods=['GET'])
+@admin_required
+def history_stats():
+    today = datetime.now().date()
+    week_start = today - timedelta(days=today.weekday())
+    month_start = today.replace(day=1)
+    ranges = (today.isoformat(), week_start.isoformat(), month_start.isoformat())
+
+    try:
+        if (request.args.get('q') or '').strip():
+            # Free-text search matches names and DNIs, which the aggregates do not keep: scan the log
+            where, params = history_filters(request.args)
+            with get_exit_db() as conn:
+                total, today_count, week_count, month_count = conn.execute(f'''
+                    SELECT COUNT(*), COUNT(CASE WHEN date = ? THEN 1 END),
+                           COUNT(CASE WHEN date >= ? THEN 1 END), COUNT(CASE WHEN date >= ? THEN 1 END)
+                    FROM exits WHERE {where}''', (*ranges, *params)).fetchone()
+                by_weekday = conn.execute(f"SELECT strftime('%w', date), COUNT(*) FROM exits WHERE {where} GROUP BY 1", params).fetchall()
+                by_minute = conn.execute(f"SELECT date, substr(time, 1, 5), COUNT(*) FROM exits WHERE {where} GROUP BY 1, 2", params).fetchall()
+            by_session = {}
+            for date, hhmm, count in by_minute:
+                name = exit_session(date, hhmm)
+                by_session[name] = by_session.get(name, 0) + count
+        else:
+            ensure_exit_daily()
+            clauses, params = ["1"], []
+            if request.args.get('from'):
+                clauses.append("date >= ?"); params.append(request.args['from'])
+            if request.args.get('to'):
+                clauses.append("date <= ?"); params.append(request.args['to'])
+            if request.args.get('motive') and request.args['motive'] != 'all':
+                clauses.append("motive = ?"); params.append(request.args['motive'])
+            where = " AND ".join(clauses)
+            with get_exit_db() as conn:
+                total, today_count, week_count, month_count = conn.execute(f'''
+                    SELECT COALESCE(SUM(count), 0), COALESCE(SUM(CASE WHEN date = ? THEN count END), 0),
+                           COALESCE(SUM(CASE WHEN date >= ? THEN count END), 0), COALESCE(SUM(CASE WHEN date >= ? THEN count END), 0)
+                    FROM exit_daily WHERE {where}''', (*ranges, *params)).fetchone()
+                by_weekday = conn.execute(f"SELECT strftime('%w', date), SUM(count) FROM exit_daily WHERE {where} GROUP BY 1", params).fetchall()
+                by_session = dict(conn.execute(f"SELECT session, SUM(count) FROM exit_daily WHERE {where} GROUP BY 1", params).fetchall())
+    except Exception as e:
+        log_error(f"Error computing history stats: {e}")
+        return jsonify({"error": "Error al calcular las estadísticas"}), 500
+
+    day_counts = dict.fromkeys(DAY_LABELS[1:6], 0)
+    for weekday, count in by_weekday:
+        if weekday is not None and DAY_LABELS[int(weekday)] in day_counts:
+            day_counts[DAY_LABELS[int(weekday)]] += count
+
+    # Morning sessions always shown; afternoon ones only when they have exits
+    shown = {name for start, _, name in default_day()["sessions"] if start < "16:00"}
+    names, labels = session_labels(shown | {name for name, count in by_session.items() if name and count})
+    sessions = [{"label": label, "count": by_session.get(name, 0)} for name, label in zip(names, labels)]
+
+    return jsonify({
+        "today": today_count, "week": week_count, "month": month_count, "total": total,
+        "days": [{"label": label, "count": count} for label, count in day_counts.items()],
+        "sessions": sessions,
+    })
+
+@app.route('/api/history/export', methods=['GET'])
+@admin_required
+def export_history():
+    """Same filters as /api/history; format=csv|xlsx, pdfs=1 to get a ZIP with the tickets too."""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": "Formato no válido (csv o xlsx)"}), 400
+    with_pdfs = request.args.get('pdfs') == '1'
+    where, params = history_filters(request.args)
+    filename = f"historial_salidas_{datetime.now().strftime('%Y-%m-%d')}.{'zip' if with_pdfs else fmt}"
+    return Response(stream_with_context(export_history_stream(fmt, where, params, with_pdfs)),
+                    content_type='application/zip' if with_pdfs else EXPORT_FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/reports', methods=['GET'])
+@admin_required
+def report():
+    """?period=month|term|year&date=YYYY-MM-DD (default today), or year=2025 (school year
+    2025-2026) with period=year|term and term=1..n, or from/to; optional group, motive, top."""
+    try:
+        day = datetime.strptime(request.args['date'], "%Y-%m-%d").date() if request.args.get('date') else datetime.now().date()
+        top = min(REPORT_MAX_TOP, max(1, int(request.args.get('top', REPORT_TOP_STUDENTS))))
+        if request.args.get('from') or request.args.get('to'):
+            start = datetime.strptime(request.args.get('from', ''), "%Y-%m-%d").date()
+            end = datetime.strptime(request.args.get('to', ''), "%Y-%m-%d").date()
+            if end < start or (end - start).days > REPORT_MAX_DAYS:
+                return jsonify({"error": f"Rango de fechas inválido (máximo {REPORT_MAX_DAYS} días)"}), 400
+            period = (f"{start.isoformat()} - {end.isoformat()}", start.isoformat(), end.isoformat())
+        else:
+            period = request.args.get('period', 'month')
+            if period not in ('month', 'term', 'year'):
+                return jsonify({"error": "Periodo inválido (month, term o year)"}), 400
+            school_year = int(request.args['year']) if request.args.get('year') else None
+            term = int(request.args['term']) if request.args.get('term') else None
+            period = report_period(period, day, school_year, term)
+    except ValueError:
+        return jsonify({"error": "Fecha o parámetros inválidos"}), 400
+    if not period:
+        return jsonify({"error": "No existe esa evaluación en el curso indicado"}), 404
+
+    label, start, end = period
+    motive = request.args.get('motive')
+    try:
+        with timed_span("report"):
+            result = build_report(start, end, request.args.get('group') or None,
+                                  motive if motive and motive != 'all' else None, top)
+    except Exception as e:
+        log_error(f"Error building report {label}: {e}")
+        return jsonify({"error": "Error al generar el informe"}), 500
+    return jsonify({"label": label, **result})
 
 @app.route('/api/history/<pdf_filename>', methods=['DELETE'])
 @admin_required
 def delete_record(pdf_filename):
-    # The filename in the CSV is what we use to match.
-    # We should normalize the input pdf_filename to avoid traversal, 
-    # but keep it exactly as it probably is in the CSV.
+    # The filename stored in the log is what we use to match.
+    # We should normalize the input pdf_filename to avoid traversal,
+    # but keep it exactly as it probably is in the log.
     clean_filename = secure_filename(pdf_filename)
-    
-    rows = []
-    deleted = False
-    
-    if os.path.exists(CSV_FILE):
-        try:
-            with open(CSV_FILE, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    # Match against the stored PDF filename
-                    if row.get('PDF') == pdf_filename or row.get('PDF') == clean_filename:
-                        deleted = True
-                        # Remove the actual file
-                        target_filename = row.get('PDF') or clean_filename
-                        pdf_path = os.path.join(PDF_DIR, target_filename)
-                        if os.path.exists(pdf_path) and os.path.isfile(pdf_path):
-                            os.remove(pdf_path)
-                    else:
-                        rows.append(row)
-        except Exception as e:
-            log_error(f"Error reading CSV during deletion: {e}")
-            return jsonify({"error": "Error interno al leer historial"}), 500
-    
-    if deleted:
-        try:
-            with open(CSV_FILE, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.DictWriter(f, fieldnames=CSV_HEADERS)
-                writer.writeheader()
-                writer.writerows(rows)
-            return jsonify({"status": "success"})
-        except Exception as e:
-            log_error(f"Error writing CSV during deletion: {e}")
-            return jsonify({"error": "Error al actualizar historial"}), 500
-            
-    log_error(f"Deletetion failed: record {pdf_filename} not found in CSV.")
+
+    try:
+        rows = delete_exit_records({pdf_filename, clean_filename})
+    except Exception as e:
+        log_error(f"Error deleting record {pdf_filename}: {e}")
+        return jsonify({"error": "Error al actualizar historial"}), 500
+
+    if rows:
+        publish_event("delete", {"pdfs": [r['pdf'] for r in rows], "ticketIds": [r['ticket_id'] for r in rows]})
+        for r in rows:
+            # Remove the actual file
+            pdf_path = os.path.join(PDF_DIR, secure_filename(r['pdf'] or clean_filename))
+            if os.path.exists(pdf_path) and os.path.isfile(pdf_path):
+                os.remove(pdf_path)
+            if PDF_MODE == 'lazy':
+                discard_cached_ticket(r['ticket_id'] or r['pdf'])
+        return jsonify({"status": "success"})
+
+    log_error(f"Deletetion failed: record {pdf_filename} not found in history.")
     return jsonify({"error": "Registro no encontrado en el historial"}), 404
 
 @app.route('/api/exit', methods=['POST'])
@@ -416,153 +2814,213 @@ def register_exit():
     try:
         data = request.json
         now = datetime.now()
-        date_str = now.strftime("%Y-%m-%d")
-        time_str = now.strftime("%H:%M:%S")
         vuelve = data.get('vuelve', False)
         horas = data.get('horas', '') if vuelve else ''
-        
-        # Sanitize ID for filename
-        safe_student_id = secure_filename(str(data.get('studentId', 'unknown')))
-        pdf_filename = f"ticket_{now.strftime('%Y%m%d_%H%M%S')}_{safe_student_id}.pdf"
+        record = make_exit_record(data, now)
+        pdf_filename = record['PDF']
         pdf_path = os.path.join(PDF_DIR, pdf_filename)
-        
-        # PDF generation logic...
+
+        # PDF generation logic (deferred to first download in lazy mode)...
         try:
-            pdf = FPDF()
-            pdf.add_page()
-            logo_path = os.path.join(DATA_DIR, 'logo.gif')
-            if os.path.exists(logo_path):
-                pdf.image(logo_path, x=92, y=10, w=25)
-            pdf.set_y(38)
-            pdf.set_font('Arial', 'B', 14)
-            pdf.cell(0, 8, safe_text('PARTE DE SALIDA'), 0, 1, 'C')
-            pdf.set_font('Arial', '', 12)
-            pdf.cell(0, 8, safe_text('I.E.S. Leopoldo Queipo'), 0, 1, 'C')
-            pdf.ln(5)
-            pdf.set_font("Arial", '', 11)
-            
-            def row(l, v):
-                pdf.set_font("Arial", 'B', 11); pdf.cell(90, 8, safe_text(l), 0, 0, 'R')
-                pdf.set_font("Arial", '', 11); pdf.cell(5); pdf.cell(0, 8, safe_text(v), 0, 1, 'L')
-                
-            row("Fecha:", date_str); row("Hora:", time_str)
-            pdf.ln(2); pdf.line(50, pdf.get_y(), 160, pdf.get_y()); pdf.ln(4)
-            pdf.set_font("Arial", 'B', 11); pdf.cell(0, 6, safe_text("Alumno:"), 0, 1, 'C')
-            pdf.set_font("Arial", '', 12); pdf.cell(0, 8, safe_text(data.get('studentName', '')), 0, 1, 'C')
-            row("Grupo:", data.get('group', '')); row("DNI:", data.get('dni', ''))
-            pdf.ln(4); pdf.line(50, pdf.get_y(), 160, pdf.get_y()); pdf.ln(4)
-            pdf.set_font("Arial", 'B', 11); pdf.cell(0, 6, safe_text("Motivo:"), 0, 1, 'C')
-            pdf.set_font("Arial", '', 11); pdf.cell(0, 8, safe_text(data.get('motive', '')), 0, 1, 'C')
-            if vuelve: pdf.ln(3); row("Regreso:", f"SÍ - Horas: {horas}")
-            pdf.set_y(-25); pdf.set_font('Arial', 'I', 9); pdf.cell(0, 10, safe_text('Documento oficial de control'), 0, 1, 'C')
-            pdf.output(pdf_path)
+            if PDF_MODE != 'lazy':
+                with timed_span("pdf"):
+                    render_ticket(record, pdf_path)
         except Exception as e:
             log_error(f"Error generating PDF at {pdf_path}: {e}")
             return jsonify({"error": f"Error al generar el PDF: {str(e)}"}), 500
 
         try:
-            ticket_id = f"{now.strftime('%Y%m%d_%H%M%S')}_{safe_student_id}"
-            with open(CSV_FILE, 'a', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([date_str, time_str, data.get('studentId', ''), data.get('studentName', ''),
-                                 data.get('group', ''), data.get('dni', ''), data.get('motive', ''),
-                                 data.get('accompaniedBy', ''), data.get('tutorName', ''), pdf_filename,
-                                 'Sí' if vuelve else 'No', horas, ticket_id, 'No'])
+            ticket_id = record['TicketID']
+            with timed_span("exit_store"):
+                add_exit_record(record)
         except Exception as e:
-            log_error(f"Error writing to CSV {CSV_FILE}: {e}")
+            log_error(f"Error writing to exit log {EXITS_DB_FILE}: {e}")
             return jsonify({"error": f"Error al guardar en el historial: {str(e)}"}), 500
+        with timed_span("event_publish"):
+            publish_event("exit", {"record": record})
 
         # Notifications logic...
         try:
-            guardian_emails = os.environ.get('GUARDIAN_EMAILS', '').split(',')
-            
-            # Email Templates (Teacher templates are the master ones now)
-            teacher_subject_tpl = os.environ.get('EMAIL_TEACHER_SUBJECT', "Aviso Salida Alumno: {periodo}")
-            teacher_body_tpl = os.environ.get('EMAIL_TEACHER_BODY', 
-                "El alumno {alumno} del grupo {grupo} ha salido del centro.\nMotivo: {motivo}\nPeriodo afectado: {periodo}\n¿Regresa?: {regreso}\n\n--- mensaje automático ---").replace('\\n', '\n')
-            
-            # Guardian templates fallback to teacher templates for consistency
-            guardian_subject_tpl = os.environ.get('EMAIL_GUARDIAN_SUBJECT', teacher_subject_tpl)
-            guardian_body_tpl = os.environ.get('EMAIL_GUARDIAN_BODY', teacher_body_tpl).replace('\\n', '\n')
+            with timed_span("notify"):
+                guardian_emails = os.environ.get('GUARDIAN_EMAILS', '').split(',')
 
-            regreso_text = f"Sí ({horas})" if vuelve else "No"
-            
-            if guardian_emails:
-                subject = guardian_subject_tpl.format(
-                    alumno=data.get('studentName'),
-                    grupo=data.get('group'),
-                    motivo=data.get('motive'),
-                    periodo="Varios (RESUMEN)",
-                    regreso=regreso_text
-                )
-                body = guardian_body_tpl.format(
-                    alumno=data.get('studentName'), 
-                    grupo=data.get('group'), 
-                    motivo=data.get('motive'), 
-                    periodo=horas if vuelve else "Resto del día",
-                    regreso=regreso_text
-                )
-                for email in guardian_emails:
-                    if email.strip(): send_email(email.strip(), subject, body)
-
-            # Identify which sessions to notify
-            sessions_to_notify = []
-            
-            # 1. Current session
-            current_sess_name, current_sess_idx = get_current_session_info()
-            if current_sess_name:
-                sessions_to_notify.append(current_sess_name)
-
-            # 2. Selected future sessions
-            if vuelve and horas:
-                # 'horas' comes as "1ª, 2ª"
-                for h in horas.split(','):
-                    mapped = SESSION_MAPPING.get(h.strip())
-                    if mapped and mapped not in sessions_to_notify:
-                        sessions_to_notify.append(mapped)
-            
-            # 3. Rest of the day if not returning
-            elif not vuelve and current_sess_idx != -1:
-                for _, _, s_name in SESSIONS_TIMES[current_sess_idx + 1:]:
-                    if "Sesión" in s_name and s_name not in sessions_to_notify:
-                        sessions_to_notify.append(s_name)
-
-            # Send emails to teachers
-            notified_emails = set()
-            notified_teacher_names = []
-            student_group = data.get('group', '')
-            
-            for session_name in sessions_to_notify:
-                teacher = get_teacher_for_group(student_group, session_name)
-                if teacher and teacher.get('email'):
-                    t_email = teacher['email'].strip()
-                    t_name = teacher.get('nombre', 'Profesor')
-                    if t_email and t_email not in notified_emails:
-                        msg_subject = teacher_subject_tpl.format(periodo=session_name)
-                        msg_body = teacher_body_tpl.format(
-                            alumno=data.get('studentName'),
-                            grupo=student_group,
-                            motivo=data.get('motive'),
-                            periodo=session_name,
-                            regreso=regreso_text
-                        )
-                        
-                        if send_email(t_email, msg_subject, msg_body):
+                # Guardian templates fallback to teacher templates for consistency
+                guardian_subject_tpl = os.environ.get('EMAIL_GUARDIAN_SUBJECT', TEACHER_SUBJECT_TPL)
+                guardian_body_tpl = os.environ.get('EMAIL_GUARDIAN_BODY', TEACHER_BODY_TPL).replace('\\n', '\n')
+
+                regreso_text = f"Sí ({horas})" if vuelve else "No"
+
+                if guardian_emails:
+                    subject = guardian_subject_tpl.format(
+                        alumno=data.get('studentName'),
+                        grupo=data.get('group'),
+                        motivo=data.get('motive'),
+                        periodo="Varios (RESUMEN)",
+                        regreso=regreso_text
+                    )
+                    body = guardian_body_tpl.format(
+                        alumno=data.get('studentName'), 
+                        grupo=data.get('group'), 
+                        motivo=data.get('motive'), 
+                        periodo=horas if vuelve else "Resto del día",
+                        regreso=regreso_text
+                    )
+                    for email in guardian_emails:
+                        if email.strip(): queue_email(email.strip(), subject, body, ticket_id)
+
+                sessions_to_notify = notify_sessions(datetime.now(), vuelve, horas)
+
+                # Send emails to teachers
+                notified_emails = set()
+                notified_teacher_names = []
+                student_group = data.get('group', '')
+
+                for session_name in sessions_to_notify:
+                    for teacher in get_teachers_for_group(student_group, session_name):
+                        if not teacher.get('email'): continue
+                        t_email = teacher['email'].strip()
+                        t_name = teacher.get('nombre', 'Profesor')
+                        if t_email and t_email not in notified_emails:
+                            queue_teacher_notice(t_email, {
+                                "alumno": data.get('studentName'),
+                                "grupo": student_group,
+                                "motivo": data.get('motive'),
+                                "periodo": session_name,
+                                "regreso": regreso_text
+                            }, ticket_id)
                             notified_emails.add(t_email)
                             if t_name not in notified_teacher_names:
                                 notified_teacher_names.append(t_name)
-                        
+
         except Exception as e:
             log_error(f"Error in notification logic: {e}")
             notified_teacher_names = []
             # We don't return 500 here to let the operation succeed even if email fails
 
-        return jsonify({"status": "success", "pdf": pdf_filename, "notified": notified_teacher_names})
-        
+        return jsonify({"status": "success", "pdf": pdf_filename, "ticketId": ticket_id, "notified": notified_teacher_names})
+
     except Exception as e:
         log_error(f"General error in register_exit: {e}")
         return jsonify({"error": f"Error interno: {str(e)}"}), 500
 
+@app.route('/api/exits/group', methods=['POST'])
+@admin_required
+def register_group_exit():
+    """Body: {"group": "E_1A"} or {"studentIds": [...]}, plus motive, accompaniedBy, vuelve, horas."""
+    data = request.json or {}
+    group = (data.get('group') or '').strip()
+    student_ids = data.get('studentIds') or []
+    if not group and not student_ids:
+        return jsonify({"error": "Indica un grupo o una lista de alumnos"}), 400
+    students, unknown = resolve_group_students(group, student_ids)
+    if unknown:
+        return jsonify({"error": f"Alumnos no encontrados: {', '.join(unknown[:10])}"}), 400
+    if not students:
+        return jsonify({"error": "El grupo no tiene alumnos"}), 404
+    if len(students) > GROUP_EXIT_MAX_STUDENTS:
+        return jsonify({"error": f"Como máximo {GROUP_EXIT_MAX_STUDENTS} alumnos por salida de grupo"}), 400
+
+    now = datetime.now()
+    vuelve = data.get('vuelve', False)
+    horas = data.get('horas', '') if vuelve else ''
+    accompanied_by = data.get('accompaniedBy', 'Solo')
+    records = [make_exit_record({
+        "studentId": s.get('id', ''), "studentName": s.get('name', ''), "group": s.get('group', ''),
+        "dni": s.get('dni', ''), "motive": data.get('motive', ''), "accompaniedBy": accompanied_by,
+        "tutorName": tutor_name_for(s, accompanied_by), "vuelve": vuelve, "horas": horas}, now) for s in students]
+    batch_id = f"{now.strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(4)}"
+    batch_pdf = f"lote_{batch_id}.pdf"
+
+    try:
+        # Eager: each page is rendered once, for both the batch and the ticket files.
+        # Lazy: the batch is rendered when it is first opened (see serve_pdf).
+        if PDF_MODE != 'lazy':
+            with timed_span("pdf"):
+                get_cached_batch(batch_id, records, ticket_dir=PDF_DIR)
+    except Exception as e:
+        log_error(f"Error generating PDFs for group exit {batch_pdf}: {e}")
+        return jsonify({"error": f"Error al generar el PDF: {str(e)}"}), 500
+
+    try:
+        with timed_span("exit_store"):
+            add_exit_records(records, batch_id)
+    except Exception as e:
+        log_error(f"Error writing group exit to {EXITS_DB_FILE}: {e}")
+        return jsonify({"error": f"Error al guardar en el historial: {str(e)}"}), 500
+    with timed_span("event_publish"):
+        publish_events("exit", [{"record": record} for record in records])
+
+    try:
+        with timed_span("notify"):
+            notified_teacher_names = queue_group_notifications(records, now, vuelve, horas)
+    except Exception as e:
+        log_error(f"Error in group notification logic: {e}")
+        notified_teacher_names = []
+
+    return jsonify({"status": "success", "count": len(records), "batchPdf": batch_pdf,
+                    "tickets": [{"ticketId": r['TicketID'], "pdf": r['PDF'], "studentId": r['ID Alumno'],
+                                 "studentName": r['Nombre']} for r in records],
+                    "notified": notified_teacher_names})
+
+@app.route('/api/notifications/<ticket_id>', methods=['GET'])
+@admin_required
+def notification_status(ticket_id):
+    return jsonify(get_notification_status(ticket_id))
+
+@app.route('/api/events', methods=['GET'])
+@limiter.exempt
+@admin_required
+def live_events():
+    # Resume after ?since=; a new client only learns the current position and starts from there
+    try:
+        last_id = int(request.args.get('since', -1))
+    except ValueError:
+        last_id = -1
+    if last_id < 0:
+        return jsonify({"events": [], "last": latest_event_id(), "retry": 0})
+    rows, retry = poll_events(last_id)
+    if rows:
+        last_id = rows[-1]['id']
+    return jsonify({"events": [{"id": r['id'], "kind": r['kind'], "data": json.loads(r['payload'])} for r in rows],
+                    "last": last_id, "retry": retry})
+
+@app.route('/api/exits/<ticket_id>/return', methods=['POST'])
+@admin_required
+def mark_returned(ticket_id):
+    try:
+        row, changed = mark_exit_returned(ticket_id)
+    except Exception as e:
+        log_error(f"Error marking return for {ticket_id}: {e}")
+        return jsonify({"error": "Error al registrar el regreso"}), 500
+    if not row:
+        return jsonify({"error": "Salida no encontrada"}), 404
+    if changed:
+        publish_event("return", {"ticketId": ticket_id, "studentId": row['student_id'], "returnedAt": row['returned_at']})
+    return jsonify({"status": "success", "ticketId": ticket_id, "returnedAt": row['returned_at'], "alreadyReturned": not changed})
+
+@app.route('/api/exits/active', methods=['GET'])
+@admin_required
+def active_exits():
+    # ?student=<id> or ?session=3 (students expected back in session 3); nothing = everyone out today
+    session_number = request.args.get('session')
+    if session_number is not None:
+        match = HOUR_NUMBER_RE.search(session_number)
+        if not match:
+            return jsonify({"error": "Sesión inválida"}), 400
+        session_number = int(match.group(1))
+    exits = get_active_exits(request.args.get('student'), session_number)
+    return jsonify({"count": len(exits), "exits": exits})
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics():
+    # Prometheus: "Authorization: Bearer <METRICS_TOKEN>"; a logged-in admin also works
+    auth = request.headers.get('Authorization', '')
+    token_ok = bool(METRICS_TOKEN) and secrets.compare_digest(auth, f"Bearer {METRICS_TOKEN}")
+    if not token_ok and not session.get('logged_in'):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/upload-students', methods=['POST'])
 @admin_required
 def upload_students():
@@ -583,44 +3041,64 @@ def upload_students():
     temp_path = os.path.join(temp_dir, filename)
     
     try:
-        file.save(temp_path)
+        with timed_span("upload_save"):
+            file.save(temp_path)
         
         # Check file size (5MB limit redundant with config but safe)
         if os.path.getsize(temp_path) > 5 * 1024 * 1024:
             raise ValueError("El archivo es demasiado grande (máximo 5MB)")
 
-        df = pd.read_excel(temp_path, header=4)
-        df.columns = [str(c).strip() for c in df.columns]
-        new_students = []
-        for _, row in df.iterrows():
-            s_name = str(row.get('Alumno/a', '')).strip()
-            if not s_name or s_name == 'nan': continue
-            new_students.append({
-                "id": str(row.get('Nº Id. Escolar', '')).strip(),
-                "name": s_name,
-                "group": str(row.get('Unidad', '')).strip(),
-                "dni": str(row.get('DNI/Pasaporte', '')).strip(),
-                "tutor1": { "name": f"{row.get('Nombre Primer tutor', '')} {row.get('Primer apellido Primer tutor', '')}".strip() }
-            })
-        
-        students_file = os.path.join(DATA_DIR, "students.json")
-        save_secure_json(students_file, new_students)
-        
-        return jsonify({"status": "success", "count": len(new_students)})
-    
+        # Parsing runs in the background so this worker is free for /api/exit
+        job_id = submit_job("roster-import", import_roster_job, temp_dir, temp_path)
+        return jsonify({"status": "queued", "jobId": job_id}), 202
+
+    except ValueError as e:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
+        shutil.rmtree(temp_dir, ignore_errors=True)
         log_error(f"Error en carga de alumnos: {str(e)}")
         return jsonify({"error": "Error interno al procesar el archivo Excel"}), 500
-    finally:
-        # Cleanup
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@admin_required
+def job_status(job_id):
+    job = get_job(job_id)
+    if not job:
+        return jsonify({"error": "Tarea no encontrada"}), 404
+    return jsonify(job)
 
 @app.route('/pdfs/<path:filename>')
 @admin_required
 def serve_pdf(filename):
     filename = secure_filename(filename)
-    return send_from_directory(PDF_DIR, filename)
+    batch = BATCH_PDF_RE.match(filename)
+    if batch:
+        with get_exit_db() as conn:
+            rows = conn.execute(f"SELECT * FROM exits WHERE batch_id = ? AND {LIVE_EXITS} ORDER BY id", (batch.group(1),)).fetchall()
+        if not rows:
+            return jsonify({"error": "Lote no encontrado"}), 404
+        try:
+            path = get_cached_batch(batch.group(1), [exit_row_to_record(r) for r in rows])
+        except Exception as e:
+            log_error(f"Error generating PDF for {filename}: {e}")
+            return jsonify({"error": "Error al generar el PDF"}), 500
+        return send_from_directory(PDF_CACHE_DIR, os.path.basename(path), download_name=filename)
+
+    if PDF_MODE != 'lazy' or os.path.isfile(os.path.join(PDF_DIR, filename)):
+        return send_from_directory(PDF_DIR, filename)
+
+    # Lazy mode: render from the stored record into the LRU cache
+    with get_exit_db() as conn:
+        row = conn.execute(f"SELECT * FROM exits WHERE pdf = ? AND {LIVE_EXITS} ORDER BY id DESC LIMIT 1", (filename,)).fetchone()
+    if not row:
+        return jsonify({"error": "Ticket no encontrado"}), 404
+    try:
+        path = get_cached_ticket(exit_row_to_record(row))
+    except Exception as e:
+        log_error(f"Error generating PDF for {filename}: {e}")
+        return jsonify({"error": "Error al generar el PDF"}), 500
+    return send_from_directory(PDF_CACHE_DIR, os.path.basename(path), download_name=filename)
 
 @app.route('/data/<path:filename>')
 @admin_required
@@ -634,10 +3112,14 @@ def serve_data(filename):
     if safe_path.startswith('..') or os.path.isabs(safe_path):
         return "Acceso Denegado", 403
         
-    # If students.json is requested, return decrypted content
+    # If students.json is requested, return decrypted content (cached, with ETag)
     if filename.lower() == 'students.json':
-        students_data = load_secure_json(os.path.join(DATA_DIR, filename))
-        return jsonify(students_data)
+        cache = get_students_cache()
+        response = make_response(bytes(cache["body"]))
+        response.mimetype = 'application/json'
+        response.set_etag(cache["etag"])
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response.make_conditional(request)
         
     return send_from_directory(DATA_DIR, safe_path)
 
@@ -650,7 +3132,29 @@ def add_security_headers(response):
     response.headers['Content-Security-Policy'] = "default-src 'self'; script-src 'self' 'unsafe-inline' https://unpkg.com; style-src 'self' 'unsafe-inline' https://fonts.googleapis.com; font-src 'self' https://fonts.gstatic.com; img-src 'self' data: blob:; connect-src 'self';"
     return response
 
+# --- STARTUP ---
+def warm_up():
+    """Loads what lazy mode defers (heavy modules, timetable index, roster, search
+    index, schedule, ticket template) and freezes it out of the GC, so forked
+    workers keep sharing those pages instead of copying them on the first collection.
+    The SQLite connections opened by the init steps are closed first: a worker
+    must not inherit them."""
+    import pandas, openpyxl, smtplib
+    from email.mime.multipart import MIMEMultipart
+    refresh_timetable_index()
+    get_search_index()
+    default_day()
+    get_ticket_template()
+    close_db_connections()
+    gc.collect()
+    gc.freeze()
+
+if STARTUP_MODE == 'preload':
+    warm_up()
+
 if __name__ == '__main__':
     # For local testing only. Production uses Gunicorn.
     port = int(os.environ.get('PORT', 40050))
+    if SHARED_DATA_DIR:
+        atexit.register(shared_snapshot.remove_snapshots, SHARED_DATA_DIR)
     app.run(host='127.0.0.1', port=port)
@@ -0,0 +1,147 @@
+"""Compact read-only snapshots shared by all gunicorn workers (roster, timetable).
+
+A snapshot is one file with interned strings, fixed-width integer columns and
+raw blobs. Workers mmap it, so its pages live once in the page cache however
+many workers there are. A new version is published by writing a temp file and
+renaming it over the old one; a worker still holding the old mapping keeps
+reading it until it notices the change. Used by server.py; gunicorn.conf.py
+removes the snapshots when the server shuts down.
+
+Layout:
+    MAGIC | header length (u32) | header JSON | padding | sections (8-byte aligned)
+The header holds the caller's metadata and {name: [offset, length, typecode]}
+for every section. Strings are the "strings.offsets" ('I', n + 1) and
+"strings.data" (UTF-8) sections; string id 0 is always "".
+"""
+import os
+import json
+import hashlib
+import mmap
+import array
+import struct
+
+MAGIC = b"SSN1"
+HEADER_LENGTH = struct.Struct(">I")
+ALIGN = 8
+
+class StringPool:
+    """Interns strings while building a snapshot: equal strings share one id."""
+    def __init__(self):
+        self.ids = {"": 0}
+        self.strings = [""]
+
+    def add(self, text):
+        text = "" if text is None else str(text)
+        sid = self.ids.get(text)
+        if sid is None:
+            sid = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+        return sid
+
+    def sections(self):
+        offsets, data, position = array.array('I', [0]), bytearray(), 0
+        for text in self.strings:
+            encoded = text.encode('utf-8')
+            data += encoded
+            position += len(encoded)
+            offsets.append(position)
+        return {"strings.offsets": ('I', offsets.tobytes()), "strings.data": ('B', bytes(data))}
+
+def build_snapshot(meta, pool, columns=None, blobs=None):
+    """meta: JSON-able dict. columns: {name: (typecode, ints)}. blobs: {name: bytes}. Returns the file bytes."""
+    sections = pool.sections()
+    for name, (typecode, values) in (columns or {}).items():
+        sections[name] = (typecode, array.array(typecode, values).tobytes())
+    for name, blob in (blobs or {}).items():
+        sections[name] = ('B', bytes(blob))
+
+    def header_bytes(table):
+        return json.dumps({"meta": meta, "sections": table}, separators=(',', ':')).encode('utf-8')
+
+    # Offsets depend on the header size and vice versa: size the header with
+    # placeholder offsets wide enough for the final ones, then pad it.
+    placeholder = {name: [10 ** 12, len(data), typecode] for name, (typecode, data) in sections.items()}
+    start = -(-(len(MAGIC) + HEADER_LENGTH.size + len(header_bytes(placeholder))) // ALIGN) * ALIGN
+    table, position = {}, start
+    for name, (typecode, data) in sections.items():
+        table[name] = [position, len(data), typecode]
+        position = -(-(position + len(data)) // ALIGN) * ALIGN
+    header = header_bytes(table)
+    out = bytearray(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+    for name, (typecode, data) in sections.items():
+        out += b"\0" * (table[name][0] - len(out))
+        out += data
+    return bytes(out)
+
+def snapshot_directory(data_dir):
+    """Where the snapshots of a data dir are published: SHARED_DATA_PATH, or a
+    per-data-dir directory on /dev/shm ('' if there is no /dev/shm)."""
+    if os.environ.get('SHARED_DATA_PATH'):
+        return os.environ['SHARED_DATA_PATH']
+    if not os.path.isdir('/dev/shm'):
+        return ''
+    return f"/dev/shm/partesSalida-{hashlib.sha256(data_dir.encode()).hexdigest()[:12]}"
+
+def remove_snapshots(directory):
+    """Deletes the published snapshots (and leftover temp files). The directory itself stays."""
+    try:
+        for name in os.listdir(directory):
+            if ".snap" in name:
+                os.remove(os.path.join(directory, name))
+    except OSError:
+        pass
+
+def write_snapshot(path, data):
+    """Atomically replaces the snapshot at path (readable by the owner only: it holds decrypted data)."""
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class Snapshot:
+    """Read-only view over snapshot bytes (an mmap, or bytes kept in this process)."""
+    def __init__(self, buffer):
+        self.buffer = buffer
+        view = memoryview(buffer)
+        if bytes(view[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a snapshot")
+        (length,) = HEADER_LENGTH.unpack_from(view, len(MAGIC))
+        start = len(MAGIC) + HEADER_LENGTH.size
+        header = json.loads(bytes(view[start:start + length]))
+        self.meta = header["meta"]
+        self.sections = {}
+        for name, (offset, size, typecode) in header["sections"].items():
+            section = view[offset:offset + size]
+            self.sections[name] = section.cast(typecode) if typecode != 'B' else section
+        self.string_offsets = self.sections["strings.offsets"]
+        self.string_data = self.sections["strings.data"]
+
+    def string(self, sid):
+        return str(self.string_data[self.string_offsets[sid]:self.string_offsets[sid + 1]], 'utf-8')
+
+    def column(self, name):
+        return self.sections[name]
+
+    def blob(self, name):
+        return self.sections[name]
+
+    def find_sorted(self, key_column, text):
+        """Row whose string in key_column (sorted by that string) equals text, or -1."""
+        lo, hi = 0, len(key_column)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.string(key_column[mid]) < text:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < len(key_column) and self.string(key_column[lo]) == text else -1
+
+def open_snapshot(path):
+    """Maps the snapshot file. None if it does not exist or is not a valid snapshot."""
+    try:
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return Snapshot(buffer)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
@@ -27,7 +27,8 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
     // State
-    let allStudents = [];
+    let totalStudents = 0;
+    let searchSeq = 0;
     let currentFilter = 'all';
     let selectedStudent = null;
     let csrfToken = null;
@@ -45,8 +46,9 @@ document.addEventListener('DOMContentLoaded', () => {
     }
 
     // Constants
-    const DATA_URL = '/data/students.json';
+    const SEARCH_URL = '/api/students/search';
     const API_URL = '/api/exit'; // Relative path to support any port
+    const GROUP_EXIT_URL = '/api/exits/group';
 
     // Initialize
     refreshCsrfToken();
@@ -104,18 +106,25 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     });
 
+    async function fetchStudents(query) {
+        const params = new URLSearchParams({ q: query, pageSize: 100 });
+        const response = await fetch(`${SEARCH_URL}?${params}`);
+        if (response.status === 401 || response.type === 'opaqueredirect' || response.url.includes('login.html')) {
+            window.location.href = '/login.html';
+            return null;
+        }
+        if (!response.ok) throw new Error('Network response was not ok');
+        return response.json();
+    }
+
     async function fetchData() {
         try {
-            const response = await fetch(DATA_URL);
-            if (response.status === 401 || response.type === 'opaqueredirect' || response.url.includes('login.html')) {
-                window.location.href = '/login.html';
-                return;
-            }
-            if (!response.ok) throw new Error('Network response was not ok');
-            allStudents = await response.json();
+            const data = await fetchStudents('');
+            if (!data) return;
+            totalStudents = data.total;
             loadingState.classList.add('hidden');
-            renderStudents(allStudents.slice(0, 50));
-            updateStats(allStudents.length);
+            renderStudents(data.results.slice(0, 50));
+            updateStats(totalStudents);
             statsBar.classList.remove('hidden');
         } catch (error) {
             console.error('Error fetching data:', error);
@@ -128,47 +137,32 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    function handleSearch(query) {
-        const rawTerm = query.toLowerCase().trim();
-        if (rawTerm === '') {
-            renderStudents(allStudents.slice(0, 50));
-            updateStats(allStudents.length);
-            noResultsState.classList.add('hidden');
-            return;
-        }
-
-        const terms = rawTerm.split(/\s+/).filter(t => t.length > 0);
-
-        const filtered = allStudents.filter(student => {
-            const name = (student.name || '').toLowerCase();
-            const group = (student.group || '').toLowerCase();
-            const dni = (student.dni || '').toLowerCase();
-
-            // Check if ALL terms are present in at least one of the fields combined
-            // Or better: Check if ALL terms match ANY of the fields? 
-            // Usually "Marc Garcia" -> "Marc" in Name AND "Garcia" in Name.
-            // But if I type "Marc B_2D", I want "Marc" in Name AND "B_2D" in Group.
-            // Simplest robust way: Combine all searchable text and check if all terms exist in it.
-
-            const searchableText = `${name} ${group} ${dni}`;
-            return terms.every(term => searchableText.includes(term));
-        });
+    async function handleSearch(query) {
+        // Search runs on the server (accent-insensitive, ranked); ignore out-of-order replies
+        const seq = ++searchSeq;
+        const rawTerm = query.trim();
+        try {
+            const data = await fetchStudents(rawTerm);
+            if (!data || seq !== searchSeq) return;
+            if (rawTerm === '') totalStudents = data.total;
 
-        renderStudents(filtered);
-        updateStats(filtered.length);
+            renderStudents(rawTerm === '' ? data.results.slice(0, 50) : data.results);
+            updateStats(data.total);
 
-        if (filtered.length === 0) {
-            noResultsState.classList.remove('hidden');
-            // Suggestion logic could go here
-        } else {
-            noResultsState.classList.add('hidden');
+            if (data.total === 0) {
+                noResultsState.classList.remove('hidden');
+            } else {
+                noResultsState.classList.add('hidden');
+            }
+        } catch (error) {
+            console.error('Error searching students:', error);
         }
     }
 
     function updateStats(count) {
         if (!countSpan || !statsBar) return;
         countSpan.textContent = count;
-        if (count > 0 && count < allStudents.length) {
+        if (count > 0 && count < totalStudents) {
             statsBar.classList.remove('hidden');
         } else {
             statsBar.classList.add('hidden');
@@ -182,6 +176,9 @@ document.addEventListener('DOMContentLoaded', () => {
             const card = createStudentCard(student);
             studentGrid.appendChild(card);
         });
+
+        // One request for all the exit counters of the rendered cards
+        updateExitCounts(studentsToRender.map(s => s.id));
     }
 
     function createStudentCard(student) {
@@ -261,9 +258,6 @@ document.addEventListener('DOMContentLoaded', () => {
             </div>
         `;
 
-        // Update exit count asynchronously
-        updateExitCount(student.id, card.querySelector('.count-val'));
-
         // Bind the click event correctly since inline onclick handles string limitation
         const btn = card.querySelector('.btn-exit');
         btn.onclick = () => openExitModal(student); // Pass full object
@@ -271,26 +265,35 @@ document.addEventListener('DOMContentLoaded', () => {
         return card;
     }
 
-    async function updateExitCount(studentId, element) {
+    async function updateExitCounts(studentIds) {
+        const ids = studentIds.filter(id => id);
+        if (ids.length === 0) return;
+
+        let counts = {};
         try {
-            const res = await fetch(`/api/student-history?id=${studentId}`);
-            if (res.ok) {
-                const data = await res.json();
-                element.textContent = data.count || 0;
+            const res = await fetch(`/api/student-history/batch?ids=${ids.map(encodeURIComponent).join(',')}`);
+            if (res.ok) counts = await res.json();
+        } catch (e) {
+            console.error('Error fetching exit counts:', e);
+        }
 
-                if (data.count > 0) {
-                    element.parentElement.classList.add('has-exits');
-                }
+        ids.forEach(studentId => {
+            const badge = document.getElementById(`counter-${studentId}`);
+            if (!badge) return;
+            const element = badge.querySelector('.count-val');
+            const data = counts[studentId] || { count: 0, monthlyCount: 0 };
+            element.textContent = data.count || 0;
 
-                // Recurrence Alert logic (Feature 6)
-                if (data.monthlyCount >= 3) {
-                    const alertElem = document.getElementById(`recurrence-${studentId}`);
-                    if (alertElem) alertElem.classList.remove('hidden');
-                }
+            if (data.count > 0) {
+                badge.classList.add('has-exits');
             }
-        } catch (e) {
-            element.textContent = '0';
-        }
+
+            // Recurrence Alert logic (Feature 6)
+            if (data.monthlyCount >= 3) {
+                const alertElem = document.getElementById(`recurrence-${studentId}`);
+                if (alertElem) alertElem.classList.remove('hidden');
+            }
+        });
     }
 
     // Modal Elements & Functions
@@ -340,6 +343,8 @@ document.addEventListener('DOMContentLoaded', () => {
         document.querySelector('input[name="accompaniedBy"][value="Solo"]').checked = true;
         checkVuelve.checked = false;
         hoursContainer.classList.add('hidden');
+        document.getElementById('checkWholeGroup').checked = false;
+        document.getElementById('wholeGroupName').textContent = student.group || '';
         document.querySelectorAll('input[name="period"]').forEach(cb => cb.checked = false);
 
         saveBtn.classList.remove('hidden');
@@ -395,6 +400,10 @@ document.addEventListener('DOMContentLoaded', () => {
             saveBtn.disabled = true;
 
             if (!csrfToken) await refreshCsrfToken();
+            if (document.getElementById('checkWholeGroup').checked) {
+                await saveGroupExit({ group: selectedStudent.group, motive, accompaniedBy: accompaniedVal, vuelve, horas });
+                return;
+            }
             const res = await fetch(API_URL, {
                 method: 'POST',
                 headers: {
@@ -436,10 +445,11 @@ document.addEventListener('DOMContentLoaded', () => {
 
                 // Show notified teachers in toast
                 const dataRes = await res.json().catch(() => ({}));
+                if (dataRes.ticketId) ownTickets.add(dataRes.ticketId);
                 const notified = dataRes.notified || [];
                 let successMsg = 'Salida registrada correctamente.';
                 if (notified.length > 0) {
-                    successMsg += '\nEmails enviados a: ' + notified.join(', ');
+                    successMsg += '\nAvisos en cola para: ' + notified.join(', ');
                 } else {
                     successMsg += '\nAviso: No se encontraron profesores para notificar.';
                 }
@@ -466,6 +476,39 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    async function saveGroupExit(payload) {
+        if (!payload.group) {
+            showToast('El alumno no tiene grupo asignado.', 'error');
+            return;
+        }
+        if (!confirm(`¿Registrar la salida de todo el grupo ${payload.group}?`)) return;
+
+        const res = await fetch(GROUP_EXIT_URL, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': csrfToken
+            },
+            body: JSON.stringify(payload)
+        });
+        const dataRes = await res.json().catch(() => ({}));
+        if (!res.ok) {
+            showToast('Error al guardar: ' + (dataRes.error || `Error del servidor (${res.status})`), 'error');
+            return;
+        }
+
+        (dataRes.tickets || []).forEach(t => ownTickets.add(t.ticketId));
+        const notified = dataRes.notified || [];
+        let successMsg = `${dataRes.count} salidas registradas para ${payload.group}.`;
+        successMsg += notified.length > 0 ? '\nAvisos en cola para: ' + notified.join(', ') : '\nAviso: No se encontraron profesores para notificar.';
+        showToast(successMsg, 'success');
+
+        // All the tickets in one PDF, one page per student
+        if (dataRes.batchPdf) window.open(`/pdfs/${encodeURIComponent(dataRes.batchPdf)}`, '_blank');
+        closeModal();
+        handleSearch(searchInput.value);
+    }
+
     // History Logic
     const historyBtn = document.getElementById('historyBtn');
     const historyModal = document.getElementById('historyModal');
@@ -473,12 +516,16 @@ document.addEventListener('DOMContentLoaded', () => {
     const historyTableBody = document.getElementById('historyTableBody');
     const historySearchInput = document.getElementById('historySearchInput');
     const exportBtn = document.getElementById('exportBtn');
+    const exportFormat = document.getElementById('exportFormat');
     const motiveFilter = document.getElementById('historyMotiveFilter');
     const dateFrom = document.getElementById('historyDateFrom');
     const dateTo = document.getElementById('historyDateTo');
     const clearFiltersBtn = document.getElementById('clearHistoryFilters');
 
     let allHistoryRecords = [];
+    let historyCursor = null;
+    let historySeq = 0;
+    let historySearchTimeout;
 
     if (historyBtn) historyBtn.addEventListener('click', openHistory);
     if (closeHistoryBtn) closeHistoryBtn.addEventListener('click', () => historyModal.classList.add('hidden'));
@@ -487,7 +534,10 @@ document.addEventListener('DOMContentLoaded', () => {
         if (e.target === historyModal) historyModal.classList.add('hidden');
     });
 
-    if (historySearchInput) historySearchInput.addEventListener('input', () => applyHistoryFilters());
+    if (historySearchInput) historySearchInput.addEventListener('input', () => {
+        clearTimeout(historySearchTimeout);
+        historySearchTimeout = setTimeout(applyHistoryFilters, 300);
+    });
     if (motiveFilter) motiveFilter.addEventListener('change', () => applyHistoryFilters());
     if (dateFrom) dateFrom.addEventListener('change', () => applyHistoryFilters());
     if (dateTo) dateTo.addEventListener('change', () => applyHistoryFilters());
@@ -540,8 +590,22 @@ document.addEventListener('DOMContentLoaded', () => {
             });
 
             if (res.ok) {
-                const data = await res.json();
-                showToast(`Se han actualizado ${data.count} alumnos correctamente.`, 'success');
+                // The import runs as a background job on the server; poll until it finishes
+                const { jobId } = await res.json();
+                const job = await waitForJob(jobId, (progress, message) => {
+                    uploadBtn.innerHTML = `<i class="ph-bold ph-spinner ph-spin"></i> ${message || 'Procesando'}... ${progress}%`;
+                });
+                if (job.status !== 'done') {
+                    showToast('Error: ' + (job.message || 'No se pudo procesar el archivo'), 'error');
+                    return;
+                }
+                const data = job.result;
+                let msg = `Se han cargado ${data.count} alumnos (${data.added} nuevos, ${data.changed} modificados, ${data.removed} eliminados).`;
+                if (data.errorCount > 0) {
+                    const firstErrors = data.errors.slice(0, 3).map(e => `fila ${e.row}: ${e.error}`).join('; ');
+                    msg += `\n${data.errorCount} filas con errores (${firstErrors}${data.errorCount > 3 ? '...' : ''})`;
+                }
+                showToast(msg, data.errorCount > 0 ? 'warning' : 'success');
                 fetchData();
             } else {
                 const data = await res.json();
@@ -557,150 +621,155 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
-    if (exportBtn) exportBtn.addEventListener('click', exportHistoryToCSV);
+    async function waitForJob(jobId, onProgress) {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const res = await fetch(`/api/jobs/${jobId}`);
+            if (!res.ok) throw new Error(`Error ${res.status} al consultar la tarea`);
+            const job = await res.json();
+            if (job.status === 'done' || job.status === 'error') return job;
+            onProgress(job.progress || 0, job.message);
+        }
+    }
+
+    if (exportBtn) exportBtn.addEventListener('click', exportHistory);
 
     async function openHistory() {
         historyModal.classList.remove('hidden');
-        historyTableBody.innerHTML = '<tr><td colspan="9" style="text-align:center">Cargando...</td></tr>';
+        await loadHistory(true);
+    }
+
+    function historyFilterParams() {
+        const params = new URLSearchParams();
+        const term = historySearchInput ? historySearchInput.value.trim() : '';
+        if (term) params.set('q', term);
+        if (motiveFilter && motiveFilter.value !== 'all') params.set('motive', motiveFilter.value);
+        if (dateFrom && dateFrom.value) params.set('from', dateFrom.value);
+        if (dateTo && dateTo.value) params.set('to', dateTo.value);
+        return params;
+    }
+
+    // Filtering, paging and stats are done by the server; the table asks for one page at a time
+    async function loadHistory(reset) {
+        const seq = reset ? ++historySeq : historySeq;
+        const params = historyFilterParams();
+        if (reset) {
+            historyCursor = null;
+            allHistoryRecords = [];
+            historyTableBody.innerHTML = '<tr><td colspan="9" style="text-align:center">Cargando...</td></tr>';
+            loadHistoryStats(params, seq);
+        } else if (historyCursor) {
+            params.set('cursor', historyCursor);
+        }
+
         try {
-            const res = await fetch('/api/history');
+            const res = await fetch(`/api/history?${params}`);
             if (!res.ok) throw new Error('Error al cargar historial');
-            allHistoryRecords = await res.json();
-            renderHistory(allHistoryRecords);
+            const data = await res.json();
+            if (seq !== historySeq) return;
+            allHistoryRecords = allHistoryRecords.concat(data.records);
+            historyCursor = data.nextCursor;
+            renderHistory(data.records, !reset);
         } catch (e) {
             console.error(e);
             historyTableBody.innerHTML = '<tr><td colspan="9" style="text-align:center; color: #ef4444;">Error de conexión</td></tr>';
         }
     }
 
-    function renderHistory(records) {
-        updateHistoryStats(records);
-        historyTableBody.innerHTML = '';
-        if (records.length === 0) {
+    async function loadHistoryStats(params, seq) {
+        try {
+            const res = await fetch(`/api/history/stats?${params}`);
+            if (!res.ok) throw new Error('Error al cargar estadísticas');
+            const stats = await res.json();
+            if (seq === historySeq) updateHistoryStats(stats);
+        } catch (e) {
+            console.error(e);
+        }
+    }
+
+    function renderHistory(records, append = false) {
+        const moreRow = document.getElementById('historyMoreRow');
+        if (moreRow) moreRow.remove();
+        if (!append) historyTableBody.innerHTML = '';
+        if (!append && records.length === 0) {
             historyTableBody.innerHTML = '<tr><td colspan="9" style="text-align:center">No hay registros</td></tr>';
             return;
         }
 
-        records.forEach(row => {
-            const tr = document.createElement('tr');
-            const pdfFile = row['PDF'] || '';
-            const vuelve = row['Vuelve'] || '-';
-            const horas = row['Horas'] ? `${row['Horas']}` : '-';
-
-            tr.innerHTML = `
-                <td>${row['Fecha'] || '-'}</td>
-                <td>${row['Hora'] || '-'}</td>
-                <td>${row['Nombre'] || '-'}</td>
-                <td><span class="group-badge small">${row['Grupo'] || '-'}</span></td>
-                <td>${row['Motivo'] || '-'}</td>
-                <td>${row['Detalle Acompañante'] || row['Acompañante'] || '-'}</td>
-                <td>${vuelve === 'Sí' ? `<span style="color:#d8b4fe">Sí (${horas})</span>` : 'No'}</td>
-                <td>
-                    ${pdfFile ? `<a href="/pdfs/${pdfFile}" target="_blank" class="pdf-link"><i class="ph-bold ph-file-pdf"></i> PDF</a>` : '-'}
-                </td>
-                <td class="row-actions">
-                </td>
-            `;
-
-            if (pdfFile) {
-                const btn = document.createElement('button');
-                btn.className = 'btn-icon-small delete-btn';
-                btn.innerHTML = '<i class="ph ph-trash"></i>';
-                btn.title = 'Eliminar registro';
-                btn.onclick = () => window.deleteRecord(pdfFile);
-                tr.querySelector('.row-actions').appendChild(btn);
-            } else {
-                tr.querySelector('.row-actions').textContent = '-';
-            }
+        records.forEach(row => historyTableBody.appendChild(createHistoryRow(row)));
 
+        if (historyCursor) {
+            const tr = document.createElement('tr');
+            tr.id = 'historyMoreRow';
+            tr.innerHTML = '<td colspan="9" style="text-align:center"><button class="btn-icon-small">Cargar más</button></td>';
+            tr.querySelector('button').onclick = () => loadHistory(false);
             historyTableBody.appendChild(tr);
-        });
+        }
     }
 
-    function applyHistoryFilters() {
-        const term = historySearchInput.value.toLowerCase().trim();
-        const motive = motiveFilter.value;
-        const from = dateFrom.value;
-        const to = dateTo.value;
-
-        const filtered = allHistoryRecords.filter(row => {
-            // Search term (DNI, Name, Group)
-            const searchable = `${row['Nombre']} ${row['Grupo']} ${row['DNI Alumno']} ${row['ID Alumno']}`.toLowerCase();
-            const matchesTerm = !term || searchable.includes(term);
-
-            // Motive
-            const matchesMotive = motive === 'all' || row['Motivo'] === motive;
+    function createHistoryRow(row) {
+        const tr = document.createElement('tr');
+        tr.dataset.pdf = row['PDF'] || '';
+        tr.dataset.ticket = row['TicketID'] || '';
+        const pdfFile = tr.dataset.pdf;
+        const vuelve = row['Vuelve'] || '-';
+        const horas = row['Horas'] ? `${row['Horas']}` : '-';
+        const returned = row['HaVuelto'] === 'Sí';
+
+        tr.innerHTML = `
+            <td>${row['Fecha'] || '-'}</td>
+            <td>${row['Hora'] || '-'}</td>
+            <td>${row['Nombre'] || '-'}</td>
+            <td><span class="group-badge small">${row['Grupo'] || '-'}</span></td>
+            <td>${row['Motivo'] || '-'}</td>
+            <td>${row['Detalle Acompañante'] || row['Acompañante'] || '-'}</td>
+            <td>${vuelve === 'Sí' ? `<span style="color:#d8b4fe">Sí (${horas})</span>${returned ? ' <i class="ph-bold ph-check" title="Ha vuelto" style="color:#86efac"></i>' : ''}` : 'No'}</td>
+            <td>
+                ${pdfFile ? `<a href="/pdfs/${pdfFile}" target="_blank" class="pdf-link"><i class="ph-bold ph-file-pdf"></i> PDF</a>` : '-'}
+            </td>
+            <td class="row-actions">
+            </td>
+        `;
 
-            // Date range
-            const rowDate = row['Fecha']; // YYYY-MM-DD
-            const matchesFrom = !from || rowDate >= from;
-            const matchesTo = !to || rowDate <= to;
+        if (vuelve === 'Sí' && !returned && row['TicketID']) {
+            const btn = document.createElement('button');
+            btn.className = 'btn-icon-small';
+            btn.innerHTML = '<i class="ph ph-sign-in"></i>';
+            btn.title = 'Marcar regreso';
+            btn.onclick = () => window.markReturned(row['TicketID']);
+            tr.querySelector('.row-actions').appendChild(btn);
+        }
 
-            return matchesTerm && matchesMotive && matchesFrom && matchesTo;
-        });
+        if (pdfFile) {
+            const btn = document.createElement('button');
+            btn.className = 'btn-icon-small delete-btn';
+            btn.innerHTML = '<i class="ph ph-trash"></i>';
+            btn.title = 'Eliminar registro';
+            btn.onclick = () => window.deleteRecord(pdfFile);
+            tr.querySelector('.row-actions').appendChild(btn);
+        } else {
+            tr.querySelector('.row-actions').textContent = '-';
+        }
 
-        renderHistory(filtered);
+        return tr;
     }
 
-    function updateHistoryStats(records) {
-        const now = new Date();
-        const todayStr = now.toISOString().split('T')[0];
-
-        // Start of week (Monday)
-        const tempDate = new Date();
-        const day = tempDate.getDay();
-        const diff = tempDate.getDate() - day + (day === 0 ? -6 : 1);
-        const startOfWeek = new Date(tempDate.setDate(diff));
-        startOfWeek.setHours(0, 0, 0, 0);
-
-        const startOfMonth = new Date(now.getFullYear(), now.getMonth(), 1);
-
-        let todayCount = 0;
-        let weekCount = 0;
-        let monthCount = 0;
-
-        // Data for trends (Feature 5)
-        const dayCounts = { 'Lun': 0, 'Mar': 0, 'Mié': 0, 'Jue': 0, 'Vie': 0 };
-        const hourCounts = { '1ª': 0, '2ª': 0, '3ª': 0, 'Recreo': 0, '4ª': 0, '5ª': 0, '6ª': 0 };
-
-        records.forEach(row => {
-            if (!row['Fecha']) return;
-            const rowDate = new Date(row['Fecha']);
-
-            // Stats
-            if (row['Fecha'] === todayStr) todayCount++;
-            if (rowDate >= startOfWeek) weekCount++;
-            if (rowDate >= startOfMonth) monthCount++;
-
-            // Trends mapping
-            const dayIdx = rowDate.getDay(); // 0=Sun, 1=Mon...
-            const dayNames = ['Dom', 'Lun', 'Mar', 'Mié', 'Jue', 'Vie', 'Sáb'];
-            if (dayCounts[dayNames[dayIdx]] !== undefined) dayCounts[dayNames[dayIdx]]++;
-
-            const time = row['Hora'] || '';
-            let session = '';
-            if (time >= '08:00' && time < '09:25') session = '1ª';
-            else if (time >= '09:25' && time < '10:20') session = '2ª';
-            else if (time >= '10:20' && time < '11:15') session = '3ª';
-            else if (time >= '11:15' && time < '11:45') session = 'Recreo';
-            else if (time >= '11:45' && time < '12:40') session = '4ª';
-            else if (time >= '12:40' && time < '13:35') session = '5ª';
-            else if (time >= '13:35' && time < '14:30') session = '6ª';
-
-            if (session && hourCounts[session] !== undefined) hourCounts[session]++;
-        });
+    function applyHistoryFilters() {
+        loadHistory(true);
+    }
 
-        document.getElementById('histStatToday').textContent = todayCount;
-        document.getElementById('histStatWeek').textContent = weekCount;
-        document.getElementById('histStatMonth').textContent = monthCount;
-        document.getElementById('histStatTotal').textContent = records.length;
+    function updateHistoryStats(stats) {
+        document.getElementById('histStatToday').textContent = stats.today;
+        document.getElementById('histStatWeek').textContent = stats.week;
+        document.getElementById('histStatMonth').textContent = stats.month;
+        document.getElementById('histStatTotal').textContent = stats.total;
 
         // Render Charts
         const trends = document.getElementById('trendsSection');
-        if (records.length > 0) {
+        if (stats.total > 0) {
             trends.classList.remove('hidden');
-            renderBarChart('daysChart', dayCounts);
-            renderBarChart('hoursChart', hourCounts);
+            renderBarChart('daysChart', Object.fromEntries(stats.days.map(d => [d.label, d.count])));
+            renderBarChart('hoursChart', Object.fromEntries(stats.sessions.map(s => [s.label, s.count])));
         } else {
             trends.classList.add('hidden');
         }
@@ -724,26 +793,15 @@ document.addEventListener('DOMContentLoaded', () => {
         }).join('');
     }
 
-    function exportHistoryToCSV() {
-        if (!allHistoryRecords || allHistoryRecords.length === 0) return;
-        const term = historySearchInput ? historySearchInput.value.toLowerCase().trim() : '';
-        let dataToExport = term ? allHistoryRecords.filter(row => {
-            const name = (row['Nombre'] || '').toLowerCase();
-            const group = (row['Grupo'] || '').toLowerCase();
-            const dni = (row['DNI Alumno'] || '').toLowerCase();
-            return name.includes(term) || group.includes(term) || dni.includes(term);
-        }) : allHistoryRecords;
-
-        const headers = Object.keys(dataToExport[0]);
-        const csvRows = [headers.join(',')];
-        for (const row of dataToExport) {
-            csvRows.push(headers.map(header => `"${('' + (row[header] || '')).replace(/"/g, '""')}"`).join(','));
-        }
-        const blob = new Blob([csvRows.join('\n')], { type: 'text/csv;charset=utf-8;' });
-        const url = URL.createObjectURL(blob);
+    // The server streams the export with the current filters; the browser saves it as it arrives
+    function exportHistory() {
+        const params = historyFilterParams();
+        const [format, pdfs] = (exportFormat ? exportFormat.value : 'csv').split('+');
+        params.set('format', format);
+        if (pdfs) params.set('pdfs', '1');
         const link = document.createElement('a');
-        link.setAttribute('href', url);
-        link.setAttribute('download', `historial_salidas_${new Date().toISOString().slice(0, 10)}.csv`);
+        link.href = `/api/history/export?${params}`;
+        link.setAttribute('download', '');
         link.click();
     }
 
@@ -771,6 +829,118 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Live Events: exits, returns and deletions from every desk, polled from /api/events
+    const ownTickets = new Set();
+
+    // Same matching as the server's history search: case and accents ignored
+    const foldText = text => (text || '').toLowerCase().normalize('NFKD').replace(/[\u0300-\u036f]/g, '');
+
+    function historyRecordMatches(record) {
+        const params = historyFilterParams();
+        if (params.get('motive') && record['Motivo'] !== params.get('motive')) return false;
+        if (params.get('from') && record['Fecha'] < params.get('from')) return false;
+        if (params.get('to') && record['Fecha'] > params.get('to')) return false;
+        const term = foldText(params.get('q'));
+        return !term || ['Nombre', 'Grupo', 'DNI Alumno', 'ID Alumno'].some(k => foldText(record[k]).includes(term));
+    }
+
+    // A group exit arrives as one event per student: refresh their counters (and the
+    // history stats) once for the whole burst, with a single batch request
+    const pendingCountIds = new Set();
+    let pendingRefreshTimer = null;
+
+    function queueLiveRefresh(studentId) {
+        if (studentId) pendingCountIds.add(studentId);
+        if (pendingRefreshTimer) return;
+        pendingRefreshTimer = setTimeout(() => {
+            const ids = [...pendingCountIds];
+            pendingCountIds.clear();
+            pendingRefreshTimer = null;
+            updateExitCounts(ids);
+            if (!historyModal.classList.contains('hidden')) loadHistoryStats(historyFilterParams(), historySeq);
+        }, 300);
+    }
+
+    function handleLiveExit(record) {
+        queueLiveRefresh(record['ID Alumno']);
+        const fromThisDesk = ownTickets.has(record['TicketID']) ||
+            (!modal.classList.contains('hidden') && selectedStudent && selectedStudent.id === record['ID Alumno']);
+        if (!fromThisDesk) showToast(`Nueva salida: ${record['Nombre']} (${record['Grupo']})`, 'warning');
+
+        if (historyModal.classList.contains('hidden')) return;
+        if (historyRecordMatches(record)) {
+            if (allHistoryRecords.length === 0) historyTableBody.innerHTML = '';
+            allHistoryRecords.unshift(record);
+            historyTableBody.prepend(createHistoryRow(record));
+        }
+    }
+
+    function handleLiveDelete(data) {
+        allHistoryRecords = allHistoryRecords.filter(r => !data.pdfs.includes(r['PDF']));
+        historyTableBody.querySelectorAll('tr[data-pdf]').forEach(tr => {
+            if (data.pdfs.includes(tr.dataset.pdf)) tr.remove();
+        });
+        queueLiveRefresh(null);
+    }
+
+    function handleLiveReturn(data) {
+        const record = allHistoryRecords.find(r => r['TicketID'] === data.ticketId);
+        if (!record) return;
+        record['HaVuelto'] = 'Sí';
+        historyTableBody.querySelectorAll('tr[data-ticket]').forEach(tr => {
+            if (tr.dataset.ticket === data.ticketId) tr.replaceWith(createHistoryRow(record));
+        });
+    }
+
+    const liveHandlers = {
+        exit: data => handleLiveExit(data.record),
+        delete: handleLiveDelete,
+        return: handleLiveReturn
+    };
+
+    async function pollLiveEvents() {
+        // Short long-poll: the server answers within a few seconds, or says how long to wait when busy
+        let since = -1;
+        while (true) {
+            let delay = 0;
+            try {
+                const res = await fetch(`/api/events?since=${since}`);
+                if (res.status === 401) return;
+                if (!res.ok) throw new Error(`HTTP ${res.status}`);
+                const data = await res.json();
+                data.events.forEach(e => liveHandlers[e.kind] && liveHandlers[e.kind](e.data));
+                since = data.last;
+                delay = data.retry * 1000;
+            } catch (e) {
+                console.error('Error polling live events:', e);
+                delay = 5000;
+            }
+            if (delay) await new Promise(resolve => setTimeout(resolve, delay));
+        }
+    }
+
+    pollLiveEvents();
+
+    window.markReturned = async function (ticketId) {
+        if (!csrfToken) await refreshCsrfToken();
+        try {
+            const res = await fetch(`/api/exits/${encodeURIComponent(ticketId)}/return`, {
+                method: 'POST',
+                headers: { 'X-CSRFToken': csrfToken }
+            });
+            if (res.ok) {
+                handleLiveReturn({ ticketId });
+                showToast('Regreso registrado.', 'success');
+            } else {
+                const errorData = await res.json().catch(() => ({}));
+                showToast(`No se pudo registrar el regreso: ${errorData.error || `Error ${res.status}`}`, 'error');
+            }
+        } catch (e) {
+            console.error(e);
+            showToast('Error al conectar con el servidor.', 'error');
+        }
+    }
+
     function showToast(message, type = 'success') {
         const toast = document.createElement('div');
         toast.className = `toast toast-${type}`;
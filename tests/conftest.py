@@ -0,0 +1,116 @@
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+import pytest
+from cryptography.fernet import Fernet
+
+# server.py reads its configuration and opens its databases when it is imported:
+# point it at a throwaway data dir first. Everything a local .env could set is
+# pinned here, so the tests never touch real data or send real email.
+_tmp = tempfile.mkdtemp(prefix="partesSalida-tests-")
+os.environ.update({
+    "STUDENTS_DATA_KEY": Fernet.generate_key().decode(),
+    "SECRET_KEY": "tests",
+    "DEBUG": "1",
+    "DATA_PATH": os.path.join(_tmp, "data"),
+    "PDF_PATH": os.path.join(_tmp, "pdfs"),
+    "PDF_CACHE_PATH": os.path.join(_tmp, "pdfs", "cache"),
+    "TIMETABLE_PATH": os.path.join(_tmp, "data", "horarios_profesores_limpio.json"),
+    "AUTHORIZED_EMAILS": "guardia@example.com",
+    "GUARDIAN_EMAILS": "",
+    "SMTP_USER": "", "SMTP_PASS": "",
+    "SHARED_DATA": "0", "STARTUP_MODE": "lazy", "PDF_MODE": "eager",
+    "SECURE_JSON_FORMAT": "", "NOTIFY_DIGEST_MINUTES": "0",
+    "RATELIMIT_STORAGE_URL": "memory://", "METRICS_TOKEN": "",
+})
+os.environ.pop("SHARED_DATA_PATH", None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+LOGIN_EMAIL = "guardia@example.com"
+# A Monday during the school day (second session) in the default schedule
+SCHOOL_NOW = datetime(2026, 10, 19, 9, 0, 5)
+
+STUDENTS = [
+    {"id": "1001", "name": "García López, Ana", "group": "E_1A", "dni": "11111111H", "tutor1": {"name": "Rosa López"}},
+    {"id": "1002", "name": "Peñalver Martínez, Íñigo", "group": "E_1A", "dni": "22222222J", "tutor1": {"name": "Juan Peñalver"}},
+    {"id": "1003", "name": "Benaisa Hammu, Nayat", "group": "E_1A", "dni": "33333333P"},
+    {"id": "2001", "name": "Ruiz Núñez, Hugo", "group": "B_2C", "dni": "44444444A"},
+]
+
+TIMETABLE = [
+    {"nombre": "Profesora Lengua", "email": "lengua@example.com",
+     "horario": [{"tramo": "Sesión 2", "Lunes": {"grupo": "E_1A"}}, {"tramo": "Sesión 3", "Lunes": {"grupo": "E_1A"}}]},
+    {"nombre": "Profesor Mates", "email": "mates@example.com",
+     "horario": [{"tramo": "Sesión 2", "Lunes": {"grupo": "B_2C"}}]},
+]
+
+@pytest.fixture(autouse=True)
+def clean_store(monkeypatch):
+    """Empty exit log, counters, aggregates, events, outbox and PDF dir for every test.
+    No background threads: outbox rows stay pending so the tests can read them."""
+    monkeypatch.setattr(server, "ensure_background_workers", lambda: None)
+    with server.get_exit_db() as conn:
+        for table in ("exits", "exit_counters", "exit_daily", "events", "outbox"):
+            conn.execute(f"DELETE FROM {table}")
+    with server.get_session_db() as conn:
+        conn.execute("DELETE FROM sessions")
+        conn.execute("DELETE FROM login_tokens")
+    for entry in os.scandir(server.PDF_DIR):
+        if entry.is_file():
+            os.remove(entry.path)
+    server._active_exits = {"date": None, "event_id": 0, "by_ticket": {}, "by_student": {}, "by_session": {}}
+    yield
+
+@pytest.fixture
+def roster():
+    server.save_secure_json(server.STUDENTS_FILE, STUDENTS)
+    server.publish_students(STUDENTS)
+    server.save_secure_json(server.TIMETABLE_PATH, TIMETABLE)
+    server.refresh_timetable_index(force=True)
+    return STUDENTS
+
+@pytest.fixture
+def school_now(monkeypatch):
+    """Freezes server.datetime.now() at SCHOOL_NOW. List it before `client`, so the
+    session is created at the frozen time too and doesn't look expired."""
+    class FrozenDateTime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return cls.fromisoformat(SCHOOL_NOW.isoformat())
+    monkeypatch.setattr(server, "datetime", FrozenDateTime)
+    return SCHOOL_NOW
+
+def csrf_token(client):
+    return client.get('/api/csrf-token').get_json()['csrf_token']
+
+def log_in(client):
+    """Real login: a token for LOGIN_EMAIL, then /api/login with the CSRF header."""
+    token = csrf_token(client)
+    expires = server.db_timestamp(datetime.now().replace(year=datetime.now().year + 1))
+    with server.get_session_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO login_tokens (email, token, expires_at) VALUES (?, ?, ?)",
+                     (LOGIN_EMAIL, "123456", expires))
+    response = client.post('/api/login', json={"email": LOGIN_EMAIL, "token": "123456"},
+                           headers={"X-CSRFToken": token})
+    assert response.status_code == 200, response.get_json()
+    client.environ_base["HTTP_X_CSRFTOKEN"] = token
+    return token
+
+@pytest.fixture
+def client():
+    """Logged-in test client that sends the CSRF header on every request."""
+    test_client = server.app.test_client()
+    log_in(test_client)
+    return test_client
+
+def exit_record(student, when, motive="Cita médica", **extra):
+    """Exit log record for a student at a datetime, as register_exit builds it."""
+    record = server.make_exit_record({"studentId": student["id"], "studentName": student["name"],
+                                      "group": student.get("group", ""), "dni": student.get("dni", ""),
+                                      "motive": motive, "accompaniedBy": "Solo"}, when)
+    record.update(extra)
+    return record
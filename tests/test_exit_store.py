@@ -0,0 +1,120 @@
+from datetime import datetime
+
+import server
+from conftest import STUDENTS, exit_record
+
+ANA, INIGO = STUDENTS[0], STUDENTS[1]
+
+def live_pdfs():
+    return [r['pdf'] for r in server.get_exit_db().execute(f"SELECT pdf FROM exits WHERE {server.LIVE_EXITS} ORDER BY id")]
+
+def daily_rows():
+    return server.get_exit_db().execute(
+        "SELECT date, group_name, motive, session, student_id, count FROM exit_daily ORDER BY date, student_id").fetchall()
+
+def rebuilt_daily_rows():
+    with server.get_exit_db() as conn:
+        conn.execute("DELETE FROM store_meta WHERE key = 'daily_built'")
+    server.ensure_exit_daily()
+    return daily_rows()
+
+def test_delete_tombstones_the_record_and_keeps_the_row():
+    first, second = exit_record(ANA, datetime(2026, 10, 19, 9, 0)), exit_record(ANA, datetime(2026, 10, 20, 9, 0))
+    server.add_exit_records([first, second])
+
+    deleted = server.delete_exit_records({first['PDF']})
+
+    assert [r['pdf'] for r in deleted] == [first['PDF']]
+    assert live_pdfs() == [second['PDF']]
+    row = server.get_exit_db().execute("SELECT deleted_at FROM exits WHERE pdf = ?", (first['PDF'],)).fetchone()
+    assert row['deleted_at'] != ''
+    # Deleting again finds nothing live
+    assert server.delete_exit_records({first['PDF']}) == []
+
+def test_compaction_purges_only_old_tombstones():
+    old, recent = exit_record(ANA, datetime(2026, 10, 19, 9, 0)), exit_record(ANA, datetime(2026, 10, 20, 9, 0))
+    server.add_exit_records([old, recent])
+    server.delete_exit_records({old['PDF'], recent['PDF']})
+    with server.get_exit_db() as conn:
+        conn.execute("UPDATE exits SET deleted_at = '2000-01-01T00:00:00' WHERE pdf = ?", (old['PDF'],))
+
+    assert server.compact_exit_store() == 1
+    remaining = [r['pdf'] for r in server.get_exit_db().execute("SELECT pdf FROM exits")]
+    assert remaining == [recent['PDF']]
+
+def test_counters_follow_adds_and_deletes():
+    this_month = datetime.now().replace(day=1, hour=9, minute=0, second=0, microsecond=0)
+    records = [exit_record(ANA, this_month.replace(minute=m)) for m in range(3)]
+    records.append(exit_record(ANA, datetime(2020, 1, 10, 9, 0)))
+    records.append(exit_record(INIGO, this_month))
+    server.add_exit_records(records)
+
+    assert server.get_exit_counts([ANA['id'], INIGO['id'], 'nobody']) == {
+        ANA['id']: {"count": 4, "monthlyCount": 3},
+        INIGO['id']: {"count": 1, "monthlyCount": 1},
+        'nobody': {"count": 0, "monthlyCount": 0},
+    }
+
+    server.delete_exit_records({records[0]['PDF'], records[4]['PDF']})
+    assert server.get_exit_counts([ANA['id'], INIGO['id']]) == {
+        ANA['id']: {"count": 3, "monthlyCount": 2},
+        INIGO['id']: {"count": 0, "monthlyCount": 0},
+    }
+    # No empty counter rows are left behind
+    assert server.get_exit_db().execute("SELECT COUNT(*) FROM exit_counters WHERE count <= 0").fetchone()[0] == 0
+
+def test_counters_match_a_rebuild():
+    records = [exit_record(s, datetime(2026, 10, 19 + i, 9, 0)) for i, s in enumerate(STUDENTS)]
+    server.add_exit_records(records)
+    server.delete_exit_records({records[1]['PDF']})
+    conn = server.get_exit_db()
+    incremental = conn.execute("SELECT * FROM exit_counters ORDER BY student_id, month").fetchall()
+    with conn:
+        server.rebuild_exit_counters(conn)
+    assert [tuple(r) for r in conn.execute("SELECT * FROM exit_counters ORDER BY student_id, month")] == \
+        [tuple(r) for r in incremental]
+
+def test_counters_endpoint(client, roster):
+    server.add_exit_records([exit_record(ANA, datetime.now())])
+    response = client.get(f"/api/student-history/batch?ids={ANA['id']},{INIGO['id']}")
+    assert response.get_json() == {ANA['id']: {"count": 1, "monthlyCount": 1}, INIGO['id']: {"count": 0, "monthlyCount": 0}}
+
+def test_daily_aggregates_follow_adds_and_deletes():
+    monday = datetime(2026, 10, 19, 9, 0)  # Sesión 2
+    first, second = exit_record(ANA, monday), exit_record(ANA, monday.replace(minute=5))
+    other = exit_record(INIGO, monday.replace(hour=12, minute=0), motive="Enfermedad")  # Sesión 5
+    server.add_exit_records([first, second, other])
+
+    assert [tuple(r) for r in daily_rows()] == [
+        ("2026-10-19", "E_1A", "Cita médica", "Sesión 2", ANA['id'], 2),
+        ("2026-10-19", "E_1A", "Enfermedad", "Sesión 5", INIGO['id'], 1),
+    ]
+
+    server.delete_exit_records({first['PDF'], other['PDF']})
+    assert [tuple(r) for r in daily_rows()] == [("2026-10-19", "E_1A", "Cita médica", "Sesión 2", ANA['id'], 1)]
+    assert [tuple(r) for r in rebuilt_daily_rows()] == [tuple(r) for r in daily_rows()]
+
+def test_report_uses_the_daily_aggregates(client, roster):
+    monday = datetime(2026, 10, 19, 9, 0)
+    records = [exit_record(ANA, monday), exit_record(ANA, monday.replace(minute=1)), exit_record(INIGO, monday)]
+    server.add_exit_records(records)
+    server.delete_exit_records({records[2]['PDF']})
+
+    report = client.get('/api/reports?from=2026-10-01&to=2026-10-31').get_json()
+
+    assert report["total"] == 2
+    assert report["students"] == [{"studentId": ANA['id'], "name": ANA['name'], "group": "E_1A", "count": 2}]
+    assert report["groups"][0]["group"] == "E_1A"
+    assert report["groups"][0]["students"] == 3
+    assert report["motives"] == [{"motive": "Cita médica", "count": 2}]
+
+def test_report_ignores_roster_records_without_group(client, roster):
+    students = STUDENTS + [{"id": "9999", "name": "Sin grupo"}]
+    server.save_secure_json(server.STUDENTS_FILE, students)
+    server.publish_students(students)
+    server.add_exit_records([exit_record(ANA, datetime(2026, 10, 19, 9, 0))])
+
+    response = client.get('/api/reports?from=2026-10-01&to=2026-10-31')
+
+    assert response.status_code == 200
+    assert response.get_json()["total"] == 1
@@ -0,0 +1,94 @@
+import csv
+import io
+import os
+import zipfile
+from datetime import datetime, timedelta
+
+import openpyxl
+
+import server
+from conftest import STUDENTS, exit_record
+
+ANA, INIGO = STUDENTS[0], STUDENTS[1]
+
+def add_exits(student, count, start=datetime(2026, 10, 19, 8, 0), **extra):
+    records = [exit_record(student, start + timedelta(minutes=i), **extra) for i in range(count)]
+    server.add_exit_records(records)
+    return records
+
+def export(client, query):
+    response = client.get(f"/api/history/export?{query}")
+    assert response.status_code == 200, response.data[:200]
+    return response
+
+def csv_rows(data):
+    return list(csv.reader(io.StringIO(data.decode('utf-8'))))
+
+def test_csv_has_the_headers_and_the_filtered_rows_newest_first(client, monkeypatch):
+    monkeypatch.setattr(server, "EXPORT_BATCH_SIZE", 2)  # several batches
+    records = add_exits(ANA, 5)
+    add_exits(INIGO, 2, motive="Enfermedad")
+    server.delete_exit_records({records[0]['PDF']})
+
+    response = export(client, "format=csv&motive=Cita%20m%C3%A9dica")
+
+    assert response.content_type == server.EXPORT_FORMATS["csv"]
+    assert response.headers['Content-Disposition'].endswith('.csv"')
+    rows = csv_rows(response.data)
+    assert rows[0] == server.CSV_HEADERS
+    pdf = server.CSV_HEADERS.index('PDF')
+    assert [r[pdf] for r in rows[1:]] == [r['PDF'] for r in reversed(records[1:])]
+    assert rows[1][server.CSV_HEADERS.index('Nombre')] == ANA['name']
+
+def test_csv_search_matches_the_history_search(client):
+    add_exits(ANA, 1)
+    add_exits(INIGO, 2)
+
+    rows = csv_rows(export(client, "q=penalver").data)
+
+    assert len(rows) == 3
+    assert {r[server.CSV_HEADERS.index('Nombre')] for r in rows[1:]} == {INIGO['name']}
+
+def test_xlsx_opens_with_the_same_content_as_the_csv(client):
+    add_exits(ANA, 2)
+    add_exits(INIGO, 1, motive="Enfermedad <urgente> & \x01")
+
+    response = export(client, "format=xlsx")
+
+    assert response.content_type == server.EXPORT_FORMATS["xlsx"]
+    sheet = openpyxl.load_workbook(io.BytesIO(response.data)).active
+    values = [[cell if cell is not None else '' for cell in row] for row in sheet.iter_rows(values_only=True)]
+    assert sheet.title == "Salidas"
+    # Same as the CSV, except for the control characters XML can't hold
+    assert values == csv_rows(export(client, "format=csv").data.replace(b"\x01", b""))
+    assert values[1][server.CSV_HEADERS.index('Motivo')] == "Enfermedad <urgente> & "
+
+def test_invalid_format_is_rejected(client):
+    assert client.get("/api/history/export?format=pdf").status_code == 400
+
+def test_zip_has_the_history_and_each_ticket_once(client, roster):
+    records = add_exits(ANA, 2) + add_exits(INIGO, 1)
+    for record in records[:2]:
+        server.render_ticket(record, os.path.join(server.PDF_DIR, record['PDF']))
+    server.add_exit_records([exit_record(ANA, datetime(2026, 10, 19, 10, 0), PDF=records[0]['PDF'])])
+
+    response = export(client, "format=csv&pdfs=1")
+
+    assert response.content_type == 'application/zip'
+    assert response.headers['Content-Disposition'].endswith('.zip"')
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    # The third exit has no PDF on disk (eager mode): it is listed but not attached
+    assert sorted(archive.namelist()) == sorted(["historial_salidas.csv"] + [f"pdfs/{r['PDF']}" for r in records[:2]])
+    assert len(csv_rows(archive.read("historial_salidas.csv"))) == 5
+    for record in records[:2]:
+        with open(os.path.join(server.PDF_DIR, record['PDF']), 'rb') as f:
+            assert archive.read(f"pdfs/{record['PDF']}") == f.read()
+
+def test_zip_with_xlsx(client):
+    add_exits(ANA, 1)
+
+    archive = zipfile.ZipFile(io.BytesIO(export(client, "format=xlsx&pdfs=1").data))
+
+    assert archive.namelist() == ["historial_salidas.xlsx"]
+    sheet = openpyxl.load_workbook(io.BytesIO(archive.read("historial_salidas.xlsx"))).active
+    assert sheet.max_row == 2
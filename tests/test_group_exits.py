@@ -0,0 +1,99 @@
+import os
+
+import server
+from conftest import STUDENTS
+
+E_1A = [s for s in STUDENTS if s['group'] == 'E_1A']
+
+def outbox_rows():
+    return server.get_exit_db().execute("SELECT to_email, subject, body, ticket_id, item FROM outbox ORDER BY id").fetchall()
+
+def group_exit(client, **body):
+    payload = {"motive": "Excursión", "accompaniedBy": "Tutor1", "vuelve": True, "horas": "3ª"}
+    payload.update(body)
+    return client.post('/api/exits/group', json=payload)
+
+def test_group_exit_registers_every_student_in_one_batch(school_now, client, roster):
+    response = group_exit(client, group="E_1A")
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["count"] == len(E_1A)
+    assert sorted(t["studentId"] for t in body["tickets"]) == sorted(s['id'] for s in E_1A)
+    rows = server.get_exit_db().execute("SELECT student_id, batch_id, accompanied_detail FROM exits ORDER BY id").fetchall()
+    assert len({r['batch_id'] for r in rows}) == 1
+    assert body["batchPdf"] == f"lote_{rows[0]['batch_id']}.pdf"
+    assert dict((r['student_id'], r['accompanied_detail']) for r in rows)['1001'] == "Rosa López"
+    assert server.get_exit_counts(['1001'])['1001']['count'] == 1
+    # One event per student for the live board
+    assert server.get_exit_db().execute("SELECT COUNT(*) FROM events WHERE kind = 'exit'").fetchone()[0] == len(E_1A)
+
+def test_group_exit_writes_the_tickets_and_serves_the_batch(school_now, client, roster):
+    body = group_exit(client, group="E_1A").get_json()
+
+    for ticket in body["tickets"]:
+        assert os.path.isfile(os.path.join(server.PDF_DIR, ticket["pdf"]))
+    response = client.get(f"/pdfs/{body['batchPdf']}")
+    assert response.status_code == 200
+    assert response.data.startswith(b"%PDF")
+
+def test_group_exit_by_ids_rejects_unknown_students(school_now, client, roster):
+    response = group_exit(client, studentIds=["1001", "nope"])
+
+    assert response.status_code == 400
+    assert "nope" in response.get_json()["error"]
+    assert server.get_exit_db().execute("SELECT COUNT(*) FROM exits").fetchone()[0] == 0
+
+def test_group_exit_by_ids_ignores_duplicates(school_now, client, roster):
+    response = group_exit(client, studentIds=["1001", "2001", "1001"])
+
+    assert response.get_json()["count"] == 2
+
+def test_group_exit_needs_a_group_or_students(client, roster):
+    assert group_exit(client).status_code == 400
+    assert group_exit(client, group="X_9Z").status_code == 404
+
+def test_guardians_get_the_guardian_template_per_student(school_now, client, roster, monkeypatch):
+    monkeypatch.setenv("GUARDIAN_EMAILS", "g1@example.com, g2@example.com")
+    monkeypatch.setenv("EMAIL_GUARDIAN_SUBJECT", "Guardia: salida de {alumno}")
+    monkeypatch.setenv("EMAIL_GUARDIAN_BODY", "Salida de {alumno} ({grupo}).\\nMotivo: {motivo}\\n¿Regresa?: {regreso}")
+
+    group_exit(client, group="E_1A")
+
+    guardian = [r for r in outbox_rows() if r['to_email'] in ("g1@example.com", "g2@example.com")]
+    assert len(guardian) == 2 * len(E_1A)
+    assert {r['subject'] for r in guardian} == {f"Guardia: salida de {s['name']}" for s in E_1A}
+    ana = next(r for r in guardian if r['subject'].endswith(E_1A[0]['name']))
+    assert ana['body'] == f"Salida de {E_1A[0]['name']} (E_1A).\nMotivo: Excursión\n¿Regresa?: Sí (3ª)"
+    # Sent one by one like a single exit's, never merged into the teacher digest
+    assert all(r['item'] is None for r in guardian)
+    rows = server.claim_outbox_batch()
+    for _, to_email, subject, body in server.outbox_messages(rows):
+        if to_email.startswith("g"):
+            assert subject.startswith("Guardia: salida de ")
+            assert "Han salido del centro" not in body
+
+def test_teachers_get_one_digest_for_the_whole_group(school_now, client, roster):
+    body = group_exit(client, group="E_1A").get_json()
+
+    assert body["notified"] == ["Profesora Lengua"]
+    teacher_rows = [r for r in outbox_rows() if r['to_email'] == "lengua@example.com"]
+    assert len(teacher_rows) == len(E_1A)
+    assert all(r['item'] for r in teacher_rows)
+    messages = [m for m in server.outbox_messages(server.claim_outbox_batch()) if m[1] == "lengua@example.com"]
+    assert len(messages) == 1
+    _, _, subject, text = messages[0]
+    assert subject.startswith(f"Aviso Salidas de Alumnos ({len(E_1A)})")
+    for student in E_1A:
+        assert student['name'] in text
+
+def test_single_exit_guardian_email_uses_the_same_templates(school_now, client, roster, monkeypatch):
+    monkeypatch.setenv("GUARDIAN_EMAILS", "g1@example.com")
+    monkeypatch.setenv("EMAIL_GUARDIAN_SUBJECT", "Guardia: salida de {alumno}")
+    student = E_1A[0]
+
+    response = client.post('/api/exit', json={"studentId": student['id'], "studentName": student['name'],
+                                              "group": student['group'], "motive": "Excursión", "vuelve": False})
+
+    assert response.status_code == 200
+    assert [r['subject'] for r in outbox_rows() if r['to_email'] == "g1@example.com"] == [f"Guardia: salida de {student['name']}"]
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta
+
+import server
+from conftest import STUDENTS, exit_record
+
+ANA, INIGO, NAYAT, HUGO = STUDENTS
+
+def add_exits(count, student=ANA, start=datetime(2026, 10, 19, 8, 0), **extra):
+    records = [exit_record(student, start + timedelta(minutes=i), **extra) for i in range(count)]
+    server.add_exit_records(records)
+    return records
+
+def all_pages(client, query, limit):
+    pages, cursor = [], None
+    while True:
+        url = f"/api/history?limit={limit}{query}" + (f"&cursor={cursor}" if cursor else "")
+        body = client.get(url).get_json()
+        pages.append([r['PDF'] for r in body['records']])
+        cursor = body['nextCursor']
+        if cursor is None:
+            return pages
+
+def test_cursor_pagination_walks_every_record_once_newest_first(client):
+    records = add_exits(7)
+
+    pages = all_pages(client, "", 3)
+
+    assert [len(p) for p in pages] == [3, 3, 1]
+    assert [pdf for page in pages for pdf in page] == [r['PDF'] for r in reversed(records)]
+
+def test_last_full_page_has_no_cursor(client):
+    add_exits(6)
+    assert [len(p) for p in all_pages(client, "", 3)] == [3, 3]
+
+def test_pagination_is_stable_while_exits_are_added(client):
+    add_exits(4)
+    first = client.get("/api/history?limit=2").get_json()
+    add_exits(3, student=INIGO, start=datetime(2026, 10, 20, 8, 0))
+
+    second = client.get(f"/api/history?limit=2&cursor={first['nextCursor']}").get_json()
+
+    assert all(r['ID Alumno'] == ANA['id'] for r in second['records'])
+    assert second['nextCursor'] is None
+
+def test_invalid_pagination_parameters(client):
+    assert client.get("/api/history?cursor=abc").status_code == 400
+    assert client.get("/api/history?limit=x").status_code == 400
+
+def test_deleted_exits_are_hidden(client):
+    records = add_exits(3)
+    server.delete_exit_records({records[1]['PDF']})
+
+    pdfs = [r['PDF'] for r in client.get("/api/history").get_json()['records']]
+
+    assert pdfs == [records[2]['PDF'], records[0]['PDF']]
+
+def test_date_and_motive_filters(client):
+    add_exits(2, start=datetime(2026, 10, 1, 9, 0))
+    add_exits(2, start=datetime(2026, 10, 15, 9, 0), motive="Enfermedad")
+    add_exits(1, start=datetime(2026, 11, 2, 9, 0))
+
+    def count(query):
+        return len(client.get(f"/api/history?{query}").get_json()['records'])
+
+    assert count("from=2026-10-10&to=2026-10-31") == 2
+    assert count("motive=Enfermedad") == 2
+    assert count("motive=all") == 5
+    assert count("from=2026-10-01&to=2026-10-31&motive=Cita%20m%C3%A9dica") == 2
+
+def test_search_ignores_case_and_accents(client):
+    add_exits(1, student=INIGO)
+    add_exits(1, student=ANA, start=datetime(2026, 10, 20, 9, 0))
+
+    def names(q):
+        return [r['Nombre'] for r in client.get("/api/history", query_string={"q": q}).get_json()['records']]
+
+    assert names("penalver") == [INIGO['name']]
+    assert names("ÍÑIGO") == [INIGO['name']]
+    assert names("e_1a") == [ANA['name'], INIGO['name']]
+    assert names(ANA['dni']) == [ANA['name']]
+    assert names(ANA['id']) == [ANA['name']]
+
+def test_search_treats_like_wildcards_literally(client):
+    add_exits(1, student=ANA)
+    add_exits(1, student={"id": "5%", "name": "Cien_por_cien", "group": "B_2C"},
+              start=datetime(2026, 10, 20, 9, 0))
+
+    def names(q):
+        return [r['Nombre'] for r in client.get("/api/history", query_string={"q": q}).get_json()['records']]
+
+    assert names("%") == ["Cien_por_cien"]
+    assert names("n_p") == ["Cien_por_cien"]
+    assert names("a_a") == []  # as a wildcard it would match "Ana"
+
+def test_stats_match_the_filtered_history(client, roster):
+    today = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0)
+    add_exits(3, start=today)
+    add_exits(2, student=INIGO, start=today - timedelta(days=400), motive="Enfermedad")
+
+    stats = client.get("/api/history/stats").get_json()
+    assert (stats['today'], stats['total']) == (3, 5)
+
+    searched = client.get("/api/history/stats?q=penalver").get_json()
+    assert (searched['today'], searched['total']) == (0, 2)
+
+    by_motive = client.get("/api/history/stats?motive=Enfermedad").get_json()
+    assert by_motive['total'] == 2
+
+def test_stats_error_is_json(client, monkeypatch):
+    def fail():
+        raise RuntimeError("broken aggregates")
+    monkeypatch.setattr(server, "ensure_exit_daily", fail)
+
+    response = client.get("/api/history/stats")
+
+    assert response.status_code == 500
+    assert response.get_json() == {"error": "Error al calcular las estadísticas"}
@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import time
+
+import pytest
+from cryptography.fernet import Fernet
+
+import secure_json
+
+RECORDS = [{"id": str(1000 + i), "name": f"Alumno {i}", "group": "E_1A"} for i in range(300)]
+
+@pytest.fixture
+def aead():
+    return secure_json.derive_aead(Fernet.generate_key())
+
+@pytest.fixture
+def path(tmp_path, aead):
+    path = str(tmp_path / "students.json")
+    secure_json.write_records(path, RECORDS, aead)
+    return path
+
+def test_round_trip(path, aead):
+    assert secure_json.is_chunked(path)
+    assert secure_json.read_all(path, aead) == RECORDS
+    assert list(secure_json.iter_records(path, aead)) == RECORDS
+    assert secure_json.read_record(path, "1007", aead) == RECORDS[7]
+    assert secure_json.read_record(path, 1007, aead) == RECORDS[7]
+    assert secure_json.read_record(path, "nope", aead) is None
+
+def test_records_are_encrypted(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert b"Alumno" not in data and b"1007" not in data
+
+def test_wrong_key_fails(path):
+    with pytest.raises(Exception):
+        secure_json.read_all(path, secure_json.derive_aead(Fernet.generate_key()))
+
+def test_append_adds_and_replaces_by_id(path, aead):
+    changed = {"id": "1003", "name": "Alumno 3", "group": "B_2C"}
+    new = {"id": "5000", "name": "Nuevo", "group": "E_1A"}
+
+    secure_json.append_records(path, [changed, new], aead)
+
+    records = secure_json.read_all(path, aead)
+    assert len(records) == len(RECORDS) + 1
+    assert secure_json.read_record(path, "1003", aead) == changed
+    assert secure_json.read_record(path, "5000", aead) == new
+    assert [r for r in records if r['id'] == "1003"] == [changed]
+    assert list(secure_json.iter_records(path, aead)) == records
+
+def test_append_leaves_no_temp_files(path, aead):
+    secure_json.append_records(path, [{"id": "5000"}], aead)
+    assert sorted(os.listdir(os.path.dirname(path))) == ["students.json", "students.json.lock"]
+
+def test_damaged_footer_falls_back_to_scanning(path, aead):
+    secure_json.append_records(path, [{"id": "1003", "name": "Cambiado"}], aead)
+    with open(path, 'r+b') as f:
+        f.seek(-len(secure_json.FOOTER_MAGIC), os.SEEK_END)
+        f.write(b"XXXX")
+
+    assert secure_json.read_record(path, "1003", aead) == {"id": "1003", "name": "Cambiado"}
+    assert len(secure_json.read_all(path, aead)) == len(RECORDS)
+
+def test_open_reader_keeps_the_old_file_during_an_append(path, aead):
+    """Appends rename a new file into place, so a reader that already opened the
+    file keeps reading a complete snapshot."""
+    inode = os.stat(path).st_ino
+    with open(path, 'rb') as reader:
+        secure_json.append_records(path, [{"id": "5000", "name": "Nuevo"}], aead)
+
+        index, _ = secure_json.load_index(reader, aead)
+        assert sorted(index) == sorted(r['id'] for r in RECORDS)
+        reader.seek(index["1007"])
+        assert secure_json.read_frame(reader, aead)[0] == secure_json.FRAME_DATA
+
+    assert os.stat(path).st_ino != inode
+    assert secure_json.read_record(path, "5000", aead) == {"id": "5000", "name": "Nuevo"}
+
+def test_reader_in_the_middle_of_an_append_sees_the_old_records(path, aead, monkeypatch):
+    """Reads the file while an append has written its frames but not its index yet."""
+    seen = []
+    write_tail = secure_json.write_tail
+    def read_then_write_tail(f, *args):
+        f.flush()
+        seen.append(secure_json.read_all(path, aead))
+        write_tail(f, *args)
+    monkeypatch.setattr(secure_json, "write_tail", read_then_write_tail)
+
+    secure_json.append_records(path, [{"id": "5000", "name": "Nuevo"}], aead)
+
+    assert seen == [RECORDS]
+    assert secure_json.read_all(path, aead) == RECORDS + [{"id": "5000", "name": "Nuevo"}]
+
+def read_until(path, key, stop, results):
+    aead = secure_json.derive_aead(key)
+    sizes, errors = [], []
+    while not stop.is_set():
+        try:
+            records = secure_json.read_all(path, aead)
+            assert records[:len(RECORDS)] == RECORDS
+            sizes.append(len(records))
+        except Exception as e:
+            errors.append(repr(e))
+    results.put((sizes, errors))
+
+def test_readers_never_see_a_partial_append(tmp_path):
+    """Reader processes (they take no lock) read while this one appends: every read sees a complete file."""
+    key = Fernet.generate_key()
+    aead = secure_json.derive_aead(key)
+    path = str(tmp_path / "students.json")
+    secure_json.write_records(path, RECORDS, aead)
+    context = multiprocessing.get_context("fork")
+    stop, results = context.Event(), context.Queue()
+    readers = [context.Process(target=read_until, args=(path, key, stop, results)) for _ in range(3)]
+    for reader in readers:
+        reader.start()
+
+    deadline, count = time.monotonic() + 1, 0
+    while time.monotonic() < deadline:
+        secure_json.append_records(path, [{"id": f"new{count}"}], aead)
+        count += 1
+    stop.set()
+    outcomes = [results.get(timeout=10) for _ in readers]
+    for reader in readers:
+        reader.join()
+
+    for sizes, errors in outcomes:
+        assert errors == []
+        assert sizes == sorted(sizes)
+    assert len(secure_json.read_all(path, aead)) == len(RECORDS) + count
@@ -0,0 +1,104 @@
+import server
+from conftest import LOGIN_EMAIL, csrf_token, log_in
+
+def session_rows():
+    return server.get_session_db().execute("SELECT session_id, user_id FROM sessions").fetchall()
+
+def session_cookie(client):
+    cookie = client.get_cookie(server.app.config['SESSION_COOKIE_NAME'])
+    return cookie.value if cookie else None
+
+def test_anonymous_visits_keep_the_session_in_the_cookie():
+    client = server.app.test_client()
+
+    token = csrf_token(client)
+    assert csrf_token(client) == token
+    client.get('/login.html')
+
+    assert session_rows() == []
+    assert session_cookie(client)
+
+def test_login_stores_the_session_server_side_with_a_new_id():
+    client = server.app.test_client()
+    csrf_token(client)
+    anonymous = session_cookie(client)
+
+    log_in(client)
+
+    rows = session_rows()
+    assert [r['user_id'] for r in rows] == [LOGIN_EMAIL]
+    logged_in = session_cookie(client)
+    assert logged_in != anonymous
+    # The cookie only carries the signed id
+    assert server.SQLiteSessionInterface().get_signer(server.app).unsign(logged_in).decode() == rows[0]['session_id']
+    assert client.get('/api/history').status_code == 200
+
+def test_login_token_is_single_use():
+    client = server.app.test_client()
+    log_in(client)
+    client.post('/api/logout')
+
+    response = client.post('/api/login', json={"email": LOGIN_EMAIL, "token": "123456"},
+                           headers={"X-CSRFToken": csrf_token(client)})
+
+    assert response.status_code == 401
+
+def test_wrong_login_token_is_rejected():
+    other = server.app.test_client()
+    token = csrf_token(other)
+    with server.get_session_db() as conn:
+        conn.execute("INSERT OR REPLACE INTO login_tokens (email, token, expires_at) VALUES (?, ?, ?)",
+                     (LOGIN_EMAIL, "123456", "2999-01-01 00:00:00"))
+
+    response = other.post('/api/login', json={"email": LOGIN_EMAIL, "token": "654321"}, headers={"X-CSRFToken": token})
+
+    assert response.status_code == 401
+    assert session_rows() == []
+
+def test_session_is_shared_between_workers():
+    """Another process only sees the sessions table: drop the pooled connection and read again."""
+    client = server.app.test_client()
+    log_in(client)
+    server.close_db_connections()
+
+    assert client.get('/api/history').status_code == 200
+
+def test_posts_need_the_csrf_token(client):
+    del client.environ_base["HTTP_X_CSRFTOKEN"]
+
+    response = client.post('/api/exits/group', json={"group": "E_1A"})
+
+    assert response.status_code == 400
+    assert server.get_exit_db().execute("SELECT COUNT(*) FROM exits").fetchone()[0] == 0
+
+def test_login_needs_the_csrf_token():
+    client = server.app.test_client()
+    csrf_token(client)
+
+    response = client.post('/api/login', json={"email": LOGIN_EMAIL, "token": "123456"})
+
+    assert response.status_code == 400
+    assert session_rows() == []
+
+def test_logout_deletes_the_session(client):
+    assert len(session_rows()) == 1
+
+    assert client.post('/api/logout').status_code == 200
+
+    assert session_rows() == []
+    assert client.get('/api/history').status_code == 401
+
+def test_expired_sessions_are_rejected_and_swept(client):
+    with server.get_session_db() as conn:
+        conn.execute("UPDATE sessions SET expires_at = '2000-01-01 00:00:00'")
+
+    assert client.get('/api/history').status_code == 401
+    assert server.sweep_expired_logins() == (0, 1)
+    assert session_rows() == []
+
+def test_api_needs_a_login():
+    client = server.app.test_client()
+
+    for url in ('/api/history', '/api/history/stats', '/api/history/export', '/api/students/search?q=ana', '/api/events'):
+        assert client.get(url).status_code == 401, url
+    assert client.get('/').status_code == 302
@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import random
+import tempfile
+
+# Benchmark: roster import on a synthetic Séneca-style export (RegAlum.xlsx).
+# Compares the previous iterrows() loop with the column-wise pipeline, reading
+# with pandas and with the openpyxl streaming path, and checks that both read
+# numeric, zero-padded and text ids exactly as written.
+#   python3 utils/bench_import.py [num_rows]
+if not os.environ.get('STUDENTS_DATA_KEY'):
+    from cryptography.fernet import Fernet
+    os.environ['STUDENTS_DATA_KEY'] = Fernet.generate_key().decode()
+_tmp = tempfile.mkdtemp()
+os.environ['DATA_PATH'] = os.path.join(_tmp, 'data')
+os.environ['PDF_PATH'] = os.path.join(_tmp, 'pdfs')
+os.environ.setdefault('DEBUG', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+import openpyxl
+import pandas as pd
+
+NAMES = ["José", "María", "Mohamed", "Fátima", "Lucía", "Hugo", "Nayat", "Iván", "Sara", "Yusef"]
+SURNAMES = ["García", "Benaisa", "Martínez", "Mohamedi", "López", "Hammu", "Núñez", "Ruiz", "Abdelkader"]
+GROUPS = [f"{p}_{c}{l}" for p in "EB" for c in range(1, 5) for l in "ABCD"]
+
+def numeric_id(i):
+    # Séneca ids are usually numbers; some come as zero-padded text and must keep the zero
+    return f"{i:07d}" if i % 5 == 1 else 1000000 + i
+
+def text_id(i):
+    return f"X{i}" if i % 2 else f"{i:07d}"
+
+def write_seneca_export(path, rows, student_id=numeric_id):
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("RegAlum")
+    ws.append(["Relación de alumnado matriculado"])
+    ws.append(["I.E.S. Leopoldo Queipo"])
+    ws.append([])
+    ws.append(["Curso 2025/2026"])
+    ws.append(list(server.ROSTER_COLUMNS.values()) + ["Fecha de nacimiento", "Teléfono"])
+    rnd = random.Random(42)
+    for i in range(rows):
+        name = f"{rnd.choice(SURNAMES)} {rnd.choice(SURNAMES)}, {rnd.choice(NAMES)}"
+        ws.append([student_id(i), name, rnd.choice(GROUPS), f"{rnd.randint(10**7, 10**8 - 1)}{rnd.choice('TRWAGMYF')}",
+                   rnd.choice(NAMES), rnd.choice(SURNAMES), "01/01/2010", "600000000"])
+    wb.save(path)
+
+def legacy_transform(df):
+    # Copy of the loop upload_students used before the column-wise pipeline
+    df.columns = [str(c).strip() for c in df.columns]
+    new_students = []
+    for _, row in df.iterrows():
+        s_name = str(row.get('Alumno/a', '')).strip()
+        if not s_name or s_name == 'nan': continue
+        new_students.append({
+            "id": str(row.get('Nº Id. Escolar', '')).strip(),
+            "name": s_name,
+            "group": str(row.get('Unidad', '')).strip(),
+            "dni": str(row.get('DNI/Pasaporte', '')).strip(),
+            "tutor1": {"name": f"{row.get('Nombre Primer tutor', '')} {row.get('Primer apellido Primer tutor', '')}".strip()}
+        })
+    return new_students
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+def bench(label, read, transform):
+    df, read_ms = timed(read)
+    students, transform_ms = timed(lambda: transform(df))
+    print(f"{label:<22} lectura {read_ms:8.1f} ms   transformación {transform_ms:8.1f} ms   ({len(students)} alumnos)")
+    return students
+
+def check_ids(path, students, student_id):
+    expected = [str(student_id(i)) for i in range(len(students))]
+    assert [s["id"] for s in students] == expected, f"Los Nº Id. Escolar de {os.path.basename(path)} deben leerse tal cual"
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    path = os.path.join(_tmp, "RegAlum.xlsx")
+    write_seneca_export(path, rows)
+    print(f"Fichero sintético: {rows} filas, {os.path.getsize(path) / 1024:.0f} KB")
+
+    legacy = bench("legacy (iterrows)", lambda: pd.read_excel(path, header=4, dtype=str), legacy_transform)
+    transform = lambda df: server.transform_roster(df)[0]
+    pandas_path = bench("vectorizado (pandas)", lambda: server.read_roster_excel(path, streaming=False), transform)
+    streaming = bench("vectorizado (stream)", lambda: server.read_roster_excel(path, streaming=True), transform)
+    assert legacy == pandas_path == streaming, "Los tres caminos deben producir el mismo roster"
+    check_ids(path, streaming, numeric_id)
+
+    # Text ids (a column pandas cannot take as numbers) must read the same way
+    text_path = os.path.join(_tmp, "RegAlum_texto.xlsx")
+    write_seneca_export(text_path, 200, text_id)
+    check_ids(text_path, transform(server.read_roster_excel(text_path, streaming=False)), text_id)
+    check_ids(text_path, transform(server.read_roster_excel(text_path, streaming=True)), text_id)
+
+    changed = [dict(s) for s in streaming]
+    changed[0]["group"] = "X_1A"
+    diff, diff_ms = timed(lambda: server.diff_rosters(streaming, changed[:-1]))
+    print(f"{'diff':<22} {diff_ms:8.1f} ms  (+{len(diff['added'])} ~{len(diff['changed'])} -{len(diff['removed'])})")
+
+if __name__ == "__main__":
+    main()
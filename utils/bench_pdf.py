@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+from datetime import datetime
+
+# Benchmark: tickets/second of the template renderer vs. the previous
+# build-everything-per-request code path. Runs against a temporary data dir;
+# only the logo is copied into it (BENCH_LOGO, by default data/logo.gif).
+#   python3 utils/bench_pdf.py [num_tickets]
+if not os.environ.get('STUDENTS_DATA_KEY'):
+    from cryptography.fernet import Fernet
+    os.environ['STUDENTS_DATA_KEY'] = Fernet.generate_key().decode()
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_LOGO = os.environ.get('BENCH_LOGO', os.path.join(BASE_DIR, 'data', 'logo.gif'))
+_tmp = tempfile.mkdtemp()
+os.environ['DATA_PATH'] = os.path.join(_tmp, 'data')
+os.makedirs(os.environ['DATA_PATH'])
+if os.path.isfile(BENCH_LOGO):
+    shutil.copy(BENCH_LOGO, os.path.join(os.environ['DATA_PATH'], 'logo.gif'))
+os.environ['PDF_PATH'] = os.path.join(_tmp, 'pdfs')
+os.environ.setdefault('DEBUG', '1')
+
+sys.path.insert(0, BASE_DIR)
+import server
+from fpdf import FPDF
+from server import safe_text
+
+def legacy_render(record, pdf_path):
+    # Copy of the ticket code register_exit used before the template renderer
+    pdf = FPDF()
+    pdf.add_page()
+    logo_path = os.path.join(server.DATA_DIR, 'logo.gif')
+    if os.path.exists(logo_path):
+        pdf.image(logo_path, x=92, y=10, w=25)
+    pdf.set_y(38)
+    pdf.set_font('Arial', 'B', 14)
+    pdf.cell(0, 8, safe_text('PARTE DE SALIDA'), 0, 1, 'C')
+    pdf.set_font('Arial', '', 12)
+    pdf.cell(0, 8, safe_text('I.E.S. Leopoldo Queipo'), 0, 1, 'C')
+    pdf.ln(5)
+    pdf.set_font("Arial", '', 11)
+
+    def row(l, v):
+        pdf.set_font("Arial", 'B', 11); pdf.cell(90, 8, safe_text(l), 0, 0, 'R')
+        pdf.set_font("Arial", '', 11); pdf.cell(5); pdf.cell(0, 8, safe_text(v), 0, 1, 'L')
+
+    row("Fecha:", record['Fecha']); row("Hora:", record['Hora'])
+    pdf.ln(2); pdf.line(50, pdf.get_y(), 160, pdf.get_y()); pdf.ln(4)
+    pdf.set_font("Arial", 'B', 11); pdf.cell(0, 6, safe_text("Alumno:"), 0, 1, 'C')
+    pdf.set_font("Arial", '', 12); pdf.cell(0, 8, safe_text(record['Nombre']), 0, 1, 'C')
+    row("Grupo:", record['Grupo']); row("DNI:", record['DNI Alumno'])
+    pdf.ln(4); pdf.line(50, pdf.get_y(), 160, pdf.get_y()); pdf.ln(4)
+    pdf.set_font("Arial", 'B', 11); pdf.cell(0, 6, safe_text("Motivo:"), 0, 1, 'C')
+    pdf.set_font("Arial", '', 11); pdf.cell(0, 8, safe_text(record['Motivo']), 0, 1, 'C')
+    if record['Vuelve'] == 'Sí': pdf.ln(3); row("Regreso:", f"SÍ - Horas: {record['Horas']}")
+    pdf.set_y(-25); pdf.set_font('Arial', 'I', 9); pdf.cell(0, 10, safe_text('Documento oficial de control'), 0, 1, 'C')
+    pdf.output(pdf_path)
+
+def make_record(i):
+    now = datetime.now()
+    return {"Fecha": now.strftime("%Y-%m-%d"), "Hora": now.strftime("%H:%M:%S"),
+            "Nombre": f"Alumno Ñúñez Prueba {i}", "Grupo": "E_3B", "DNI Alumno": f"{i:08d}X",
+            "Motivo": "Médico", "Vuelve": "Sí" if i % 2 else "No", "Horas": "3ª, 4ª"}
+
+def bench(label, render, n):
+    out_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    for i in range(n):
+        render(make_record(i), os.path.join(out_dir, f"t{i}.pdf"))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {n / elapsed:8.1f} tickets/s  ({elapsed * 1000 / n:.2f} ms/ticket)")
+    return n / elapsed
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    if not os.path.exists(server.TICKET_LOGO_PATH):
+        print(f"Aviso: {server.TICKET_LOGO_PATH} no existe, se mide sin logo (indica uno con BENCH_LOGO=ruta/logo.gif)")
+    server.render_ticket(make_record(0), os.path.join(_tmp, 'warmup.pdf'))  # builds the template
+    legacy = bench("legacy", legacy_render, n)
+    template = bench("template", server.render_ticket, n)
+    print(f"Speedup: x{template / legacy:.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import platform
+from datetime import datetime
+
+# Startup benchmark: worker boot time, per-worker memory and first-use latency
+# for each STARTUP_MODE, simulating gunicorn with N forked workers.
+#   eager:   what server.py did before lazy startup (pandas/FPDF/smtplib and the
+#            timetable loaded at import), each worker importing the app itself
+#   lazy:    each worker imports the app; heavy modules and data load on first use
+#   preload: the master imports the app with everything warmed (gunicorn --preload)
+#            and the workers are forked from it
+# Private memory is what each worker does not share with the others (smaps_rollup).
+#   python3 utils/bench_startup.py [--workers 2] [--runs 3] [--students 1500] [--out results.json]
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from bench_workflow import make_students, make_timetable, write_seneca_export, git_version
+
+MODES = ["eager", "lazy", "preload"]
+
+def memory_kb():
+    """{"rss", "pss", "private"} in kB for this process."""
+    fields = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[1].isdigit():
+                    fields[parts[0].rstrip(":")] = int(parts[1])
+    except OSError:
+        import resource
+        return {"rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "pss": None, "private": None}
+    return {"rss": fields.get("Rss"), "pss": fields.get("Pss"),
+            "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0)}
+
+def import_app(mode):
+    t = time.perf_counter()
+    if mode == "eager":
+        import pandas, smtplib
+        from fpdf import FPDF
+    import server
+    if mode == "eager":
+        server.refresh_timetable_index()
+    return server, (time.perf_counter() - t) * 1000
+
+def first_use(server, xlsx):
+    """Latency of the first call of each kind in a fresh worker."""
+    timings = {}
+    def timed(name, fn):
+        t = time.perf_counter()
+        fn()
+        timings[name] = round((time.perf_counter() - t) * 1000, 1)
+    client = server.app.test_client()
+    with client.session_transaction() as s:
+        s["logged_in"] = True
+    timed("students_json", lambda: client.get("/data/students.json"))
+    timed("teacher_lookup", lambda: server.get_teachers_for_group("E_1A", "Sesión 3", "Lunes"))
+    record = dict.fromkeys(server.CSV_HEADERS, "x")
+    timed("ticket", lambda: server.render_ticket(record, os.path.join(os.path.dirname(xlsx), f"t{os.getpid()}.pdf")))
+    timed("roster_read", lambda: server.transform_roster(server.read_roster_excel(xlsx)))
+    return timings
+
+def run_mode(mode, workers, xlsx):
+    """Runs inside the per-mode subprocess: imports (or not) in the master, forks the workers."""
+    os.environ["STARTUP_MODE"] = "preload" if mode == "preload" else "lazy"
+    master_import_ms = None
+    if mode == "preload":
+        server, master_import_ms = import_app(mode)
+    master_memory = memory_kb()
+
+    results = []
+    for _ in range(workers):
+        read_fd, write_fd = os.pipe()
+        forked_at = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            if mode == "preload":
+                boot_ms = (time.perf_counter() - forked_at) * 1000
+            else:
+                server, boot_ms = import_app(mode)
+            booted = memory_kb()
+            timings = first_use(server, xlsx)
+            with os.fdopen(write_fd, "w") as out:
+                json.dump({"boot_ms": round(boot_ms, 1), "memory_booted_kb": booted,
+                           "memory_kb": memory_kb(), "first_use_ms": timings}, out)
+            os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd) as pipe:
+            results.append(json.loads(pipe.read()))
+        os.waitpid(pid, 0)
+    return {"mode": mode, "master_import_ms": master_import_ms and round(master_import_ms, 1),
+            "master_memory_kb": master_memory, "workers": results}
+
+def seed(data_dir, num_students):
+    import secure_json
+    rnd = random.Random(1)
+    aead = secure_json.derive_aead(os.environ["STUDENTS_DATA_KEY"])
+    students = make_students(num_students, rnd)
+    secure_json.write_records(os.path.join(data_dir, "students.json"), students, aead)
+    secure_json.write_records(os.path.join(data_dir, "horarios_profesores_limpio.json"), make_timetable(rnd), aead)
+    return students
+
+def median(values):
+    values = sorted(v for v in values if v is not None)
+    return values[len(values) // 2] if values else None
+
+def summarize(runs):
+    workers = [w for run in runs for w in run["workers"]]
+    return {"boot_ms": median([w["boot_ms"] for w in workers]),
+            "master_import_ms": median([run["master_import_ms"] for run in runs]),
+            "worker_booted_rss_kb": median([w["memory_booted_kb"]["rss"] for w in workers]),
+            "worker_booted_private_kb": median([w["memory_booted_kb"]["private"] for w in workers]),
+            "worker_rss_kb": median([w["memory_kb"]["rss"] for w in workers]),
+            "worker_private_kb": median([w["memory_kb"]["private"] for w in workers]),
+            "worker_pss_kb": median([w["memory_kb"]["pss"] for w in workers]),
+            "first_use_ms": {op: median([w["first_use_ms"][op] for w in workers]) for op in workers[0]["first_use_ms"]}}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque de los workers")
+    parser.add_argument("--workers", type=int, default=2, help="workers de gunicorn simulados")
+    parser.add_argument("--runs", type=int, default=3, help="repeticiones por modo (se da la mediana)")
+    parser.add_argument("--students", type=int, default=1500)
+    parser.add_argument("--modes", default=",".join(MODES))
+    parser.add_argument("--out", help="fichero JSON de resultados (por defecto bench_startup_<versión>.json)")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--xlsx", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_mode(args.worker, args.workers, args.xlsx)))
+        return
+
+    import subprocess
+    from cryptography.fernet import Fernet
+    tmp = tempfile.mkdtemp()
+    data_dir = os.path.join(tmp, "data")
+    os.makedirs(data_dir)
+    env = dict(os.environ, DATA_PATH=data_dir, PDF_PATH=os.path.join(tmp, "pdfs"), DEBUG="1",
+               STUDENTS_DATA_KEY=Fernet.generate_key().decode())
+    os.environ.update(env)
+    students = seed(data_dir, args.students)
+    xlsx = os.path.join(tmp, "RegAlum.xlsx")
+    write_seneca_export(xlsx, students[:200])
+
+    version = git_version()
+    results = {}
+    for mode in args.modes.split(","):
+        runs = []
+        for _ in range(args.runs):
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", mode, "--xlsx", xlsx,
+                                   "--workers", str(args.workers)], capture_output=True, text=True, env=env)
+            if proc.returncode != 0:
+                print(proc.stderr)
+                sys.exit(f"Fallo al medir el modo {mode}")
+            runs.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        results[mode] = {"summary": summarize(runs), "runs": runs}
+        s = results[mode]["summary"]
+        master = f", import en el maestro {s['master_import_ms']:.0f} ms" if s["master_import_ms"] else ""
+        print(f"\n{mode}: arranque del worker {s['boot_ms']:.1f} ms{master}")
+        print(f"  memoria por worker al arrancar: RSS {s['worker_booted_rss_kb'] / 1024:.1f} MB, "
+              f"privada {(s['worker_booted_private_kb'] or 0) / 1024:.1f} MB")
+        print(f"  memoria por worker tras el primer uso: RSS {s['worker_rss_kb'] / 1024:.1f} MB, privada {(s['worker_private_kb'] or 0) / 1024:.1f} MB, "
+              f"PSS {(s['worker_pss_kb'] or 0) / 1024:.1f} MB")
+        print("  primer uso: " + ", ".join(f"{op} {ms:.1f} ms" for op, ms in s["first_use_ms"].items()))
+
+    report = {"version": version, "timestamp": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "host": socket.gethostname(),
+              "params": {"workers": args.workers, "runs": args.runs, "students": args.students}, "results": results}
+    out = args.out or f"bench_startup_{version or 'local'}.json"
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+import os
+import sys
+import csv
+import json
+import time
+import random
+import socket
+import argparse
+import tempfile
+import platform
+import subprocess
+import socketserver
+import ssl
+import threading
+from datetime import datetime, timedelta
+
+# Benchmark / load test of the exit workflow through the Flask test client:
+# synthetic roster, timetable and multi-year salidas.csv, a local stub SMTP
+# server, and p50/p99 latency + throughput per endpoint as the log grows.
+# Every size runs in a fresh subprocess (the server reads its data dir on import).
+#   python3 utils/bench_workflow.py [--years 1,3,5] [--students 1500] [--requests 200]
+#                                   [--out results.json] [--compare previous.json]
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+NAMES = ["José", "María", "Mohamed", "Fátima", "Lucía", "Hugo", "Nayat", "Iván", "Sara", "Yusef"]
+SURNAMES = ["García", "Benaisa", "Martínez", "Mohamedi", "López", "Hammu", "Núñez", "Ruiz", "Abdelkader"]
+GROUPS = [f"{p}_{c}{l}" for p in "EB" for c in range(1, 5) for l in "ABCD"]
+MOTIVES = ["Médico", "Enfermedad", "Asuntos familiares", "Otros"]
+DAYS = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes"]
+EXITS_PER_SCHOOL_DAY = 40
+
+# --- Synthetic data ---
+def make_students(n, rnd):
+    return [{"id": str(1000000 + i), "name": f"{rnd.choice(SURNAMES)} {rnd.choice(SURNAMES)}, {rnd.choice(NAMES)}",
+             "group": rnd.choice(GROUPS), "dni": f"{rnd.randint(10**7, 10**8 - 1)}X",
+             "tutor1": {"name": f"{rnd.choice(NAMES)} {rnd.choice(SURNAMES)}"}} for i in range(n)]
+
+def make_timetable(rnd, teachers=70):
+    timetable = []
+    for t in range(teachers):
+        horario = [{"tramo": f"Sesión {s}", **{day: ({"grupo": rnd.choice(GROUPS), "materia": "Materia"} if rnd.random() < 0.7 else {})
+                                              for day in DAYS}} for s in range(1, 9)]
+        timetable.append({"nombre": f"Profesor {t}", "email": f"profesor{t}@bench.local", "horario": horario})
+    return timetable
+
+def write_exit_log(path, students, years, rnd, headers):
+    """salidas.csv with EXITS_PER_SCHOOL_DAY exits on every weekday of the last `years` years."""
+    rows = 0
+    day = datetime.now() - timedelta(days=365 * years)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        while day.date() < datetime.now().date():
+            if day.weekday() < 5:
+                for _ in range(EXITS_PER_SCHOOL_DAY):
+                    s = rnd.choice(students)
+                    hour = f"{rnd.randint(8, 14):02d}:{rnd.randint(0, 59):02d}:{rnd.randint(0, 59):02d}"
+                    stamp = f"{day:%Y%m%d}_{hour.replace(':', '')}_{s['id']}"
+                    vuelve = rnd.random() < 0.3
+                    writer.writerow([day.strftime("%Y-%m-%d"), hour, s["id"], s["name"], s["group"], s["dni"],
+                                     rnd.choice(MOTIVES), "Tutor1", s["tutor1"]["name"], f"ticket_{stamp}.pdf",
+                                     "Sí" if vuelve else "No", "3ª, 4ª" if vuelve else "", stamp, "No"])
+                    rows += 1
+            day += timedelta(days=1)
+    return rows
+
+def write_seneca_export(path, students):
+    import openpyxl
+    from server import ROSTER_COLUMNS
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("RegAlum")
+    for line in (["Relación de alumnado matriculado"], ["I.E.S. Leopoldo Queipo"], [], ["Curso 2025/2026"]):
+        ws.append(line)
+    ws.append(list(ROSTER_COLUMNS.values()))
+    for s in students:
+        tutor = s["tutor1"]["name"].split(" ", 1)
+        ws.append([int(s["id"]), s["name"], s["group"], s["dni"], tutor[0], tutor[-1]])
+    wb.save(path)
+
+# --- Stub SMTP server (STARTTLS + AUTH, accepts and counts every message) ---
+def make_self_signed_cert(directory):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number()).not_valid_before(datetime.now() - timedelta(days=1))
+            .not_valid_after(datetime.now() + timedelta(days=1)).sign(key, hashes.SHA256()))
+    cert_path, key_path = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return cert_path, key_path
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, text):
+        self.wfile.write(text.encode() + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply("220 stub ESMTP")
+        tls = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode(errors="replace").strip()[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self.reply("250-stub\r\n250-AUTH PLAIN LOGIN" + ("" if tls else "\r\n250-STARTTLS") + "\r\n250 OK")
+            elif verb == "STAR":
+                self.reply("220 Ready to start TLS")
+                self.connection = self.server.tls.wrap_socket(self.connection, server_side=True)
+                self.rfile, self.wfile = self.connection.makefile("rb"), self.connection.makefile("wb")
+                tls = True
+            elif verb == "AUTH":
+                self.reply("235 Authenticated")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b""):
+                    pass
+                with self.server.lock:
+                    self.server.delivered += 1
+                self.reply("250 Queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("250 OK")
+
+def start_stub_smtp(directory):
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), StubSMTPHandler)
+    server.daemon_threads = True
+    server.tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server.tls.load_cert_chain(*make_self_signed_cert(directory))
+    server.lock, server.delivered = threading.Lock(), 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# --- Measurement ---
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+def measure(fn, n):
+    latencies = []
+    start = time.perf_counter()
+    for i in range(n):
+        t = time.perf_counter()
+        fn(i)
+        latencies.append((time.perf_counter() - t) * 1000)
+    total = time.perf_counter() - start
+    latencies.sort()
+    return {"n": n, "p50_ms": round(percentile(latencies, 50), 3), "p99_ms": round(percentile(latencies, 99), 3),
+            "mean_ms": round(sum(latencies) / n, 3), "throughput_per_s": round(n / total, 1)}
+
+def check(response, *codes):
+    if response.status_code not in codes:
+        raise RuntimeError(f"{response.request.method} {response.request.path}: {response.status_code} {response.get_data(as_text=True)[:200]}")
+    return response
+
+def run_size(years, num_students, requests):
+    """Runs inside the per-size subprocess: seeds a data dir, imports server and drives the routes."""
+    rnd = random.Random(years)
+    tmp = tempfile.mkdtemp()
+    data_dir = os.path.join(tmp, "data")
+    os.makedirs(data_dir)
+    smtp = start_stub_smtp(tmp)
+    os.environ.update({"DATA_PATH": data_dir, "PDF_PATH": os.path.join(tmp, "pdfs"), "DEBUG": "1",
+                       "SMTP_SERVER": "127.0.0.1", "SMTP_PORT": str(smtp.server_address[1]),
+                       "SMTP_USER": "bench", "SMTP_PASS": "bench", "GUARDIAN_EMAILS": "guardia@bench.local"})
+
+    import secure_json
+    aead = secure_json.derive_aead(os.environ["STUDENTS_DATA_KEY"])
+    students = make_students(num_students, rnd)
+    secure_json.write_records(os.path.join(data_dir, "students.json"), students, aead)
+    secure_json.write_records(os.path.join(data_dir, "horarios_profesores_limpio.json"), make_timetable(rnd), aead)
+    import server
+    rows = write_exit_log(server.CSV_FILE, students, years, rnd, server.CSV_HEADERS)
+    t = time.perf_counter()
+    server.import_csv_history()  # the one-time legacy import an upgraded install runs on startup
+    import_ms = (time.perf_counter() - t) * 1000
+    server.app.config["WTF_CSRF_ENABLED"] = False
+    client = server.app.test_client()
+    with client.session_transaction() as s:
+        s["logged_in"] = True
+
+    ops = {}
+    ops["serve_data"] = measure(lambda i: check(client.get("/data/students.json"), 200), requests)
+    ops["serve_data_304"] = measure(lambda i: check(client.get("/data/students.json", headers={
+        "If-None-Match": client.get("/data/students.json").headers["ETag"]}), 304), requests)
+    ops["student_history"] = measure(lambda i: check(client.get(f"/api/student-history?id={rnd.choice(students)['id']}"), 200), requests)
+    ops["history"] = measure(lambda i: check(client.get("/api/history"), 200), requests)
+    ops["history_search"] = measure(lambda i: check(client.get(f"/api/history?q={rnd.choice(SURNAMES)}"), 200), requests)
+    ops["history_stats"] = measure(lambda i: check(client.get("/api/history/stats"), 200), requests)
+
+    pdfs = []
+    def register(i):
+        s = students[i % len(students)]  # distinct students: ticket ids are per second and student
+        vuelve = i % 3 == 0
+        r = check(client.post("/api/exit", json={"studentId": s["id"], "studentName": s["name"], "group": s["group"],
+                                                  "dni": s["dni"], "motive": rnd.choice(MOTIVES), "accompaniedBy": "Tutor1",
+                                                  "tutorName": s["tutor1"]["name"], "vuelve": vuelve,
+                                                  "horas": "3ª, 4ª" if vuelve else ""}), 200)
+        pdfs.append(r.get_json()["pdf"])
+    ops["register_exit"] = measure(register, requests)
+    ops["delete_record"] = measure(lambda i: check(client.delete(f"/api/history/{pdfs[i]}"), 200), len(pdfs))
+
+    xlsx = os.path.join(tmp, "RegAlum.xlsx")
+    write_seneca_export(xlsx, students)
+    def upload(i):
+        with open(xlsx, "rb") as f:
+            job_id = check(client.post("/api/upload-students", data={"file": (f, "RegAlum.xlsx")}), 202).get_json()["jobId"]
+        while check(client.get(f"/api/jobs/{job_id}"), 200).get_json()["status"] not in ("done", "error"):
+            time.sleep(0.01)
+    ops["upload_students"] = measure(upload, max(1, requests // 50))
+
+    # Let the outbox worker deliver what register_exit queued
+    deadline = time.time() + 60
+    while time.time() < deadline and server.get_exit_db().execute(
+            "SELECT COUNT(*) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0]:
+        time.sleep(0.1)
+    return {"years": years, "records": rows, "students": num_students, "csv_import_ms": round(import_ms, 1),
+            "emails_delivered": smtp.delivered, "ops": ops}
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=BASE_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(previous, current):
+    print(f"\nComparación con {previous.get('version')} (p50, ms):")
+    old_sizes = {r["years"]: r for r in previous["results"]}
+    for result in current["results"]:
+        old = old_sizes.get(result["years"])
+        if not old:
+            continue
+        for op, stats in result["ops"].items():
+            if op in old["ops"]:
+                before = old["ops"][op]["p50_ms"]
+                change = (stats["p50_ms"] - before) / before * 100 if before else 0
+                print(f"  {result['years']}a {op:<18} {before:9.2f} -> {stats['p50_ms']:9.2f}  ({change:+.0f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del flujo de salidas")
+    parser.add_argument("--years", default="1,3,5", help="años de historial a generar, separados por comas")
+    parser.add_argument("--students", type=int, default=1500)
+    parser.add_argument("--requests", type=int, default=200, help="peticiones por endpoint")
+    parser.add_argument("--out", help="fichero JSON de resultados (por defecto bench_workflow_<versión>.json)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para comparar")
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        if not os.environ.get("STUDENTS_DATA_KEY"):
+            from cryptography.fernet import Fernet
+            os.environ["STUDENTS_DATA_KEY"] = Fernet.generate_key().decode()
+        print(json.dumps(run_size(args.worker, args.students, args.requests)))
+        return
+
+    version = git_version()
+    results = []
+    for years in [int(y) for y in args.years.split(",")]:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", str(years),
+                               "--students", str(args.students), "--requests", str(args.requests)],
+                              capture_output=True, text=True)
+        if proc.returncode != 0:
+            print(proc.stderr)
+            sys.exit(f"Fallo al medir {years} años de historial")
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(f"\n{years} año(s): {result['records']} salidas, importación CSV {result['csv_import_ms']:.0f} ms, "
+              f"{result['emails_delivered']} emails entregados")
+        for op, s in result["ops"].items():
+            print(f"  {op:<18} p50 {s['p50_ms']:8.2f} ms  p99 {s['p99_ms']:8.2f} ms  {s['throughput_per_s']:8.1f} req/s")
+
+    report = {"version": version, "timestamp": datetime.now().isoformat(timespec="seconds"),
+              "python": platform.python_version(), "host": socket.gethostname(),
+              "params": {"students": args.students, "requests": args.requests}, "results": results}
+    out = args.out or f"bench_workflow_{version or 'local'}.json"
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"\nResultados guardados en {out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,9 @@ import base64
 from cryptography.fernet import Fernet
 import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import secure_json
+
 def generate_key():
     key = Fernet.generate_key()
     print("\n" + "="*50)
@@ -46,11 +49,14 @@ def decrypt_file(file_path, key):
         return
 
     try:
-        fernet = Fernet(key)
-        with open(file_path, 'rb') as f:
-            encrypted_data = f.read()
-        
-        decrypted_data = fernet.decrypt(encrypted_data).decode('utf-8')
+        if secure_json.is_chunked(file_path):
+            records = list(secure_json.iter_records(file_path, secure_json.derive_aead(key)))
+            decrypted_data = json.dumps(records, indent=4, ensure_ascii=False)
+        else:
+            fernet = Fernet(key)
+            with open(file_path, 'rb') as f:
+                encrypted_data = f.read()
+            decrypted_data = fernet.decrypt(encrypted_data).decode('utf-8')
         
         # Verify it's valid JSON before saving
         json.loads(decrypted_data)
@@ -66,17 +72,54 @@ def decrypt_file(file_path, key):
     except Exception as e:
         print(f"Error durante el descifrado: {e}")
 
+def migrate_file(file_path, key):
+    """Rewrites a single-token Fernet file (or plain JSON) in the chunked per-record format."""
+    if not os.path.exists(file_path):
+        print(f"Error: El archivo {file_path} no existe.")
+        return
+    if secure_json.is_chunked(file_path):
+        print(f"{file_path} ya está en formato por bloques.")
+        return
+
+    try:
+        with open(file_path, 'rb') as f:
+            raw = f.read()
+        try:
+            data = json.loads(Fernet(key).decrypt(raw).decode('utf-8'))
+        except Exception:
+            data = json.loads(raw.decode('utf-8'))  # JSON plano sin cifrar
+        if not isinstance(data, list):
+            print("Error: El formato por bloques solo admite listas de registros.")
+            return
+
+        backup_path = file_path + ".fernet.bak"
+        with open(backup_path, 'wb') as f:
+            f.write(raw)
+        print(f"Backup creado en: {backup_path}")
+
+        aead = secure_json.derive_aead(key)
+        secure_json.write_records(file_path, data, aead)
+        # Read it back before declaring success
+        if list(secure_json.iter_records(file_path, aead)) != data:
+            os.replace(backup_path, file_path)
+            print("Error: La verificación falló, se ha restaurado el fichero original.")
+            return
+        print(f"¡Éxito! {file_path} migrado al formato por bloques ({len(data)} registros).")
+    except Exception as e:
+        print(f"Error durante la migración: {e}")
+
 def main():
     print("Herramienta de Cifrado para Student Finder")
     print("1. Generar nueva clave")
     print("2. Cifrar archivo JSON (requiere clave)")
     print("3. Descifrar archivo JSON (requiere clave)")
+    print("4. Migrar archivo cifrado al formato por bloques (requiere clave)")
     
     choice = input("\nSelecciona una opción: ")
     
     if choice == '1':
         generate_key()
-    elif choice in ['2', '3']:
+    elif choice in ['2', '3', '4']:
         key_str = input("Introduce la clave STUDENTS_DATA_KEY: ").strip()
         if not key_str:
             print("Error: Clave no proporcionada.")
@@ -87,6 +130,8 @@ def main():
         try:
             if choice == '2':
                 encrypt_file(path, key_str.encode())
+            elif choice == '4':
+                migrate_file(path, key_str.encode())
             else:
                 decrypt_file(path, key_str.encode())
         except Exception as e:
@@ -0,0 +1,16 @@
+import os
+import sys
+from datetime import datetime
+
+# Reuse the server's configuration (.env, DATA_PATH) and exit store
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server
+
+def main():
+    default_path = f"salidas_{datetime.now().strftime('%Y%m%d')}.csv"
+    path = sys.argv[1] if len(sys.argv) > 1 else default_path
+    server.export_exits_to_csv(path)
+    print(f"Historial exportado a: {path}")
+
+if __name__ == "__main__":
+    main()